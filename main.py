@@ -2,26 +2,51 @@
 import asyncio
 import sys
 
-# noinspection PyPackageRequirements
-import aiolog
+import yaml
 
 from middleman.config import Config
+from middleman.errors import ConfigError
+
+# A different config file path can be specified as the first command line argument
+args = [arg for arg in sys.argv[1:] if not arg.startswith("--")]
+config_path = args[0] if args else "config.yaml"
+
+if "--check-config" in sys.argv[1:]:
+    # Validate the config without importing the Matrix client or setting anything up,
+    # for fast health checks
+    try:
+        Config(config_path, check_only=True)
+    except (ConfigError, OSError, yaml.YAMLError) as e:
+        print("Invalid config:", e)
+        sys.exit(1)
+    print("Config is valid")
+    sys.exit(0)
 
 try:
+    # noinspection PyPackageRequirements
+    import aiolog
+
     from middleman import main
 
     # Read config file
-
-    # A different config file path can be specified as the first command line argument
-    if len(sys.argv) > 1:
-        config_path = sys.argv[1]
-    else:
-        config_path = "config.yaml"
     config = Config(config_path)
 
+    if config.performance_mode:
+        from middleman.performance import enable_performance_mode
+
+        # Before the event loop is created
+        enable_performance_mode()
+
     aiolog.start()
 
     # Run the main function of the bot
-    asyncio.get_event_loop().run_until_complete(main.main(config)).run_until_complete(aiolog.stop())
+    try:
+        loop = asyncio.get_event_loop()
+        loop.run_until_complete(main.main(config))
+        loop.run_until_complete(aiolog.stop())
+    finally:
+        if config.log_listener:
+            # Write out any queued log records
+            config.log_listener.stop()
 except ImportError as e:
     print("Unable to import middleman.main:", e)
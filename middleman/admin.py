@@ -0,0 +1,158 @@
+"""
+Offline database administration.
+
+Run with `python -m middleman.admin [--config config.yaml] <command>`. Commands:
+
+    stats               Show the migration version, row counts and size of the database
+    prune               Delete rows the bot no longer needs
+    export              Write the rows of a table as JSON lines
+    vacuum              Reclaim free space and update query planner statistics
+    analyze             Update query planner statistics
+    migrate             Migrate the database, or show pending migrations with --dry-run
+
+Prune, vacuum and migrate are best run while the bot is stopped.
+"""
+import argparse
+import logging
+import sys
+import time
+
+from middleman.config import Config
+from middleman.errors import ConfigError
+from middleman.serialisation import dumps, use_orjson
+from middleman.storage import Storage, TABLES, latest_migration_version
+
+
+def _stats(store: Storage, args):
+    stats = store.get_stats()
+    print(f"Migration version: {stats['migration_version']} (latest {latest_migration_version})")
+    for table, rows in stats["tables"].items():
+        print(f"{table}: {rows} rows")
+    print(f"Size: {stats['size']} bytes")
+    if stats["free"] is not None:
+        print(f"Free: {stats['free']} bytes")
+
+
+def _prune(store: Storage, args):
+    relays_before = time.time() - args.relay_retention_days * 24 * 3600 if args.relay_retention_days else None
+    deleted = store.prune(args.keep_encrypted_events, relays_before)
+    for table, rows in deleted.items():
+        print(f"{table}: {rows} rows deleted")
+
+
+def _export(store: Storage, args):
+    output = open(args.output, "w") if args.output else sys.stdout
+    try:
+        rows = 0
+        for row in store.iter_table(args.table):
+            output.write(dumps(row))
+            output.write("\n")
+            rows += 1
+    finally:
+        if args.output:
+            output.close()
+    print(f"Exported {rows} rows of {args.table}", file=sys.stderr)
+
+
+def _vacuum(store: Storage, args):
+    store.vacuum()
+    print("Database vacuumed")
+
+
+def _analyze(store: Storage, args):
+    store.analyze()
+    print("Database analyzed")
+
+
+def _migrate(store: Storage, args):
+    current = store.get_migration_level()
+    if args.dry_run:
+        pending = store.dry_run_migrations()
+        if not pending:
+            print(f"Database is at the latest version v{latest_migration_version}")
+        for migration in pending:
+            transaction = "in a transaction" if migration["transactional"] else "without a transaction"
+            print(
+                f"v{migration['version']}: would run {transaction}, "
+                f"touching an estimated {migration['rows']} rows",
+            )
+        return
+    store.migrate()
+    print(f"Database migrated from v{current or 0} to v{latest_migration_version}")
+
+
+def get_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(prog="python -m middleman.admin", description="Middleman database admin")
+    parser.add_argument("-c", "--config", default="config.yaml", help="path to the bot config file")
+    parser.add_argument("-v", "--verbose", action="store_true", help="show log messages")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    subparsers.add_parser("stats", help="show row counts and the size of the database").set_defaults(
+        func=_stats, needs_latest=False,
+    )
+
+    prune = subparsers.add_parser("prune", help="delete rows the bot no longer needs")
+    prune.add_argument(
+        "--keep-encrypted-events", type=int, metavar="N",
+        help="also delete all but the newest N undecrypted events",
+    )
+    prune.add_argument(
+        "--relay-retention-days", type=int, metavar="N",
+        help="delete searchable relayed messages older than N days (default: search.retention_days)",
+    )
+    prune.set_defaults(func=_prune, needs_latest=True)
+
+    export = subparsers.add_parser("export", help="write the rows of a table as JSON lines")
+    export.add_argument("table", nargs="?", default="messages", choices=TABLES)
+    export.add_argument("--format", default="jsonl", choices=["jsonl"])
+    export.add_argument("-o", "--output", help="file to write to instead of standard output")
+    export.set_defaults(func=_export, needs_latest=True)
+
+    subparsers.add_parser("vacuum", help="reclaim free space").set_defaults(func=_vacuum, needs_latest=False)
+    subparsers.add_parser("analyze", help="update query planner statistics").set_defaults(
+        func=_analyze, needs_latest=False,
+    )
+
+    migrate = subparsers.add_parser("migrate", help="migrate the database to the latest version")
+    migrate.add_argument("--dry-run", action="store_true", help="only show the pending migrations")
+    migrate.set_defaults(func=_migrate, needs_latest=False)
+    return parser
+
+
+def main(argv=None) -> int:
+    args = get_parser().parse_args(argv)
+    try:
+        # Only read the config, without creating the store folder or setting up the log outputs of the bot
+        config = Config(args.config, check_only=True)
+    except ConfigError as ex:
+        print("Invalid config:", ex, file=sys.stderr)
+        return 1
+    handler = logging.StreamHandler(sys.stderr)
+    handler.setFormatter(logging.Formatter("%(levelname)s %(message)s"))
+    logging.getLogger().addHandler(handler)
+    if not args.verbose:
+        # Keep the output of the commands readable
+        logging.getLogger().setLevel(logging.WARNING)
+    if config.performance_mode:
+        use_orjson()
+    if args.command == "prune" and args.relay_retention_days is None:
+        args.relay_retention_days = config.search_retention_days
+
+    # Open the database without touching it, so inspecting does not migrate it
+    store = Storage(config.database, message_cache_size=0, migrate=False)
+    try:
+        if args.needs_latest and store.get_migration_level() != latest_migration_version:
+            print(
+                f"Database is at v{store.get_migration_level()}, but v{latest_migration_version} is required. "
+                f"Run the migrate command first.",
+                file=sys.stderr,
+            )
+            return 1
+        args.func(store, args)
+    finally:
+        store.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
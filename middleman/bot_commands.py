@@ -1,17 +1,28 @@
+import asyncio
 import logging
+from datetime import datetime
+from functools import cached_property
+from typing import List
 
 # noinspection PyPackageRequirements
 from nio import RoomSendResponse
 
 from middleman import commands_help
+from middleman.broadcast import Broadcast, get_tagged_rooms
 from middleman.chat_functions import send_text_to_room
-from middleman.utils import get_replaces
+from middleman.errors import ConfigError
+from middleman.utils import get_room_id, parse_relations
 
 logger = logging.getLogger(__name__)
 
+# How many relayed messages to show for a search
+SEARCH_RESULT_LIMIT = 10
+# How many characters of each relayed message to show for a search
+SEARCH_RESULT_LENGTH = 200
+
 
 class Command(object):
-    def __init__(self, client, store, config, command, room, event):
+    def __init__(self, client, store, config, command, room, event, relations=None, search=None, broadcasts=None):
         """A command made by a user
 
         Args:
@@ -26,6 +37,13 @@ class Command(object):
             room (nio.rooms.MatrixRoom): The room the command was sent in
 
             event (nio.events.room_events.RoomMessageText): The event describing the command
+
+            relations (Relations): Optional relations of the event, if already parsed
+
+            search (SearchIndex): Optional index of relayed messages to search
+
+            broadcasts (set): Optional set to add broadcast tasks to while they run, for
+                waiting for them on shutdown
         """
         self.client = client
         self.store = store
@@ -33,7 +51,14 @@ class Command(object):
         self.command = command
         self.room = room
         self.event = event
-        self.args = self.command.split()[1:]
+        self.relations = relations
+        self.search = search
+        self.broadcasts = broadcasts
+
+    @cached_property
+    def args(self):
+        # Split only when a command needs its arguments
+        return self.command.split()[1:]
 
     async def process(self):
         """Process the command"""
@@ -43,6 +68,12 @@ class Command(object):
             await self._show_help()
         elif self.command.startswith("message"):
             await self._message()
+        elif self.command.startswith("broadcast"):
+            await self._broadcast()
+        elif self.command.startswith("search"):
+            await self._search()
+        elif self.command.startswith("reload"):
+            await self._reload()
         else:
             # Just ignore. Sometimes nio is confused on the room states and we
             # used to send "sorry, unknown command" messages to massive rooms
@@ -73,6 +104,120 @@ class Command(object):
             text = "Unknown help topic!"
         await send_text_to_room(self.client, self.room.room_id, text)
 
+    async def _reload(self):
+        """Reload the config file without restarting"""
+        if self.room.room_id != self.config.management_room_id:
+            # Only allow reloading from the management room
+            return
+
+        try:
+            self.config.reload()
+        except (ConfigError, OSError) as ex:
+            logger.warning("Failed to reload config: %s", ex)
+            await send_text_to_room(self.client, self.room.room_id, f"Failed to reload config: {ex}")
+            return
+        await send_text_to_room(self.client, self.room.room_id, "Config reloaded.")
+
+    async def _get_broadcast_rooms(self, target: str) -> List[str]:
+        """Get the IDs of the rooms a broadcast target refers to
+
+        Raises:
+            ValueError: If a room alias cannot be resolved
+        """
+        if target == "all":
+            room_ids = list(self.client.rooms)
+        elif target.startswith("tag:"):
+            room_ids = await get_tagged_rooms(self.client, target[4:], self.config.broadcast_concurrency)
+        else:
+            room_ids = [await get_room_id(self.client, room, logger) for room in target.split(",") if room]
+        # Never broadcast to the bot's own rooms, nor the same room twice
+        excluded = {self.config.management_room_id, self.config.matrix_logging_room}
+        return [room_id for room_id in dict.fromkeys(room_ids) if room_id not in excluded]
+
+    async def _broadcast(self):
+        """
+        Write a m.text message to many rooms.
+        """
+        if self.room.room_id != self.config.management_room_id:
+            # Only allow broadcasting from the management room
+            return
+
+        if len(self.args) < 2:
+            await send_text_to_room(self.client, self.room.room_id, commands_help.COMMAND_BROADCAST)
+            return
+
+        target = self.args[0]
+        # Remove the command
+        text = self.command[9:]
+        # Remove the target
+        text = text.replace(target, "", 1)
+        # Strip the leading spaces
+        text = text.strip()
+
+        try:
+            room_ids = await self._get_broadcast_rooms(target)
+        except ValueError as ex:
+            await send_text_to_room(self.client, self.room.room_id, f"Failed to broadcast: {ex}")
+            return
+        if not room_ids:
+            await send_text_to_room(self.client, self.room.room_id, f"No rooms found for `{target}`.")
+            return
+
+        broadcast = Broadcast(
+            self.client, self.store, self.config, self.event.event_id, room_ids, text,
+            replaces=(self.relations or parse_relations(self.event)).replaces,
+        )
+        # Run in the background, so that other events are not held up until the broadcast is done
+        task = asyncio.ensure_future(broadcast.run())
+        if self.broadcasts is not None:
+            self.broadcasts.add(task)
+            task.add_done_callback(self.broadcasts.discard)
+
+    async def _search(self):
+        """Search the relayed messages"""
+        if self.room.room_id != self.config.management_room_id:
+            # Only allow searching from the management room
+            return
+
+        if not self.search or not self.search.enabled:
+            await send_text_to_room(self.client, self.room.room_id, "Search is not enabled.")
+            return
+
+        sender = None
+        words = []
+        for arg in self.args:
+            if arg.startswith("from:"):
+                sender = arg[5:]
+            else:
+                words.append(arg)
+        if not words and not sender:
+            await send_text_to_room(self.client, self.room.room_id, commands_help.COMMAND_SEARCH)
+            return
+        if sender and self.config.anonymise_senders:
+            await send_text_to_room(
+                self.client, self.room.room_id, "Senders are not stored, as senders are anonymised.",
+            )
+            return
+
+        results = self.search.search(" ".join(words), sender, SEARCH_RESULT_LIMIT)
+        if not results:
+            await send_text_to_room(self.client, self.room.room_id, "No relayed messages found.")
+            return
+
+        lines = []
+        for result in results:
+            body = " ".join(result.body.split())
+            if len(body) > SEARCH_RESULT_LENGTH:
+                body = body[:SEARCH_RESULT_LENGTH] + "…"
+            line = f"* {datetime.fromtimestamp(result.created):%Y-%m-%d %H:%M} "
+            if result.sender:
+                line += f"{result.sender}: "
+            line += body
+            if result.management_event_id:
+                line += f" ([relay](https://matrix.to/#/{self.room.room_id}/{result.management_event_id}))"
+            lines.append(line)
+        await send_text_to_room(self.client, self.room.room_id, "\n".join(lines))
+
     async def _message(self):
         """
         Write a m.text message to a room.
@@ -85,12 +230,12 @@ class Command(object):
             await send_text_to_room(self.client, self.room.room_id, commands_help.COMMAND_WRITE)
             return
 
-        replaces = get_replaces(self.event)
+        replaces = (self.relations or parse_relations(self.event)).replaces
         replaces_event_id = None
         if replaces:
             message = self.store.get_message_by_management_event_id(replaces)
             if message:
-                replaces_event_id = message["event_id"]
+                replaces_event_id = message.event_id
 
         room = self.args[0]
         # Remove the command
@@ -109,10 +254,10 @@ class Command(object):
                 room_id=room,
             )
             if replaces_event_id:
-                logger.info(f"Processed editing message in room {room}")
+                logger.info("Processed editing message in room %s", room)
                 await send_text_to_room(self.client, self.room.room_id, f"Message was edited in {room}")
             else:
-                logger.info(f"Processed sending message to room {room}")
+                logger.info("Processed sending message to room %s", room)
                 await send_text_to_room(self.client, self.room.room_id, f"Message was delivered to {room}")
             return
 
@@ -0,0 +1,183 @@
+import asyncio
+import logging
+from typing import Dict, List
+
+# noinspection PyPackageRequirements
+from nio import RoomSendResponse
+
+from middleman.chat_functions import send_text_to_room
+from middleman.retry import RetryBudget, RetryPolicy
+from middleman.utils import get_room_tags
+
+logger = logging.getLogger(__name__)
+
+# Seconds between edits of the progress message
+BROADCAST_PROGRESS_INTERVAL = 5
+# How many failed rooms to list in the summary
+BROADCAST_MAX_FAILURES_LISTED = 20
+# How many times to try posting the progress message before waiting for the summary
+BROADCAST_PROGRESS_ATTEMPTS = 2
+
+# Retry policy of broadcast messages. Broadcasts are expected to be rate limited, so they
+# wait longer for the homeserver, and have a budget of their own so that they do not use
+# up the retries of relays.
+broadcast_policy = RetryPolicy(
+    max_attempts=8, max_delay=60, deadline=600, budget=RetryBudget(max_tokens=50, token_ratio=0.5),
+)
+
+
+def broadcast_key(management_event_id: str, room_id: str) -> str:
+    """Get the management event ID a broadcast message is stored with in `messages`
+
+    A broadcast command is sent out as one message per room, while each management room
+    event maps to one message, so the room is made part of the key.
+    """
+    return f"{management_event_id}|{room_id}"
+
+
+async def get_tagged_rooms(client, tag: str, concurrency: int) -> List[str]:
+    """Get the joined rooms that the bot has tagged with the given tag
+
+    Args:
+        client (nio.AsyncClient): nio client used to interact with matrix
+
+        tag (str): The room tag, for example `u.support`
+
+        concurrency (int): How many rooms to fetch the tags of at a time
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def has_tag(room_id: str) -> bool:
+        async with semaphore:
+            try:
+                return tag in await get_room_tags(client, room_id)
+            except Exception as ex:
+                logger.warning("Failed to get the tags of room %s: %s", room_id, ex)
+                return False
+
+    room_ids = list(client.rooms)
+    tagged = await asyncio.gather(*(has_tag(room_id) for room_id in room_ids))
+    return [room_id for room_id, is_tagged in zip(room_ids, tagged) if is_tagged]
+
+
+class Broadcast(object):
+    def __init__(self, client, store, config, management_event_id, room_ids, text, replaces=None):
+        """A message sent out to many rooms
+
+        Messages are sent to `config.broadcast_concurrency` rooms at a time, relying on
+        `broadcast_policy` to back off when rate limited. Progress is posted to the management
+        room as one message that is edited in place. If the progress message cannot be
+        posted, only the summary is posted. Each message sent is stored in `messages`
+        keyed by `broadcast_key`, so that editing the broadcast command edits every message.
+
+        Args:
+            client (nio.AsyncClient): nio client used to interact with matrix
+
+            store (Storage): Bot storage
+
+            config (Config): Bot configuration parameters
+
+            management_event_id (str): The management room event of the broadcast command
+
+            room_ids (list): The IDs of the rooms to send to
+
+            text (str): The message to send
+
+            replaces (str): Optional management room event of the broadcast command this edits
+        """
+        self.client = client
+        self.store = store
+        self.config = config
+        self.management_event_id = management_event_id
+        self.room_ids = room_ids
+        self.text = text
+        self.replaces = replaces
+        self.delivered = 0
+        self.failed: Dict[str, str] = {}
+        self.progress_event_id = None
+        self.progress_attempts = 0
+
+    @property
+    def noun(self) -> str:
+        return "Broadcast edit" if self.replaces else "Broadcast"
+
+    def _progress_text(self) -> str:
+        return (
+            f"{self.noun} in progress to {len(self.room_ids)} rooms: {self.delivered} delivered, "
+            f"{len(self.failed)} failed."
+        )
+
+    def _summary_text(self) -> str:
+        text = f"{self.noun} delivered to {self.delivered} of {len(self.room_ids)} rooms."
+        if self.failed:
+            failures = [f"* `{room_id}`: {error}" for room_id, error in self.failed.items()]
+            if len(failures) > BROADCAST_MAX_FAILURES_LISTED:
+                more = len(failures) - BROADCAST_MAX_FAILURES_LISTED
+                failures = failures[:BROADCAST_MAX_FAILURES_LISTED] + [f"* ...and {more} more"]
+            text += "\n\nFailed rooms:\n\n" + "\n".join(failures)
+        return text
+
+    async def _post_progress(self, text: str, summary: bool = False):
+        if not self.progress_event_id:
+            if self.progress_attempts >= BROADCAST_PROGRESS_ATTEMPTS and not summary:
+                # Don't post a new message for every update
+                return
+            self.progress_attempts += 1
+        response = await send_text_to_room(
+            self.client, self.config.management_room_id, text, True, replaces_event_id=self.progress_event_id,
+        )
+        if not self.progress_event_id and isinstance(response, RoomSendResponse):
+            self.progress_event_id = response.event_id
+
+    async def _update_progress(self):
+        while True:
+            await asyncio.sleep(BROADCAST_PROGRESS_INTERVAL)
+            try:
+                await self._post_progress(self._progress_text())
+            except Exception as ex:
+                logger.warning("Failed to update broadcast progress: %s", ex)
+
+    async def _send(self, room_id: str, semaphore: asyncio.Semaphore):
+        async with semaphore:
+            replaces_event_id = None
+            if self.replaces:
+                message = self.store.get_message_by_management_event_id(broadcast_key(self.replaces, room_id))
+                if not message:
+                    self.failed[room_id] = "the original broadcast was not delivered"
+                    return
+                replaces_event_id = message.event_id
+            try:
+                response = await send_text_to_room(
+                    self.client, room_id, self.text, False, replaces_event_id=replaces_event_id,
+                    policy=broadcast_policy,
+                )
+            except Exception as ex:
+                response = str(ex)
+
+        if isinstance(response, RoomSendResponse) and response.event_id:
+            self.store.store_message(
+                event_id=response.event_id,
+                management_event_id=broadcast_key(self.management_event_id, room_id),
+                room_id=room_id,
+            )
+            self.delivered += 1
+        else:
+            self.failed[room_id] = getattr(response, "message", response)
+            logger.warning("Failed to broadcast to room %s: %s", room_id, self.failed[room_id])
+
+    async def run(self):
+        logger.info("Broadcasting %s to %s rooms", self.management_event_id, len(self.room_ids))
+        try:
+            await self._post_progress(self._progress_text())
+        except Exception as ex:
+            logger.warning("Failed to post broadcast progress: %s", ex)
+        progress = asyncio.ensure_future(self._update_progress())
+        semaphore = asyncio.Semaphore(max(self.config.broadcast_concurrency, 1))
+        try:
+            await asyncio.gather(*(self._send(room_id, semaphore) for room_id in self.room_ids))
+        finally:
+            progress.cancel()
+        logger.info(
+            "Broadcast %s delivered to %s of %s rooms", self.management_event_id, self.delivered, len(self.room_ids),
+        )
+        await self._post_progress(self._summary_text(), summary=True)
@@ -1,17 +1,26 @@
-import json
+import asyncio
 import logging
+import time
+from functools import wraps
 
 # noinspection PyPackageRequirements
-from nio import (
-    JoinError, MatrixRoom, Event, RoomKeyEvent, RoomMessageText, MegolmEvent, LocalProtocolError,
-    RoomKeyRequestError, RoomMemberEvent,
-)
+from nio import JoinError, MatrixRoom, Event, RoomKeyEvent, RoomMessageText, MegolmEvent, RoomMemberEvent
 
 from middleman.bot_commands import Command
 from middleman.chat_functions import send_text_to_room
+from middleman.coalescing import BurstCoalescer
+from middleman.digest import Digest
+from middleman.flood import FloodGuard
+from middleman.group_sessions import GroupSessionSharer
+from middleman.inbound import (
+    InboundQueue, PRIORITY_DIRECT, PRIORITY_MANAGEMENT, PRIORITY_NAMED, PRIORITY_UNMENTIONED,
+)
+from middleman.key_requests import KeyRequestManager
 from middleman.media_responses import Media
-from middleman.message_responses import Message
-from middleman.utils import with_ratelimit
+from middleman.message_responses import Message, is_mention_only_room
+from middleman.outbox import Outbox
+from middleman.search import SearchIndex
+from middleman.utils import parse_relations, restore_megolm_event, with_ratelimit
 
 logger = logging.getLogger(__name__)
 
@@ -33,13 +42,90 @@ class Callbacks(object):
         self.config = config
         self.command_prefix = config.command_prefix
         self.received_events = []
-        self.welcome_message_sent_to_room = []
+        # Rooms that have been sent the welcome message, preloaded so checking needs no database read
+        self.welcome_message_sent_to_room = set(store.get_welcome_message_rooms())
+        self.coalescer = BurstCoalescer(config)
+        self.digest = Digest(config)
+        self.flood = FloodGuard(config)
+        self.outbox = Outbox(client, store, config)
+        self.search = SearchIndex(store, config)
+        self.group_sessions = GroupSessionSharer(client, config)
+        self.key_requests = KeyRequestManager(client, store)
+        self.inbound = InboundQueue(config)
+        # Amount of callbacks currently being processed
+        self.in_flight = 0
+        # Amount of events currently being handed to the callbacks by the sync
+        self.receiving = 0
+        # Broadcasts in progress
+        self.broadcasts = set()
+
+    def received(self, callback):
+        """Wrap a callback registered with the client to keep count of events being received, for
+        stopping the sync between batches on shutdown"""
+        @wraps(callback)
+        async def wrapper(*args):
+            self.receiving += 1
+            try:
+                return await callback(*args)
+            finally:
+                self.receiving -= 1
+        return wrapper
+
+    def tracked(self, callback):
+        """Wrap a callback to keep count of callbacks in progress, for draining them on shutdown"""
+        @wraps(callback)
+        async def wrapper(*args):
+            self.in_flight += 1
+            try:
+                return await callback(*args)
+            finally:
+                self.in_flight -= 1
+        return wrapper
+
+    def queued(self, callback):
+        """Wrap a room event callback to go through the inbound queue, if enabled"""
+        if not self.inbound.enabled:
+            return callback
+
+        @wraps(callback)
+        async def wrapper(room, event):
+            await self.inbound.put(self.get_priority(room, event), callback, room, event)
+        return wrapper
+
+    def get_priority(self, room: MatrixRoom, event: Event) -> int:
+        """Get the priority of an inbound room event"""
+        if room.room_id == self.config.management_room_id:
+            return PRIORITY_MANAGEMENT
+        if is_mention_only_room(self.config, [room.canonical_alias, room.room_id], room.is_named):
+            body = getattr(event, "body", None) or ""
+            if self.config.user_localpart.lower() not in body.lower():
+                return PRIORITY_UNMENTIONED
+        if not room.is_named:
+            return PRIORITY_DIRECT
+        return PRIORITY_NAMED
+
+    async def drain(self, timeout: float):
+        """Wait for the callbacks in progress, the queued events and those waiting to be queued, the
+        outbox item being sent and the broadcasts in progress to finish, for at most timeout seconds
+
+        Returns:
+            A tuple of the amount of callbacks that finished and the amount still in progress or queued
+        """
+        in_flight = self.in_flight + self.inbound.size + self.inbound.waiting
+        deadline = time.monotonic() + timeout
+        while (
+            (self.in_flight or self.inbound.size or self.inbound.waiting or self.outbox.running or self.broadcasts)
+            and time.monotonic() < deadline
+        ):
+            await asyncio.sleep(0.1)
+        remaining = self.in_flight + self.inbound.size + self.inbound.waiting
+        return max(in_flight - remaining, 0), remaining
 
     async def decrypted_callback(self, room_id: str, event: RoomMessageText):
         if isinstance(event, RoomMessageText):
             await self.message(self.client.rooms[room_id], event)
         else:
-            logger.warning(f"Unknown event %s passed to decrypted_callback" % event)
+            logger.warning("Unknown event %s passed to decrypted_callback", event)
 
     async def decryption_failure(self, room: MatrixRoom, event: MegolmEvent):
         """Callback for when an event fails to decrypt."""
@@ -51,26 +137,19 @@ class Callbacks(object):
         # Store for later
         self.store.store_encrypted_event(event)
 
-        waiting_for_keys = self.store.get_encrypted_events_for_user(event.sender)
+        waiting_for_keys = self.store.count_encrypted_events_for_user(event.sender)
         logger.info(
             "Waiting to decrypt %s events from sender %s",
-            len(waiting_for_keys), event.sender,
+            waiting_for_keys, event.sender,
         )
 
-        # Send a request for the key
-        response = None
-        try:
-            response = await self.client.request_room_key(event)
-        except LocalProtocolError as ex:
-            if str(ex) != "A key sharing request is already sent out for this session id.":
-                logger.warning(f"Failed to request room key for event {event.event_id}: {ex}")
-        if isinstance(response, RoomKeyRequestError):
-            logger.warning("RoomKeyRequestError: %s (%s)", response.message, response.status_code)
-
-        # Send a message to the management room if
+        # Send a request for the key, unless already requested for this session
+        first_failure = await self.key_requests.request(event)
+
+        # Send a message to the management room once per session if
         # * matrix logging is not enabled
         # * room is not named (ie dm normally)
-        if not self.config.matrix_logging_room or not room.is_named:
+        if first_failure and (not self.config.matrix_logging_room or not room.is_named):
             await send_text_to_room(
                 client=self.client,
                 room=self.config.management_room_id,
@@ -81,8 +160,6 @@ class Callbacks(object):
     def trim_duplicates_caches(self):
         if len(self.received_events) > DUPLICATES_CACHE_SIZE:
             self.received_events = self.received_events[:DUPLICATES_CACHE_SIZE]
-        if len(self.welcome_message_sent_to_room) > DUPLICATES_CACHE_SIZE:
-            self.welcome_message_sent_to_room = self.welcome_message_sent_to_room[:DUPLICATES_CACHE_SIZE]
 
     async def member(self, room: MatrixRoom, event: RoomMemberEvent) -> None:
         """Callback for when a room member event is received.
@@ -96,12 +173,15 @@ class Callbacks(object):
             # Don't react to anything in the logging room
             return
 
+        if room.room_id == self.config.management_room_id:
+            # Share the group session with any new members before the next relay needs it
+            self.group_sessions.request_share()
+
         self.trim_duplicates_caches()
         if self.should_process(event.event_id) is False:
             return
         logger.debug(
-            f"Received a room member event for {room.display_name} | "
-            f"{event.sender}: {event.membership}"
+            "Received a room member event for %s | %s: %s", room.display_name, event.sender, event.membership,
         )
 
         # Ignore if it was not us joining the room
@@ -117,15 +197,16 @@ class Callbacks(object):
         # Send welcome message if configured
         if self.config.welcome_message and room.is_group:
             if room.room_id in self.welcome_message_sent_to_room:
-                logger.debug(f"Not sending welcome message to room {room.room_id} - it's been sent already!")
+                logger.debug("Not sending welcome message to room %s - it's been sent already!", room.room_id)
                 return
             # Send welcome message
-            logger.info(f"Sending welcome message to room {room.room_id}")
-            self.welcome_message_sent_to_room.insert(0, room.room_id)
+            logger.info("Sending welcome message to room %s", room.room_id)
+            self.welcome_message_sent_to_room.add(room.room_id)
+            self.store.store_welcome_message_room(room.room_id)
             await send_text_to_room(self.client, room.room_id, self.config.welcome_message, True)
 
         # Notify the management room for visibility
-        logger.info(f"Notifying management room of room join to {room.room_id}")
+        logger.info("Notifying management room of room join to %s", room.room_id)
         await send_text_to_room(
             self.client,
             self.config.management_room_id,
@@ -161,11 +242,14 @@ class Callbacks(object):
         if msg.startswith(" * "):
             msg = msg[3:]
 
-        logger.debug(
-            f"Bot message received for room {room.display_name} | "
-            f"{room.user_name(event.sender)} (named: {room.is_named}, name: {room.name}, "
-            f"alias: {room.canonical_alias}): {msg}"
-        )
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(
+                "Bot message received for room %s | %s (named: %s, name: %s, alias: %s): %s",
+                room.display_name, room.user_name(event.sender), room.is_named, room.name, room.canonical_alias, msg,
+            )
+
+        # Parse reply and edit relations once for the handlers, only management room messages need them
+        relations = parse_relations(event) if room.room_id == self.config.management_room_id else None
 
         # Process as message if in a public room without command prefix
         has_command_prefix = msg.startswith(self.command_prefix) or msg.startswith("!message")
@@ -177,11 +261,18 @@ class Callbacks(object):
                 # Remove the command prefix
                 msg = msg[len(self.command_prefix):]
 
-            command = Command(self.client, self.store, self.config, msg, room, event)
+            command = Command(
+                self.client, self.store, self.config, msg, room, event, relations=relations, search=self.search,
+                broadcasts=self.broadcasts,
+            )
             await command.process()
         else:
             # General message listener
-            message = Message(self.client, self.store, self.config, msg, room, event)
+            message = Message(
+                self.client, self.store, self.config, msg, room, event,
+                coalescer=self.coalescer, digest=self.digest, outbox=self.outbox, relations=relations,
+                search=self.search, flood=self.flood,
+            )
             await message.process()
 
     async def media(self, room, event):
@@ -220,15 +311,16 @@ class Callbacks(object):
         # Extract media info
         media_info = event.source.get("content").get("info")
 
-        logger.debug(
-            f"Bot media received for room {room.display_name} | "
-            f"{room.user_name(event.sender)} (named: {room.is_named}, name: {room.name}, "
-            f"alias: {room.canonical_alias}): {body}"
-        )
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(
+                "Bot media received for room %s | %s (named: %s, name: %s, alias: %s): %s",
+                room.display_name, room.user_name(event.sender), room.is_named, room.name, room.canonical_alias, body,
+            )
 
         # General media listener
         media = Media(
             self.client, self.store, self.config, msgtype, body, media_url, media_file, media_info, room, event,
+            flood=self.flood,
         )
         await media.process()
 
@@ -236,19 +328,20 @@ class Callbacks(object):
         """Callback for when an invitation is received. Join the room specified in the invite"""
         if self.should_process(event.source.get("event_id")) is False:
             return
-        logger.debug(f"Got invite to {room.room_id} from {event.sender}.")
+        logger.debug("Got invite to %s from %s.", room.room_id, event.sender)
 
         result = await with_ratelimit(self.client, "join", room.room_id)
         if type(result) == JoinError:
             logger.error("Unable to join room: %s", room.room_id)
             return
 
-        logger.info(f"Joined {room.room_id}")
+        logger.info("Joined %s", room.room_id)
 
     async def room_key(self, event: RoomKeyEvent):
         """Callback for ToDevice events like room key events."""
+        self.key_requests.fulfilled(event.session_id)
         events = self.store.get_encrypted_events(event.session_id)
-        waiting_for_keys = self.store.get_encrypted_events_for_user(event.sender)
+        waiting_for_keys = self.store.count_encrypted_events_for_user(event.sender)
         if len(events):
             log_func = logger.info
         else:
@@ -259,7 +352,7 @@ class Callbacks(object):
         )
         log_func(
             "Waiting to decrypt %s events from sender %s",
-            len(waiting_for_keys), event.sender,
+            waiting_for_keys, event.sender,
         )
 
         if not events:
@@ -267,13 +360,9 @@ class Callbacks(object):
 
         for encrypted_event in events:
             try:
-                event_dict = json.loads(encrypted_event["event"])
-                params = event_dict["source"]
-                params["room_id"] = event_dict["room_id"]
-                params["transaction_id"] = event_dict["transaction_id"]
-                megolm_event = MegolmEvent.from_dict(params)
+                megolm_event = restore_megolm_event(encrypted_event.event)
             except Exception as ex:
-                logger.warning("Failed to restore MegolmEvent for %s: %s", encrypted_event["event_id"], ex)
+                logger.warning("Failed to restore MegolmEvent for %s: %s", encrypted_event.event_id, ex)
                 continue
             try:
                 # noinspection PyTypeChecker
@@ -287,7 +376,7 @@ class Callbacks(object):
                 logger.info("Parsed event: %s", parsed_event)
                 self.store.remove_encrypted_event(decrypted.event_id)
                 # noinspection PyTypeChecker
-                await self.decrypted_callback(encrypted_event["room_id"], parsed_event)
+                await self.decrypted_callback(encrypted_event.room_id, parsed_event)
             else:
                 logger.warning("Failed to decrypt event %s", decrypted.event_id)
 
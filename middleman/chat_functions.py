@@ -1,26 +1,32 @@
 import logging
+import uuid
 from typing import Union
 
-from commonmark import commonmark
 # noinspection PyPackageRequirements
 from nio import SendRetryError, RoomSendResponse, RoomSendError, LocalProtocolError, AsyncClient
 
+from middleman.retry import RETRYABLE_EXCEPTIONS, RetryPolicy, with_retry
 from middleman.utils import get_room_id
 
 logger = logging.getLogger(__name__)
 
+# Errors sending a message, after any retries
+SEND_EXCEPTIONS = (LocalProtocolError, SendRetryError) + RETRYABLE_EXCEPTIONS
 
-async def send_text_to_room(
-    client: AsyncClient, room: str, message: str, notice: bool = True, markdown_convert: bool = True,
-    reply_to_event_id: str = None, replaces_event_id: str = None, notify_room_on_failure: str = None,
-) -> Union[RoomSendResponse, RoomSendError, str]:
-    """Send text to a matrix room
 
-    Args:
-        client (nio.AsyncClient): The client to communicate to matrix with
+def markdown_to_html(text: str) -> str:
+    """Convert markdown to HTML, importing the converter on first use"""
+    from commonmark import commonmark
+    return commonmark(text)
 
-        room (str): The ID or alias of the room to send the message to
 
+def make_text_content(
+    message: str, notice: bool = True, markdown_convert: bool = True, reply_to_event_id: str = None,
+    replaces_event_id: str = None,
+) -> dict:
+    """Build the content of a text message event
+
+    Args:
         message (str): The message content
 
         notice (bool): Whether the message should be sent with an "m.notice" message type
@@ -32,14 +38,7 @@ async def send_text_to_room(
         reply_to_event_id (str): Optional event ID that this message is a reply to.
 
         replaces_event_id (str): Optional event ID that this message replaces.
-
-        notify_room_on_failure (str): Optional room ID to notify on failure.
     """
-    try:
-        room_id = await get_room_id(client, room, logger)
-    except ValueError as ex:
-        return str(ex)
-
     # Determine whether to ping room members or not
     msgtype = "m.notice" if notice else "m.text"
 
@@ -50,7 +49,7 @@ async def send_text_to_room(
     }
 
     if markdown_convert:
-        content["formatted_body"] = commonmark(message)
+        content["formatted_body"] = markdown_to_html(message)
 
     if replaces_event_id:
         content["m.relates_to"] = {
@@ -63,7 +62,7 @@ async def send_text_to_room(
             "body": message,
         }
         if markdown_convert:
-            content["m.new_content"]["formatted_body"] = commonmark(message)
+            content["m.new_content"]["formatted_body"] = markdown_to_html(message)
     # We don't store the original message content so cannot provide the fallback, unfortunately
     elif reply_to_event_id:
         content["m.relates_to"] = {
@@ -72,14 +71,79 @@ async def send_text_to_room(
             },
         }
 
+    return content
+
+
+async def room_send(
+    client: AsyncClient, room_id: str, message_type: str, content: dict, policy: RetryPolicy = None,
+) -> Union[RoomSendResponse, RoomSendError]:
+    """Send an event to a room, retrying it according to the retry policy
+
+    In an encrypted room the outbound group session is shared first if needed, outside of
+    the retries, so that claiming keys for and sharing with every member device in a large
+    room does not count towards the deadline of the send.
+
+    Raises:
+        LocalProtocolError, SendRetryError: If the event can not be encrypted or sent
+
+        asyncio.TimeoutError, aiohttp.ClientError: If the retry policy gives up on an error
+    """
+    room = client.rooms.get(room_id)
+    if room and room.encrypted and client.olm:
+        if client.should_query_keys:
+            await client.keys_query()
+        if client.olm.should_share_group_session(room_id):
+            await client.share_group_session(room_id, ignore_unverified_devices=True)
+
+    # Reuse the transaction ID on retries so that the event is not sent twice
+    tx_id = str(uuid.uuid4())
+    return await with_retry(lambda: client.room_send(
+        room_id,
+        message_type,
+        content,
+        tx_id=tx_id,
+        ignore_unverified_devices=True,
+    ), policy)
+
+
+async def send_text_to_room(
+    client: AsyncClient, room: str, message: str, notice: bool = True, markdown_convert: bool = True,
+    reply_to_event_id: str = None, replaces_event_id: str = None, notify_room_on_failure: str = None,
+    policy: RetryPolicy = None,
+) -> Union[RoomSendResponse, RoomSendError, str]:
+    """Send text to a matrix room
+
+    Args:
+        client (nio.AsyncClient): The client to communicate to matrix with
+
+        room (str): The ID or alias of the room to send the message to
+
+        message (str): The message content
+
+        notice (bool): Whether the message should be sent with an "m.notice" message type
+            (will not ping users)
+
+        markdown_convert (bool): Whether to convert the message content to markdown.
+            Defaults to true.
+
+        reply_to_event_id (str): Optional event ID that this message is a reply to.
+
+        replaces_event_id (str): Optional event ID that this message replaces.
+
+        notify_room_on_failure (str): Optional room ID to notify on failure.
+
+        policy (RetryPolicy): Optional retry policy to send with, instead of the default one.
+    """
     try:
-        return await client.room_send(
-            room_id,
-            "m.room.message",
-            content,
-            ignore_unverified_devices=True,
-        )
-    except (LocalProtocolError, SendRetryError) as ex:
+        room_id = await get_room_id(client, room, logger)
+    except ValueError as ex:
+        return str(ex)
+
+    content = make_text_content(message, notice, markdown_convert, reply_to_event_id, replaces_event_id)
+
+    try:
+        return await room_send(client, room_id, "m.room.message", content, policy)
+    except SEND_EXCEPTIONS as ex:
         logger.exception(f"Unable to send message response to {room_id}")
 
         if notify_room_on_failure:
@@ -90,10 +154,10 @@ async def send_text_to_room(
                     room=notify_room_on_failure,
                     message="Message did not get delivered due to an error. Please try again.",
                 )
-            except (LocalProtocolError, SendRetryError):
+            except SEND_EXCEPTIONS:
                 logger.exception(f"Failed to notify sender in {notify_room_on_failure} of failed message send")
 
-        return f"Failed to send message: {ex}"
+        return f"Failed to send message: {str(ex) or type(ex).__name__}"
 
 
 async def send_reaction(
@@ -124,20 +188,16 @@ async def send_reaction(
     }
 
     try:
-        return await client.room_send(
-            room_id,
-            "m.reaction",
-            content,
-            ignore_unverified_devices=True,
-        )
-    except (LocalProtocolError, SendRetryError) as ex:
+        return await room_send(client, room_id, "m.reaction", content)
+    except SEND_EXCEPTIONS as ex:
         logger.exception(f"Unable to send reaction to {event_id}")
-        return f"Failed to send reaction: {ex}"
+        return f"Failed to send reaction: {str(ex) or type(ex).__name__}"
 
 
 async def send_media_to_room(
     client: AsyncClient, room: str, media_type: str, body: str, media_url: str = None,
-    media_file: dict = None, media_info: dict = None, reply_to_event_id: str = None,
+    media_file: dict = None, media_info: dict = None, reply_to_event_id: str = None, filename: str = None,
+    markdown_convert: bool = False,
 ) -> Union[RoomSendResponse, RoomSendError, str]:
     """Send media to a matrix room
 
@@ -157,6 +217,12 @@ async def send_media_to_room(
         media_info (dict): The media url and metadata
 
         reply_to_event_id (str): Optional event ID that this message is a reply to.
+
+        filename (str): Optional original file name. When given, the body is sent as a caption
+            of the media as per MSC2530.
+
+        markdown_convert (bool): Whether to add the body converted from markdown as a formatted
+            caption. Only used when a filename is given. Defaults to false.
     """
     try:
         room_id = await get_room_id(client, room, logger)
@@ -181,6 +247,12 @@ async def send_media_to_room(
     if media_info:
         content.update({"info": media_info})
 
+    if filename:
+        content["filename"] = filename
+        if markdown_convert:
+            content["format"] = "org.matrix.custom.html"
+            content["formatted_body"] = markdown_to_html(body)
+
     # We don't store the original message content so cannot provide the fallback, unfortunately
     if reply_to_event_id:
         content["m.relates_to"] = {
@@ -190,12 +262,7 @@ async def send_media_to_room(
         }
 
     try:
-        return await client.room_send(
-            room_id,
-            "m.room.message",
-            content,
-            ignore_unverified_devices=True,
-        )
-    except (LocalProtocolError, SendRetryError) as ex:
+        return await room_send(client, room_id, "m.room.message", content)
+    except SEND_EXCEPTIONS as ex:
         logger.exception(f"Unable to send media response to {room_id}")
-        return f"Failed to send media: {ex}"
+        return f"Failed to send media: {str(ex) or type(ex).__name__}"
@@ -0,0 +1,82 @@
+import logging
+import time
+from typing import Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Maximum messages merged into one relay. Every message resends the whole burst as an edit.
+BURST_MAX_MESSAGES = 20
+# Maximum characters of messages merged into one relay, well below the Matrix event size limit
+BURST_MAX_LENGTH = 8000
+
+
+class Burst(object):
+    def __init__(self, management_event_id: str, content: str):
+        """A run of messages from one sender in one room relayed as one management room event
+
+        Args:
+            management_event_id (str): The management room event the burst was relayed as
+
+            content (str): The first message of the burst
+        """
+        self.management_event_id = management_event_id
+        self.contents = [content]
+        self.length = len(content)
+        self.last_seen = time.monotonic()
+
+    def fits(self, content: str) -> bool:
+        """Whether a message can be added without the burst growing over its limits"""
+        return len(self.contents) < BURST_MAX_MESSAGES and self.length + len(content) <= BURST_MAX_LENGTH
+
+
+class BurstCoalescer(object):
+    def __init__(self, config):
+        """Tracks recent relays per (room, sender) so quick consecutive messages can be merged
+
+        Bursts are merged for `config.coalesce_window` seconds after their last message. Zero disables.
+        A burst is closed once it has `BURST_MAX_MESSAGES` messages or the next message would take
+        it over `BURST_MAX_LENGTH` characters, and the next message starts a new burst.
+
+        Args:
+            config (Config): Bot configuration parameters
+        """
+        self.config = config
+        self.bursts: Dict[Tuple[str, str], Burst] = {}
+
+    @property
+    def window(self) -> float:
+        return self.config.coalesce_window
+
+    @property
+    def enabled(self) -> bool:
+        return self.window > 0
+
+    def _evict_expired(self, now: float):
+        expired = [key for key, burst in self.bursts.items() if now - burst.last_seen > self.window]
+        for key in expired:
+            del self.bursts[key]
+
+    def get(self, room_id: str, sender: str, content: str) -> Optional[Burst]:
+        """Get the open burst for this room and sender, if any and if the message fits in it."""
+        now = time.monotonic()
+        self._evict_expired(now)
+        burst = self.bursts.get((room_id, sender))
+        if burst and not burst.fits(content):
+            self.close(room_id, sender)
+            return None
+        return burst
+
+    def close(self, room_id: str, sender: str):
+        """Close the open burst for this room and sender, so the next message starts a new one."""
+        self.bursts.pop((room_id, sender), None)
+
+    def start(self, room_id: str, sender: str, management_event_id: str, content: str):
+        """Open a new burst after a message has been relayed as a new management room event."""
+        self.bursts[(room_id, sender)] = Burst(management_event_id, content)
+
+    def extend(self, burst: Burst, content: str) -> List[str]:
+        """Add a message to a burst, returning all the messages it now contains."""
+        burst.contents.append(content)
+        burst.length += len(content)
+        burst.last_seen = time.monotonic()
+        return burst.contents
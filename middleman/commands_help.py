@@ -6,3 +6,32 @@ For example:
 
 `!message #foobar:domain.tld Hello people in the Foobar room.`
 """
+
+COMMAND_BROADCAST = """Sends a message to many rooms using the bot. Usage:
+
+`<command prefix> broadcast <rooms> <Text to write>`
+
+Where rooms is one of:
+
+* `all`: All rooms the bot is in
+* `tag:<tag>`: The rooms the bot account has tagged with the tag, for example `tag:u.support`
+* A comma separated list of room IDs or aliases, for example `#foo:domain.tld,#bar:domain.tld`
+
+For example:
+
+`!middleman broadcast all Maintenance starts in 10 minutes.`
+
+Editing the command edits the message in every room.
+"""
+
+COMMAND_SEARCH = """Searches the messages relayed to the management room. Usage:
+
+`<command prefix> search <words>`
+
+Add `from:<user ID>` to find only messages from one sender, or give only that to list
+their latest messages.
+
+For example:
+
+`!middleman search from:@user:domain.tld invoice`
+"""
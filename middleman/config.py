@@ -1,14 +1,16 @@
 import logging
 import os
+import queue
 import re
 import sys
+from logging.handlers import QueueHandler, QueueListener
 from typing import Any, List
 
 import yaml
-# noinspection PyPackageRequirements
-from aiolog import matrix
 
 from middleman.errors import ConfigError
+from middleman.log_formatters import JsonFormatter
+from middleman.matrix_logging import BufferedMatrixHandler
 
 logger = logging.getLogger()
 # Prevent debug messages from peewee lib
@@ -21,25 +23,37 @@ logging.getLogger('nio').setLevel(logging.WARNING)
 
 
 class Config(object):
-    def __init__(self, filepath):
+    def __init__(self, filepath, check_only: bool = False):
         """
         Args:
             filepath (str): Path to config file
+
+            check_only (bool): Only validate the config, without setting up log output or
+                creating the store folder
         """
         if not os.path.isfile(filepath):
             raise ConfigError(f"Config file '{filepath}' does not exist")
 
+        self.filepath = filepath
+
         # Load in the config file at the given filepath
-        with open(filepath) as file_stream:
-            self.config = yaml.safe_load(file_stream.read())
+        self.config = self._read_file()
 
         # Logging setup
         formatter = logging.Formatter(
             "%(asctime)s | %(name)s [%(levelname)s] %(message)s"
         )
 
-        log_level = self._get_cfg(["logging", "level"], default="INFO")
-        logger.setLevel(log_level)
+        logger.setLevel(self._get_log_level())
+
+        log_format = self._get_cfg(["logging", "format"], required=False, default="text")
+        if log_format == "json":
+            output_formatter = JsonFormatter()
+        elif log_format == "text":
+            output_formatter = formatter
+        else:
+            raise ConfigError("logging.format must be one of 'text' or 'json'")
+        output_handlers = []
 
         file_logging_enabled = self._get_cfg(
             ["logging", "file_logging", "enabled"], default=False
@@ -47,18 +61,30 @@ class Config(object):
         file_logging_filepath = self._get_cfg(
             ["logging", "file_logging", "filepath"], default="bot.log"
         )
-        if file_logging_enabled:
+        if file_logging_enabled and not check_only:
             handler = logging.FileHandler(file_logging_filepath)
-            handler.setFormatter(formatter)
-            logger.addHandler(handler)
+            handler.setFormatter(output_formatter)
+            output_handlers.append(handler)
 
         console_logging_enabled = self._get_cfg(
             ["logging", "console_logging", "enabled"], default=True
         )
-        if console_logging_enabled:
+        if console_logging_enabled and not check_only:
             handler = logging.StreamHandler(sys.stdout)
-            handler.setFormatter(formatter)
-            logger.addHandler(handler)
+            handler.setFormatter(output_formatter)
+            output_handlers.append(handler)
+
+        # Optionally write file and console logs from a background thread, so that
+        # logging does not block the event loop on slow disks or pipes
+        self.log_listener = None
+        if self._get_cfg(["logging", "queue"], required=False, default=False) and not check_only:
+            log_queue = queue.SimpleQueue()
+            logger.addHandler(QueueHandler(log_queue))
+            self.log_listener = QueueListener(log_queue, *output_handlers, respect_handler_level=True)
+            self.log_listener.start()
+        else:
+            for handler in output_handlers:
+                logger.addHandler(handler)
 
         # Storage setup
         self.store_path = self._get_cfg(["storage", "store_path"], required=True)
@@ -66,7 +92,8 @@ class Config(object):
         # Create the store folder if it doesn't exist
         if not os.path.isdir(self.store_path):
             if not os.path.exists(self.store_path):
-                os.mkdir(self.store_path)
+                if not check_only:
+                    os.mkdir(self.store_path)
             else:
                 raise ConfigError(
                     f"storage.store_path '{self.store_path}' is not a directory"
@@ -83,11 +110,20 @@ class Config(object):
             self.database = {
                 "type": "sqlite",
                 "connection_string": database_path[len(sqlite_scheme):],
+                "profile": self._get_cfg(["storage", "sqlite", "profile"], required=False, default="default"),
+                "mmap_size": self._get_cfg(["storage", "sqlite", "mmap_size"], required=False, default=0),
+                "cache_size": self._get_cfg(["storage", "sqlite", "cache_size"], required=False, default=0),
             }
+            if self.database["profile"] not in ("default", "performance"):
+                raise ConfigError("storage.sqlite.profile must be one of 'default' or 'performance'")
         elif database_path.startswith(postgres_scheme):
             self.database = {"type": "postgres", "connection_string": database_path}
         else:
             raise ConfigError("Invalid connection string for storage.database")
+        self.message_cache_size = self._get_cfg(["storage", "message_cache_size"], required=False, default=1000)
+        self.database_maintenance_interval = self._get_cfg(
+            ["storage", "maintenance_interval"], required=False, default=3600,
+        )
 
         # Matrix bot account setup
         self.user_id = self._get_cfg(["matrix", "user_id"], required=True)
@@ -108,35 +144,237 @@ class Config(object):
 
         self.command_prefix = self._get_cfg(["command_prefix"], default="!c") + " "
 
+        self.performance_mode = self._get_cfg(["performance_mode"], required=False, default=False)
+
         # Matrix logging
         matrix_logging_enabled = self._get_cfg(["logging", "matrix_logging", "enabled"], default=False)
+        matrix_logging_batch_interval = self._get_cfg(
+            ["logging", "matrix_logging", "batch", "interval"], required=False, default=0,
+        )
         self.matrix_logging_room = None
-        if matrix_logging_enabled:
+        self.matrix_logging_handler = None
+        if matrix_logging_enabled and matrix_logging_batch_interval:
+            self.matrix_logging_room = self._get_cfg(["logging", "matrix_logging", "room"], required=True)
+            self.matrix_logging_handler = BufferedMatrixHandler(
+                room_id=self.matrix_logging_room,
+                interval=matrix_logging_batch_interval,
+                batch_size=self._get_cfg(["logging", "matrix_logging", "batch", "size"], required=False, default=50),
+                queue_size=self._get_cfg(
+                    ["logging", "matrix_logging", "batch", "queue_size"], required=False, default=500,
+                ),
+            )
+            self.matrix_logging_handler.setFormatter(formatter)
+            if not check_only:
+                logger.addHandler(self.matrix_logging_handler)
+        elif matrix_logging_enabled:
             if not self.user_token:
                 logger.warning("Not setting up Matrix logging - requires user access token to be set")
             else:
                 self.matrix_logging_room = self._get_cfg(["logging", "matrix_logging", "room"], required=True)
-                handler = matrix.Handler(
-                    homeserver_url=self.homeserver_url,
-                    access_token=self.user_token,
-                    room_id=self.matrix_logging_room,
-                )
-                handler.setFormatter(formatter)
-                logger.addHandler(handler)
+                if not check_only:
+                    # Imported here so that validating the config does not need the Matrix dependencies
+                    # noinspection PyPackageRequirements
+                    from aiolog import matrix
+
+                    handler = matrix.Handler(
+                        homeserver_url=self.homeserver_url,
+                        access_token=self.user_token,
+                        room_id=self.matrix_logging_room,
+                    )
+                    handler.setFormatter(formatter)
+                    logger.addHandler(handler)
 
         # Middleman specific config
         self.management_room = self._get_cfg(["middleman", "management_room"], required=True)
         self.management_room_id = self.management_room if self.management_room.startswith("!") else None
-        self.anonymise_senders = self._get_cfg(["middleman", "anonymise_senders"], required=False, default=False)
-        self.welcome_message = self._get_cfg(["middleman", "welcome_message"], required=False)
-        self.mention_only_rooms = self._get_cfg(["middleman", "mention_only_rooms"], required=False, default=[])
-        self.mention_only_always_for_named = self._get_cfg(
-            ["middleman", "mention_only_always_for_named"], required=False, default=False,
+        self.shutdown_timeout = self._get_cfg(["middleman", "shutdown_timeout"], required=False, default=10)
+        self.outbox_enabled = self._get_cfg(["middleman", "outbox", "enabled"], required=False, default=False)
+        self.outbox_rate = self._get_cfg(["middleman", "outbox", "rate"], required=False, default=5)
+        self.outbox_max_attempts = self._get_cfg(["middleman", "outbox", "max_attempts"], required=False, default=10)
+        if self.outbox_rate <= 0:
+            raise ConfigError("middleman.outbox.rate must be greater than zero")
+        self.search_enabled = self._get_cfg(["middleman", "search", "enabled"], required=False, default=False)
+        self.search_retention_days = self._get_cfg(
+            ["middleman", "search", "retention_days"], required=False, default=0,
+        )
+        if self.search_retention_days < 0:
+            raise ConfigError("middleman.search.retention_days must not be negative")
+        self.inbound_queue_enabled = self._get_cfg(
+            ["middleman", "inbound_queue", "enabled"], required=False, default=False,
         )
-        self.confirm_reaction = self._get_cfg(["middleman", "confirm_reaction", "enabled"], required=False, default=False)
-        self.confirm_reaction_success = self._get_cfg(["middleman", "confirm_reaction", "success"], required=False, default="✔️")
-        self.confirm_reaction_fail = self._get_cfg(["middleman", "confirm_reaction", "fail"], required=False, default="❗")
-        self.relay_management_media = self._get_cfg(["middleman", "relay_management_media"], required=False, default=False)
+        self.inbound_queue_capacity = self._get_cfg(
+            ["middleman", "inbound_queue", "capacity"], required=False, default=1000,
+        )
+        self.inbound_queue_shed_named = self._get_cfg(
+            ["middleman", "inbound_queue", "shed_named_rooms"], required=False, default=False,
+        )
+        if self.inbound_queue_capacity <= 0:
+            raise ConfigError("middleman.inbound_queue.capacity must be greater than zero")
+        self._apply(self._get_reloadable_options())
+
+    def _get_log_level(self) -> str:
+        """Get the log level, validated so that setting it can not fail
+
+        Raises:
+            ConfigError: If the level is not a known log level
+        """
+        log_level = self._get_cfg(["logging", "level"], default="INFO")
+        if not isinstance(log_level, str) or not isinstance(logging.getLevelName(log_level), int):
+            raise ConfigError(f"logging.level '{log_level}' is not a valid log level")
+        return log_level
+
+    def _get_reloadable_options(self) -> dict:
+        """Read and validate the options that can be changed without restarting or reconnecting
+
+        All options are validated before any of them is applied, so that an invalid option
+        can not leave the config partly reloaded.
+
+        Raises:
+            ConfigError: If any of the options is invalid
+        """
+        mention_only_rooms = self._get_cfg(["middleman", "mention_only_rooms"], required=False, default=[])
+        if not isinstance(mention_only_rooms, list) or not all(isinstance(room, str) for room in mention_only_rooms):
+            raise ConfigError("middleman.mention_only_rooms must be a list of room IDs and aliases")
+        welcome_message = self._get_cfg(["middleman", "welcome_message"], required=False)
+        if welcome_message is not None and not isinstance(welcome_message, str):
+            raise ConfigError("middleman.welcome_message must be a string")
+
+        return {
+            "anonymise_senders": self._get_bool(["middleman", "anonymise_senders"], default=False),
+            "welcome_message": welcome_message,
+            # A set for fast lookups of room IDs and aliases
+            "mention_only_rooms": set(mention_only_rooms),
+            "mention_only_always_for_named": self._get_bool(
+                ["middleman", "mention_only_always_for_named"], default=False,
+            ),
+            "confirm_reaction": self._get_bool(["middleman", "confirm_reaction", "enabled"], default=False),
+            "confirm_reaction_success": self._get_string(["middleman", "confirm_reaction", "success"], default="✔️"),
+            "confirm_reaction_fail": self._get_string(["middleman", "confirm_reaction", "fail"], default="❗"),
+            "relay_management_media": self._get_bool(["middleman", "relay_management_media"], default=False),
+            "media_relay_caption": self._get_bool(["middleman", "media_relay_caption"], default=False),
+            "coalesce_window": self._get_number(["middleman", "coalesce_window"], default=0, minimum=0),
+            "broadcast_concurrency": self._get_number(
+                ["middleman", "broadcast", "concurrency"], default=5, minimum=1, integer=True,
+            ),
+            "digest_enabled": self._get_bool(["middleman", "digest", "enabled"], default=False),
+            "digest_interval": self._get_number(["middleman", "digest", "interval"], default=3600, minimum=1),
+            "digest_samples": self._get_number(["middleman", "digest", "samples"], default=5, minimum=1, integer=True),
+            "flood_enabled": self._get_bool(["middleman", "flood_protection", "enabled"], default=False),
+            "flood_room_rate": self._get_number(
+                ["middleman", "flood_protection", "room", "per_minute"], default=30, minimum=0, positive=True,
+            ),
+            "flood_room_burst": self._get_number(
+                ["middleman", "flood_protection", "room", "burst"], default=20, minimum=1, integer=True,
+            ),
+            "flood_sender_rate": self._get_number(
+                ["middleman", "flood_protection", "sender", "per_minute"], default=10, minimum=0, positive=True,
+            ),
+            "flood_sender_burst": self._get_number(
+                ["middleman", "flood_protection", "sender", "burst"], default=10, minimum=1, integer=True,
+            ),
+            "flood_notice_interval": self._get_number(
+                ["middleman", "flood_protection", "notice_interval"], default=300, minimum=1,
+            ),
+            "flood_max_buckets": self._get_number(
+                ["middleman", "flood_protection", "max_buckets"], default=10000, minimum=1, integer=True,
+            ),
+            "log_level": self._get_log_level(),
+        }
+
+    def _get_bool(self, path: List[str], default: bool) -> bool:
+        """Get an optional option that must be true or false
+
+        Raises:
+            ConfigError: If the option is not a boolean
+        """
+        value = self._get_cfg(path, required=False, default=default)
+        if not isinstance(value, bool):
+            raise ConfigError(f"{'.'.join(path)} must be true or false")
+        return value
+
+    def _get_string(self, path: List[str], default: str) -> str:
+        """Get an optional option that must be a non-empty string
+
+        Raises:
+            ConfigError: If the option is not a non-empty string
+        """
+        value = self._get_cfg(path, required=False, default=default)
+        if not isinstance(value, str) or not value:
+            raise ConfigError(f"{'.'.join(path)} must be a non-empty string")
+        return value
+
+    def _get_number(
+        self, path: List[str], default: float, minimum: float, integer: bool = False, positive: bool = False,
+    ) -> float:
+        """Get an optional numeric option within range
+
+        Args:
+            path (List[str]): Path to the option
+
+            default (float): Value if the option is not set
+
+            minimum (float): Smallest allowed value
+
+            integer (bool): Whether the value must be a whole number
+
+            positive (bool): Whether the value must also be greater than zero
+
+        Raises:
+            ConfigError: If the option is not a number in range
+        """
+        value = self._get_cfg(path, required=False, default=default)
+        kind = "a whole number" if integer else "a number"
+        if isinstance(value, bool) or not isinstance(value, int if integer else (int, float)):
+            raise ConfigError(f"{'.'.join(path)} must be {kind}")
+        if value < minimum or (positive and value <= 0):
+            limit = "greater than zero" if positive else f"at least {minimum}"
+            raise ConfigError(f"{'.'.join(path)} must be {limit}")
+        return value
+
+    def _apply(self, options: dict):
+        for name, value in options.items():
+            setattr(self, name, value)
+        logger.setLevel(self.log_level)
+
+    def reload(self):
+        """Reload the options that can be changed without restarting from the config file
+
+        Connection, storage and logging output options are not reloaded. The new options
+        are swapped in all at once, so events being processed see either the old or the
+        new options. If the file is invalid, the current options are kept.
+
+        Raises:
+            ConfigError: If the config file is missing, can not be read or is invalid
+        """
+        if not os.path.isfile(self.filepath):
+            raise ConfigError(f"Config file '{self.filepath}' does not exist")
+        new_config = self._read_file()
+
+        current_config, self.config = self.config, new_config
+        try:
+            options = self._get_reloadable_options()
+        except ConfigError:
+            self.config = current_config
+            raise
+        self._apply(options)
+        logger.info("Config reloaded from %s", self.filepath)
+
+    def _read_file(self) -> dict:
+        """Read and parse the config file
+
+        Raises:
+            ConfigError: If the file is not valid YAML or is not a mapping of options
+        """
+        try:
+            with open(self.filepath) as file_stream:
+                config = yaml.safe_load(file_stream.read())
+        except (OSError, UnicodeDecodeError) as ex:
+            raise ConfigError(f"Config file '{self.filepath}' could not be read: {ex}")
+        except yaml.YAMLError as ex:
+            raise ConfigError(f"Config file '{self.filepath}' is not valid YAML: {ex}")
+        if not isinstance(config, dict):
+            raise ConfigError(f"Config file '{self.filepath}' must contain a mapping of options")
+        return config
 
     def _get_cfg(
         self, path: List[str], default: Any = None, required: bool = True,
@@ -150,7 +388,9 @@ class Config(object):
         """
         # Shift through the config until we reach our option
         config = self.config
-        for name in path:
+        for depth, name in enumerate(path):
+            if not isinstance(config, dict):
+                raise ConfigError(f"Config option {'.'.join(path[:depth])} must be a mapping of options")
             config = config.get(name)
 
             # If at any point we don't get our expected option...
@@ -0,0 +1,161 @@
+import asyncio
+import logging
+from collections import Counter, deque
+from typing import Dict, List, Tuple
+
+# noinspection PyPackageRequirements
+from nio import RoomSendResponse
+
+from middleman.chat_functions import send_text_to_room
+
+logger = logging.getLogger(__name__)
+
+# Maximum length of a sample line included in a digest
+SAMPLE_MAX_LENGTH = 200
+# How many top senders to list in a digest
+TOP_SENDERS_COUNT = 5
+# Maximum length of one digest message. The text is sent both as is and converted to HTML,
+# and encryption grows the event further, so this is well below the Matrix event size limit.
+MAX_MESSAGE_LENGTH = 12000
+# Separator between the summaries of rooms in a digest message
+SUMMARY_SEPARATOR = "\n\n---\n\n"
+
+
+class RoomDigest(object):
+    def __init__(self, room_id: str, room_name: str, samples: int):
+        """Counters and recent messages of one room since the last digest
+
+        Args:
+            room_id (str): The room ID
+
+            room_name (str): The room display name, updated as messages come in
+
+            samples (int): How many of the latest messages to keep
+        """
+        self.room_id = room_id
+        self.room_name = room_name
+        self.count = 0
+        self.senders = Counter()
+        self.samples = deque(maxlen=samples)
+
+    def record(self, sender: str, text: str):
+        self.count += 1
+        self.senders[sender] += 1
+        if self.samples.maxlen:
+            if len(text) > SAMPLE_MAX_LENGTH:
+                text = text[:SAMPLE_MAX_LENGTH] + "…"
+            self.samples.append((sender, text))
+
+    def merge(self, newer: "RoomDigest"):
+        """Add the counters and messages of a digest of the same room recorded after this one"""
+        self.room_name = newer.room_name
+        self.count += newer.count
+        self.senders.update(newer.senders)
+        self.samples.extend(newer.samples)
+
+    def summary(self, anonymise_senders: bool) -> str:
+        lines = [
+            f"Digest for {self.room_name} (`{self.room_id}`): {self.count} messages not relayed since "
+            f"the last digest.",
+        ]
+        if not anonymise_senders:
+            top_senders = ", ".join(
+                f"{sender} ({count})" for sender, count in self.senders.most_common(TOP_SENDERS_COUNT)
+            )
+            lines.append(f"Top senders: {top_senders}")
+        if self.samples:
+            lines.append("")
+            lines.append("Latest messages:")
+            for sender, text in self.samples:
+                text = text.replace("\n", " ")
+                lines.append(f"> {text}" if anonymise_senders else f"> {sender}: {text}")
+                lines.append("")
+        return "\n".join(lines).strip()
+
+
+class Digest(object):
+    def __init__(self, config):
+        """Collects messages that were not relayed from mention only rooms and posts periodic summaries
+
+        Args:
+            config (Config): Bot configuration parameters
+        """
+        self.config = config
+        self.rooms: Dict[str, RoomDigest] = {}
+
+    @property
+    def enabled(self) -> bool:
+        return self.config.digest_enabled
+
+    def record(self, room_id: str, room_name: str, sender: str, text: str):
+        """Count a message that was not relayed."""
+        room_digest = self.rooms.get(room_id)
+        if not room_digest:
+            room_digest = self.rooms[room_id] = RoomDigest(room_id, room_name, self.config.digest_samples)
+        room_digest.room_name = room_name
+        room_digest.record(sender, text)
+
+    def pop_rooms(self) -> List[RoomDigest]:
+        """Get the digests of all rooms with messages since the last digest and reset the counters."""
+        rooms, self.rooms = self.rooms, {}
+        return list(rooms.values())
+
+    def restore(self, room_digests: List[RoomDigest]):
+        """Put back digests that could not be posted, merging in what has been recorded since."""
+        for room_digest in room_digests:
+            newer = self.rooms.get(room_digest.room_id)
+            if newer:
+                room_digest.merge(newer)
+            self.rooms[room_digest.room_id] = room_digest
+
+    def get_messages(self, room_digests: List[RoomDigest]) -> List[Tuple[str, List[RoomDigest]]]:
+        """Group the summaries of rooms into as few messages of at most `MAX_MESSAGE_LENGTH` as possible
+
+        Returns:
+            Tuples of the message text and the digests of the rooms summarised in it
+        """
+        messages = []
+        summaries = []
+        rooms = []
+        length = 0
+        for room_digest in room_digests:
+            summary = room_digest.summary(self.config.anonymise_senders)
+            if len(summary) > MAX_MESSAGE_LENGTH:
+                summary = summary[:MAX_MESSAGE_LENGTH] + "\n(truncated)"
+            if summaries and length + len(SUMMARY_SEPARATOR) + len(summary) > MAX_MESSAGE_LENGTH:
+                messages.append((SUMMARY_SEPARATOR.join(summaries), rooms))
+                summaries = []
+                rooms = []
+                length = 0
+            length += len(summary) + (len(SUMMARY_SEPARATOR) if summaries else 0)
+            summaries.append(summary)
+            rooms.append(room_digest)
+        if summaries:
+            messages.append((SUMMARY_SEPARATOR.join(summaries), rooms))
+        return messages
+
+    async def post(self, client):
+        """Post the digest of all rooms with messages since the last digest
+
+        The rooms are summarised in as few messages as fit. If a message can not be sent, the
+        rooms of it and of the messages after it are kept for the next digest.
+        """
+        messages = self.get_messages(self.pop_rooms())
+        for index, (text, _rooms) in enumerate(messages):
+            try:
+                response = await send_text_to_room(client, self.config.management_room, text)
+            except Exception as ex:
+                response = ex
+            if not isinstance(response, RoomSendResponse):
+                logger.warning("Failed to post the digest, keeping it for the next one: %s", response)
+                self.restore([room_digest for _text, rooms in messages[index:] for room_digest in rooms])
+                return
+
+    async def run(self, client):
+        """Post the digest to the management room periodically."""
+        while True:
+            await asyncio.sleep(self.config.digest_interval)
+            try:
+                await self.post(client)
+            except Exception as ex:
+                logger.warning("Failed to post the digest: %s", ex)
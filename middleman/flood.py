@@ -0,0 +1,151 @@
+import asyncio
+import logging
+import time
+from collections import Counter, OrderedDict
+from typing import Tuple
+
+from middleman.chat_functions import send_text_to_room
+
+logger = logging.getLogger(__name__)
+
+# How many senders and rooms to list in a flood protection notice
+FLOOD_NOTICE_TOP_COUNT = 5
+# How many senders and rooms to count held back messages of between notices
+FLOOD_MAX_COUNTED = 1000
+
+
+class TokenBucket(object):
+    def __init__(self, capacity: float, now: float):
+        """Allows bursts of up to `capacity` messages, refilled at a steady rate
+
+        Args:
+            capacity (float): Maximum amount of tokens, ie messages allowed in a burst
+
+            now (float): The current monotonic time
+        """
+        self.tokens = capacity
+        self.updated = now
+
+    def refill(self, capacity: float, rate: float, now: float):
+        self.tokens = min(capacity, self.tokens + (now - self.updated) * rate)
+        self.updated = now
+
+    def is_full(self, capacity: float, rate: float, now: float) -> bool:
+        return self.tokens + (now - self.updated) * rate >= capacity
+
+
+class FloodGuard(object):
+    def __init__(self, config):
+        """Limits the rate of messages relayed per source room and per sender
+
+        Each room and each sender has a token bucket. A message is relayed only if both its
+        room and its sender have a token left, otherwise it is counted, and the counts are
+        posted to the management room as one notice every `config.flood_notice_interval`
+        seconds.
+
+        Buckets are kept in least recently used order. A bucket that has refilled completely
+        is the same as a new one, so idle buckets are evicted from the front as new ones are
+        added, and at most `config.flood_max_buckets` are kept. Held back messages are counted
+        per room and per sender for the first `FLOOD_MAX_COUNTED` rooms and senders between
+        notices, and in total for all of them.
+
+        Args:
+            config (Config): Bot configuration parameters
+        """
+        self.config = config
+        # (kind, room ID or sender) -> bucket, least recently used first
+        self.buckets = OrderedDict()
+        self.held_rooms = Counter()
+        self.held_senders = Counter()
+        self.held_total = 0
+        self.room_names = {}
+
+    @property
+    def enabled(self) -> bool:
+        return self.config.flood_enabled
+
+    def _get_bucket(self, key: Tuple[str, str], capacity: float, rate: float, now: float) -> TokenBucket:
+        bucket = self.buckets.get(key)
+        if bucket:
+            self.buckets.move_to_end(key)
+            bucket.refill(capacity, rate, now)
+            return bucket
+
+        self._evict(now)
+        bucket = self.buckets[key] = TokenBucket(capacity, now)
+        return bucket
+
+    def _evict(self, now: float):
+        while self.buckets:
+            key, bucket = next(iter(self.buckets.items()))
+            if len(self.buckets) < self.config.flood_max_buckets and not self._is_idle(key, bucket, now):
+                break
+            self.buckets.popitem(last=False)
+
+    def _is_idle(self, key: Tuple[str, str], bucket: TokenBucket, now: float) -> bool:
+        if key[0] == "room":
+            return bucket.is_full(self.config.flood_room_burst, self.config.flood_room_rate / 60, now)
+        return bucket.is_full(self.config.flood_sender_burst, self.config.flood_sender_rate / 60, now)
+
+    def allow(self, room_id: str, room_name: str, sender: str) -> bool:
+        """Check whether a message may be relayed, counting it if not
+
+        Tokens are only taken when both the room and the sender have one left.
+        """
+        now = time.monotonic()
+        room_bucket = self._get_bucket(
+            ("room", room_id), self.config.flood_room_burst, self.config.flood_room_rate / 60, now,
+        )
+        sender_bucket = self._get_bucket(
+            ("sender", sender), self.config.flood_sender_burst, self.config.flood_sender_rate / 60, now,
+        )
+        if room_bucket.tokens >= 1 and sender_bucket.tokens >= 1:
+            room_bucket.tokens -= 1
+            sender_bucket.tokens -= 1
+            return True
+
+        self.held_total += 1
+        if room_id in self.held_rooms or len(self.held_rooms) < FLOOD_MAX_COUNTED:
+            self.held_rooms[room_id] += 1
+            self.room_names[room_id] = room_name
+        if sender in self.held_senders or len(self.held_senders) < FLOOD_MAX_COUNTED:
+            self.held_senders[sender] += 1
+        return False
+
+    def pop_notice(self) -> str:
+        """Get the notice of the messages held back since the last notice and reset the counters"""
+        held_rooms, self.held_rooms = self.held_rooms, Counter()
+        held_senders, self.held_senders = self.held_senders, Counter()
+        held_total, self.held_total = self.held_total, 0
+        room_names, self.room_names = self.room_names, {}
+        if not held_total:
+            return ""
+
+        lines = [f"Flood protection held back {held_total} messages since the last notice."]
+        if not self.config.anonymise_senders:
+            rooms = ", ".join(
+                f"{room_names[room_id]} (`{room_id}`): {count}"
+                for room_id, count in held_rooms.most_common(FLOOD_NOTICE_TOP_COUNT)
+            )
+            senders = ", ".join(
+                f"{sender}: {count}" for sender, count in held_senders.most_common(FLOOD_NOTICE_TOP_COUNT)
+            )
+            if held_total > sum(held_rooms.values()):
+                rooms += f", {held_total - sum(held_rooms.values())} more not counted per room"
+            if held_total > sum(held_senders.values()):
+                senders += f", {held_total - sum(held_senders.values())} more not counted per sender"
+            lines.append(f"Rooms: {rooms}")
+            lines.append(f"Senders: {senders}")
+        return "  \n".join(lines)
+
+    async def run(self, client):
+        """Post the flood protection notice to the management room periodically"""
+        while True:
+            await asyncio.sleep(self.config.flood_notice_interval)
+            try:
+                notice = self.pop_notice()
+                if notice:
+                    logger.warning("%s", notice)
+                    await send_text_to_room(client, self.config.management_room, notice)
+            except Exception as ex:
+                logger.warning("Failed to post the flood protection notice: %s", ex)
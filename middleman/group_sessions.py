@@ -0,0 +1,77 @@
+import asyncio
+import datetime
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+# Seconds between checks that the management room group session is shared
+SHARE_CHECK_INTERVAL = 60
+# Rotate the group session this many messages before it would otherwise rotate
+ROTATION_MESSAGE_MARGIN = 10
+# Rotate the group session this long before it would otherwise rotate
+ROTATION_AGE_MARGIN = datetime.timedelta(hours=1)
+
+
+class GroupSessionSharer(object):
+    def __init__(self, client, config):
+        """Keeps the management room outbound group session shared ahead of relays
+
+        When the management room has no shared outbound group session, the next relay has
+        to claim keys and share a new session with every member device before it can be
+        sent. This shares the session in the background instead: on startup, when the room
+        membership or the device lists of users change, periodically, and shortly before
+        the session would be rotated.
+
+        Args:
+            client (nio.AsyncClient): nio client used to interact with matrix
+
+            config (Config): Bot configuration parameters
+        """
+        self.client = client
+        self.config = config
+        self.wakeup = asyncio.Event()
+
+    def request_share(self):
+        """Check the session is shared as soon as possible"""
+        self.wakeup.set()
+
+    def _rotate_if_due(self, room_id: str):
+        session = self.client.olm.outbound_group_sessions.get(room_id)
+        if not session:
+            return
+        age = datetime.datetime.now() - session.creation_time
+        if (
+            session.message_count >= session.max_messages - ROTATION_MESSAGE_MARGIN
+            or age >= session.max_age - ROTATION_AGE_MARGIN
+        ):
+            logger.info("Rotating the group session of room %s ahead of time", room_id)
+            self.client.olm.outbound_group_sessions.pop(room_id, None)
+
+    async def share(self):
+        room_id = self.config.management_room_id
+        room = self.client.rooms.get(room_id)
+        if not room or not room.encrypted or not self.client.olm:
+            return
+
+        self._rotate_if_due(room_id)
+        if self.client.should_query_keys:
+            await self.client.keys_query()
+        if not self.client.olm.should_share_group_session(room_id):
+            return
+
+        started = time.monotonic()
+        await self.client.share_group_session(room_id, ignore_unverified_devices=True)
+        logger.info("Shared the group session of room %s in %.2fs", room_id, time.monotonic() - started)
+
+    async def run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout=SHARE_CHECK_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            self.wakeup.clear()
+            try:
+                await self.share()
+            except Exception as ex:
+                logger.warning("Failed to share the management room group session: %s", ex)
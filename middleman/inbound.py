@@ -0,0 +1,128 @@
+import asyncio
+import logging
+from collections import Counter, deque
+from typing import Awaitable, Callable
+
+logger = logging.getLogger(__name__)
+
+# Priorities of inbound events, processed in this order
+PRIORITY_MANAGEMENT = 0
+PRIORITY_DIRECT = 1
+PRIORITY_NAMED = 2
+PRIORITY_UNMENTIONED = 3
+PRIORITY_NAMES = ["management", "direct", "named", "unmentioned"]
+
+# Seconds between reports of the queue depth and shed events
+INBOUND_REPORT_INTERVAL = 60
+
+
+class InboundQueue(object):
+    def __init__(self, config):
+        """Bounded priority queue of inbound room events
+
+        Events are processed by priority: management room messages first, then direct
+        messages, then messages in named rooms, then messages in mention only rooms that
+        don't mention the bot. Events of the same priority are processed in arrival order.
+
+        When the queue is full, an event that may be shed is dropped, starting from the lowest
+        priority queued, or the new event itself if nothing of lower priority is queued. Only
+        messages that don't mention the bot may be shed, or also named room messages with
+        `config.inbound_queue_shed_named`. An event that may not be shed waits for room in the
+        queue, which holds up the sync until the backlog shrinks.
+
+        Queued events are only kept in memory. The sync token advances as soon as they are
+        queued, so events still queued when the bot crashes, is restarted or reaches the
+        shutdown timeout are lost.
+
+        Args:
+            config (Config): Bot configuration parameters
+        """
+        self.config = config
+        self.levels = [deque() for _ in PRIORITY_NAMES]
+        self.size = 0
+        # Events waiting for room in the queue
+        self.waiting = 0
+        self.condition = asyncio.Condition()
+        # Shed events since the last report, by priority
+        self.shed = Counter()
+        self.shed_total = 0
+        self.processed = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.config.inbound_queue_enabled
+
+    @property
+    def shed_from(self) -> int:
+        return PRIORITY_NAMED if self.config.inbound_queue_shed_named else PRIORITY_UNMENTIONED
+
+    def get_stats(self) -> dict:
+        return {
+            "depth": {name: len(level) for name, level in zip(PRIORITY_NAMES, self.levels)},
+            "shed": {PRIORITY_NAMES[priority]: count for priority, count in self.shed.items()},
+            "shed_total": self.shed_total,
+            "processed": self.processed,
+        }
+
+    def _lowest_queued_priority(self) -> int:
+        for priority in range(len(self.levels) - 1, -1, -1):
+            if self.levels[priority]:
+                return priority
+
+    async def put(self, priority: int, callback: Callable[..., Awaitable], *args) -> bool:
+        """Queue an event to be processed, waiting for room if it may not be shed
+
+        Returns:
+            False if the event was shed
+        """
+        async with self.condition:
+            while self.size >= self.config.inbound_queue_capacity:
+                lowest = self._lowest_queued_priority()
+                if lowest >= self.shed_from and lowest > priority:
+                    self.levels[lowest].popleft()
+                    self.size -= 1
+                    self.shed[lowest] += 1
+                    self.shed_total += 1
+                elif priority >= self.shed_from:
+                    self.shed[priority] += 1
+                    self.shed_total += 1
+                    return False
+                else:
+                    self.waiting += 1
+                    try:
+                        await self.condition.wait()
+                    finally:
+                        self.waiting -= 1
+            self.levels[priority].append((callback, args))
+            self.size += 1
+            self.condition.notify_all()
+        return True
+
+    async def get(self):
+        async with self.condition:
+            while not self.size:
+                await self.condition.wait()
+            for level in self.levels:
+                if level:
+                    self.size -= 1
+                    self.condition.notify_all()
+                    return level.popleft()
+
+    async def run(self):
+        """Process queued events one at a time"""
+        while True:
+            callback, args = await self.get()
+            try:
+                await callback(*args)
+            except Exception as ex:
+                logger.exception("Failed to process inbound event: %s", ex)
+            self.processed += 1
+
+    async def report(self):
+        """Log the queue depth and the amount of shed events periodically, while there is a backlog"""
+        while True:
+            await asyncio.sleep(INBOUND_REPORT_INTERVAL)
+            if self.size or self.shed:
+                log_func = logger.warning if self.shed else logger.info
+                log_func("Inbound queue: %s", self.get_stats())
+                self.shed.clear()
@@ -0,0 +1,160 @@
+import asyncio
+import logging
+import time
+from typing import Dict
+
+# noinspection PyPackageRequirements
+from nio import LocalProtocolError, MegolmEvent, RoomKeyRequestError, RoomKeyRequestResponse
+
+from middleman.storage import KeyRequest
+from middleman.utils import restore_megolm_event
+
+logger = logging.getLogger(__name__)
+
+# Seconds to wait for a key before requesting it again, doubled for each request
+KEY_REQUEST_BACKOFF = 60
+# How many times to request a key before giving up
+KEY_REQUEST_MAX_ATTEMPTS = 5
+# Seconds between checks for key requests due to be sent again
+KEY_REQUEST_CHECK_INTERVAL = 30
+# Seconds between deletions of finished key requests from the database
+KEY_REQUEST_PRUNE_INTERVAL = 3600
+
+
+class KeyRequestManager(object):
+    def __init__(self, client, store):
+        """Requests room keys for events that failed to decrypt, once per session
+
+        A key is requested once per megolm session, however many events of the session
+        fail to decrypt. If the key does not arrive, it is requested again with exponential
+        backoff until the request expires after `KEY_REQUEST_MAX_ATTEMPTS` requests.
+        Outstanding requests are stored in the database, so they survive restarts. Finished
+        requests are deleted from the database periodically.
+
+        Args:
+            client (nio.AsyncClient): nio client used to interact with matrix
+
+            store (Storage): Bot storage
+        """
+        self.client = client
+        self.store = store
+        self.pending: Dict[str, KeyRequest] = {
+            request.session_id: request for request in store.get_pending_key_requests()
+        }
+        self.requests_sent = 0
+        self.requests_fulfilled = 0
+        self.requests_expired = 0
+
+    def get_stats(self) -> dict:
+        return {
+            "pending": len(self.pending),
+            "sent": self.requests_sent,
+            "fulfilled": self.requests_fulfilled,
+            "expired": self.requests_expired,
+        }
+
+    def _save(self, request: KeyRequest, status: str = "pending"):
+        self.store.save_key_request(
+            request.session_id, request.room_id, request.user_id, request.attempts, request.next_attempt, status,
+        )
+
+    async def request(self, event: MegolmEvent) -> bool:
+        """Request the key for an event that failed to decrypt
+
+        Returns:
+            True if this is the first request for the session of the event, False if the
+            key has already been requested
+        """
+        if event.session_id in self.pending:
+            logger.debug("Key for session %s has already been requested", event.session_id)
+            return False
+
+        request = KeyRequest(event.session_id, event.room_id, event.sender, 0, 0)
+        self.pending[event.session_id] = await self._send(request, event)
+        return True
+
+    async def _send(self, request: KeyRequest, event: MegolmEvent) -> KeyRequest:
+        attempts = request.attempts + 1
+        request = request._replace(
+            attempts=attempts,
+            next_attempt=time.time() + KEY_REQUEST_BACKOFF * 2 ** (attempts - 1),
+        )
+        self._save(request)
+
+        response = None
+        try:
+            if attempts > 1:
+                # Forget the previous request so that the client allows requesting again
+                await self.client.cancel_key_share(event)
+            response = await self.client.request_room_key(event)
+        except LocalProtocolError as ex:
+            logger.warning("Failed to request room key for session %s: %s", request.session_id, ex)
+        if isinstance(response, RoomKeyRequestResponse):
+            self.requests_sent += 1
+            logger.info("Requested key for session %s (attempt %s)", request.session_id, attempts)
+        elif isinstance(response, RoomKeyRequestError):
+            logger.warning("RoomKeyRequestError: %s (%s)", response.message, response.status_code)
+        elif response is not None:
+            logger.warning("Unexpected response to key request for session %s: %s", request.session_id, response)
+        return request
+
+    def fulfilled(self, session_id: str):
+        """Mark the request for a session done when its key arrives"""
+        request = self.pending.pop(session_id, None)
+        if not request:
+            return
+        self._save(request, "fulfilled")
+        self.requests_fulfilled += 1
+        logger.info("Key request for session %s fulfilled. Key requests: %s", session_id, self.get_stats())
+
+    async def _retry_due(self):
+        now = time.time()
+        for request in list(self.pending.values()):
+            if request.next_attempt > now:
+                continue
+            if request.attempts >= KEY_REQUEST_MAX_ATTEMPTS:
+                del self.pending[request.session_id]
+                self._save(request, "expired")
+                self.requests_expired += 1
+                logger.warning(
+                    "Gave up requesting key for session %s after %s attempts. Key requests: %s",
+                    request.session_id, request.attempts, self.get_stats(),
+                )
+                continue
+
+            # Only one stored event is needed to request the key
+            stored_event = next(self.store.iter_encrypted_events(request.session_id), None)
+            if not stored_event:
+                # Nothing left to decrypt
+                del self.pending[request.session_id]
+                self._save(request, "fulfilled")
+                continue
+            try:
+                event = restore_megolm_event(stored_event.event)
+            except Exception as ex:
+                logger.warning("Failed to restore MegolmEvent for %s: %s", stored_event.event_id, ex)
+                del self.pending[request.session_id]
+                self._save(request, "expired")
+                self.requests_expired += 1
+                continue
+            self.pending[request.session_id] = await self._send(request, event)
+
+    async def run(self):
+        """Request keys again for requests that have not been fulfilled in time, and delete
+        finished requests periodically"""
+        last_pruned = time.monotonic()
+        while True:
+            await asyncio.sleep(KEY_REQUEST_CHECK_INTERVAL)
+            try:
+                await self._retry_due()
+            except Exception as ex:
+                logger.warning("Failed to retry key requests: %s", ex)
+            if time.monotonic() - last_pruned < KEY_REQUEST_PRUNE_INTERVAL:
+                continue
+            last_pruned = time.monotonic()
+            try:
+                pruned = self.store.prune_key_requests()
+                if pruned:
+                    logger.info("Deleted %s finished key requests", pruned)
+            except Exception as ex:
+                logger.warning("Failed to delete finished key requests: %s", ex)
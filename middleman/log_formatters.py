@@ -0,0 +1,18 @@
+import logging
+
+from middleman.serialisation import dumps
+
+
+class JsonFormatter(logging.Formatter):
+    """Formats log records as one JSON object per line, for log collectors"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        data = {
+            "time": self.formatTime(record),
+            "logger": record.name,
+            "level": record.levelname,
+            "message": record.getMessage(),
+        }
+        if record.exc_info:
+            data["exception"] = self.formatException(record.exc_info)
+        return dumps(data)
@@ -1,5 +1,8 @@
 #!/usr/bin/env python3
+import asyncio
 import logging
+import signal
+import time
 from time import sleep
 
 # noinspection PyPackageRequirements
@@ -22,18 +25,76 @@ from nio import (
     RoomMessageText,
     RoomMessageMedia,
     RoomResolveAliasResponse,
+    SyncResponse,
 )
 
 from middleman.callbacks import Callbacks
 from middleman.config import Config
+from middleman.errors import ConfigError
 from middleman.storage import Storage
 
 logger = logging.getLogger(__name__)
 
 
+def reload_config(config: Config):
+    try:
+        config.reload()
+    except (ConfigError, OSError) as ex:
+        logger.error("Failed to reload config, keeping the current config: %s", ex)
+
+
+async def shutdown_gracefully(client: AsyncClient, callbacks: Callbacks, store: Storage, config: Config, sync):
+    """Stop syncing, finish processing the events already received, then close the database
+
+    The sync is stopped once no events of the sync batch being processed are being handed to
+    the callbacks, so no new events are received while draining. The callbacks in progress,
+    the queued inbound events, the outbox item being sent and the broadcasts in progress are
+    then finished, and the relayed messages still queued for the search index are written.
+    All of this takes at most `config.shutdown_timeout` seconds, after which the rest is
+    abandoned.
+
+    The sync token is saved by the client after each sync, so events not yet received
+    will be received on the next start. Events of the batch still waiting for room in the
+    inbound queue when the sync is stopped, and events still queued when the time is up,
+    are lost.
+    """
+    logger.info("Shutting down, finishing events already received...")
+    deadline = time.monotonic() + config.shutdown_timeout
+
+    # Stop syncing between batches
+    while callbacks.receiving and time.monotonic() < deadline:
+        await asyncio.sleep(0.1)
+    if callbacks.inbound.waiting:
+        logger.warning("Abandoned %s events waiting for room in the inbound queue", callbacks.inbound.waiting)
+    sync.cancel()
+    try:
+        await sync
+    except asyncio.CancelledError:
+        pass
+
+    callbacks.outbox.stop()
+    drained, abandoned = await callbacks.drain(max(deadline - time.monotonic(), 0))
+    if callbacks.broadcasts:
+        logger.warning("Abandoned %s broadcasts in progress", len(callbacks.broadcasts))
+
+    if config.matrix_logging_handler:
+        # Post any remaining log records
+        await config.matrix_logging_handler.flush(client)
+
+    # Index any relayed messages still queued
+    callbacks.search.flush()
+
+    if config.message_cache_size:
+        logger.info("Message cache: %s", store.get_message_cache_stats())
+    store.close()
+    logger.info("Shutdown complete, %s events in progress were finished and %s abandoned", drained, abandoned)
+
+
 async def main(config: Config):
+    started = time.monotonic()
+
     # Configure the database
-    store = Storage(config.database)
+    store = Storage(config.database, message_cache_size=config.message_cache_size)
 
     # Configuration options for the AsyncClient
     client_config = AsyncClientConfig(
@@ -59,17 +120,77 @@ async def main(config: Config):
     # Set up event callbacks
     callbacks = Callbacks(client, store, config)
     # noinspection PyTypeChecker
-    client.add_event_callback(callbacks.member, (RoomMemberEvent,))
+    client.add_event_callback(callbacks.received(callbacks.tracked(callbacks.member)), (RoomMemberEvent,))
+    # noinspection PyTypeChecker
+    client.add_event_callback(
+        callbacks.received(callbacks.queued(callbacks.tracked(callbacks.message))),
+        (RoomMessageText, RoomMessageNotice, RoomMessageFormatted),
+    )
     # noinspection PyTypeChecker
-    client.add_event_callback(callbacks.message, (RoomMessageText, RoomMessageNotice, RoomMessageFormatted))
+    client.add_event_callback(
+        callbacks.received(callbacks.queued(callbacks.tracked(callbacks.media))),
+        (RoomMessageMedia, RoomEncryptedMedia),
+    )
     # noinspection PyTypeChecker
-    client.add_event_callback(callbacks.media, (RoomMessageMedia, RoomEncryptedMedia))
+    client.add_event_callback(callbacks.received(callbacks.tracked(callbacks.invite)), (InviteMemberEvent,))
     # noinspection PyTypeChecker
-    client.add_event_callback(callbacks.invite, (InviteMemberEvent,))
+    client.add_event_callback(callbacks.received(callbacks.tracked(callbacks.decryption_failure)), (MegolmEvent,))
     # noinspection PyTypeChecker
-    client.add_event_callback(callbacks.decryption_failure, (MegolmEvent,))
+    client.add_to_device_callback(
+        callbacks.received(callbacks.tracked(callbacks.room_key)), (ForwardedRoomKeyEvent, RoomKeyEvent),
+    )
+
+    synced = False
+
+    async def on_sync(response: SyncResponse):
+        nonlocal synced
+        if not synced:
+            synced = True
+            logger.info("First sync completed %.1fs after startup", time.monotonic() - started)
+            callbacks.group_sessions.request_share()
+            if config.outbox_enabled:
+                # Only once the rooms are known, so that items left from before a restart can be sent
+                asyncio.ensure_future(callbacks.outbox.run())
+        elif response.device_list.changed:
+            # Share the group session with any new devices before the next relay needs it
+            callbacks.group_sessions.request_share()
+
     # noinspection PyTypeChecker
-    client.add_to_device_callback(callbacks.room_key, (ForwardedRoomKeyEvent, RoomKeyEvent))
+    client.add_response_callback(on_sync, (SyncResponse,))
+
+    asyncio.ensure_future(callbacks.group_sessions.run())
+    asyncio.ensure_future(callbacks.key_requests.run())
+
+    if config.message_cache_size:
+        asyncio.ensure_future(store.report_message_cache())
+
+    if config.database_maintenance_interval:
+        asyncio.ensure_future(store.run_maintenance(config.database_maintenance_interval))
+
+    if config.matrix_logging_handler:
+        asyncio.ensure_future(config.matrix_logging_handler.run(client))
+
+    if config.inbound_queue_enabled:
+        # One worker, so that the events of a room are processed in the order they were received
+        asyncio.ensure_future(callbacks.inbound.run())
+        asyncio.ensure_future(callbacks.inbound.report())
+
+    if config.search_enabled:
+        asyncio.ensure_future(callbacks.search.run())
+
+    # The digest is always scheduled, as it can be enabled by reloading the config
+    asyncio.ensure_future(callbacks.digest.run(client))
+    # Likewise flood protection
+    asyncio.ensure_future(callbacks.flood.run(client))
+
+    # Reload the config on SIGHUP
+    loop = asyncio.get_event_loop()
+    loop.add_signal_handler(signal.SIGHUP, reload_config, config)
+
+    # Shut down gracefully on SIGTERM (for example container stop) and SIGINT
+    shutdown = asyncio.Event()
+    loop.add_signal_handler(signal.SIGTERM, shutdown.set)
+    loop.add_signal_handler(signal.SIGINT, shutdown.set)
 
     # Keep trying to reconnect on failure (with some time in-between)
     while True:
@@ -130,7 +251,15 @@ async def main(config: Config):
                     logger.info(f"Logging room membership is good")
 
             logger.info(f"Logged in as {config.user_id}")
-            await client.sync_forever(timeout=30000, full_state=True)
+            sync = asyncio.ensure_future(client.sync_forever(timeout=30000, full_state=True))
+            shutdown_requested = asyncio.ensure_future(shutdown.wait())
+            await asyncio.wait({sync, shutdown_requested}, return_when=asyncio.FIRST_COMPLETED)
+            if shutdown.is_set():
+                await shutdown_gracefully(client, callbacks, store, config, sync)
+                break
+            shutdown_requested.cancel()
+            # Raise any error that stopped the sync
+            sync.result()
 
         except (ClientConnectionError, ServerDisconnectedError):
             logger.warning("Unable to connect to homeserver, retrying in 15s...")
@@ -0,0 +1,94 @@
+import asyncio
+import logging
+from collections import OrderedDict
+from typing import Optional
+
+# Maximum length of one batched log message, well below the Matrix event size limit
+MAX_MESSAGE_LENGTH = 30000
+
+
+class BufferedMatrixHandler(logging.Handler):
+    def __init__(self, room_id: str, interval: float, batch_size: int, queue_size: int):
+        """Logging handler that posts log records to a Matrix room in batches
+
+        Records are buffered and sent as one message per interval, or sooner when the
+        batch size is reached. Repeated identical records in a batch are collapsed into
+        one line with a count. When the buffer is full, further records are dropped and
+        only counted, so logging never blocks or grows memory without bound.
+
+        Args:
+            room_id (str): The room to post log records to
+
+            interval (float): Seconds between posting batches
+
+            batch_size (int): Amount of distinct records that triggers posting a batch early
+
+            queue_size (int): Maximum amount of distinct records to buffer
+        """
+        super().__init__()
+        self.room_id = room_id
+        self.interval = interval
+        self.batch_size = batch_size
+        self.queue_size = queue_size
+        # (logger name, level, message) -> [formatted record, count]
+        self.records = OrderedDict()
+        self.dropped = 0
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self.wakeup: Optional[asyncio.Event] = None
+
+    def emit(self, record: logging.LogRecord):
+        try:
+            key = (record.name, record.levelno, record.getMessage())
+            if key in self.records:
+                self.records[key][1] += 1
+                return
+            if len(self.records) >= self.queue_size:
+                self.dropped += 1
+                return
+            self.records[key] = [self.format(record), 1]
+            if len(self.records) >= self.batch_size and self.loop:
+                self.loop.call_soon_threadsafe(self.wakeup.set)
+        except Exception:
+            self.handleError(record)
+
+    def pop_batch(self) -> Optional[str]:
+        """Get the buffered records as one message and clear the buffer"""
+        self.acquire()
+        try:
+            records, self.records = self.records, OrderedDict()
+            dropped, self.dropped = self.dropped, 0
+        finally:
+            self.release()
+        if not records and not dropped:
+            return None
+
+        lines = []
+        for formatted, count in records.values():
+            lines.append(formatted if count == 1 else f"{formatted} (repeated {count} times)")
+        if dropped:
+            lines.append(f"{dropped} log records were dropped as the log buffer was full.")
+        text = "\n".join(lines)
+        if len(text) > MAX_MESSAGE_LENGTH:
+            text = text[:MAX_MESSAGE_LENGTH] + "\n(truncated)"
+        return text
+
+    async def flush(self, client):
+        """Post the buffered records to the room now"""
+        # Imported here so that the config, which sets up this handler, can be loaded without nio
+        from middleman.chat_functions import send_text_to_room
+
+        text = self.pop_batch()
+        if text:
+            await send_text_to_room(client, self.room_id, text, notice=True, markdown_convert=False)
+
+    async def run(self, client):
+        """Post the buffered records to the room periodically"""
+        self.loop = asyncio.get_running_loop()
+        self.wakeup = asyncio.Event()
+        while True:
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout=self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self.wakeup.clear()
+            await self.flush(client)
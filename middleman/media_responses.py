@@ -5,7 +5,7 @@ from typing import List
 from nio import RoomSendResponse, RoomSendError
 
 from middleman.chat_functions import send_media_to_room, send_reaction, send_text_to_room
-from middleman.utils import get_in_reply_to
+from middleman.utils import parse_relations
 
 logger = logging.getLogger(__name__)
 
@@ -18,7 +18,9 @@ media_name = {
 
 
 class Media(object):
-    def __init__(self, client, store, config, media_type, body, media_url, media_file, media_info, room, event):
+    def __init__(
+        self, client, store, config, media_type, body, media_url, media_file, media_info, room, event, flood=None,
+    ):
         """Initialize a new Media
 
         Args:
@@ -41,6 +43,8 @@ class Media(object):
             room (nio.rooms.MatrixRoom): The room the event came from
 
             event (nio.events.room_events.RoomMessageMedia): The event defining the media
+
+            flood (FloodGuard): Optional rate limiter of relays per room and sender
         """
         self.client = client
         self.store = store
@@ -52,9 +56,10 @@ class Media(object):
         self.media_url = media_url
         self.media_file = media_file
         self.media_info = media_info
+        self.flood = flood
 
     async def handle_management_room_media(self):
-        reply_to = get_in_reply_to(self.event)
+        reply_to = parse_relations(self.event).reply_to
 
         if reply_to and self.config.relay_management_media:
             # Send back to original sender
@@ -63,20 +68,20 @@ class Media(object):
                 # Relay back to original sender
                 response = await send_media_to_room(
                     self.client,
-                    message["room_id"],
+                    message.room_id,
                     self.media_type,
                     self.body,
                     self.media_url,
                     self.media_file,
                     self.media_info,
-                    reply_to_event_id=message["event_id"],
+                    reply_to_event_id=message.event_id,
                 )
                 if isinstance(response, RoomSendResponse):
                     # Store our outbound reply so we can reference it later
                     self.store.store_message(
                         event_id=response.event_id,
                         management_event_id=self.event.event_id,
-                        room_id=message["room_id"],
+                        room_id=message.room_id,
                     )
                     if self.config.confirm_reaction:
                         management_room_text = self.config.confirm_reaction_success
@@ -84,9 +89,9 @@ class Media(object):
                         management_room_text = f"{media_name[self.media_type]} delivered back to the sender."
                     else:
                         management_room_text = f"{media_name[self.media_type]} delivered back to the sender in " \
-                                               f"room {message['room_id']}."
+                                               f"room {message.room_id}."
                     logger.info(
-                        f"{media_name[self.media_type]} {self.event.event_id} relayed back to the original sender",
+                        "%s %s relayed back to the original sender", media_name[self.media_type], self.event.event_id,
                     )
                 else:
                     if self.config.confirm_reaction:
@@ -112,11 +117,11 @@ class Media(object):
                     )
             else:
                 logger.debug(
-                    f"Skipping {media_name[self.media_type]} {self.event.event_id} "
-                    f"which is not a reply to one of our relay messages",
+                    "Skipping %s %s which is not a reply to one of our relay messages",
+                    media_name[self.media_type], self.event.event_id,
                 )
         else:
-            logger.debug(f"Skipping {self.event.event_id} reply {media_name[self.media_type]}")
+            logger.debug("Skipping %s reply %s", self.event.event_id, media_name[self.media_type])
 
     def is_mention_only_room(self, identifiers: List[str], is_named: bool) -> bool:
         """
@@ -145,9 +150,21 @@ class Media(object):
         # First check if we want to relay this
         if self.is_mention_only_room([self.room.canonical_alias, self.room.room_id], self.room.is_named):
             # skip media in mention only rooms for now
-            logger.debug(f"Skipping {media_name[self.media_type]} %s in room %s as it's set to "
-                         f"only relay on mention and mentions are not supported for media ",
-                         self.event.event_id, self.room.room_id)
+            logger.debug("Skipping %s %s in room %s as it's set to only relay on mention and mentions are "
+                         "not supported for media ", media_name[self.media_type], self.event.event_id, self.room.room_id)
+            return
+
+        if self.flood and self.flood.enabled and not self.flood.allow(
+            self.room.room_id, self.room.display_name, self.event.sender,
+        ):
+            logger.debug(
+                "Holding back %s %s from %s in room %s due to flood protection",
+                media_name[self.media_type], self.event.event_id, self.event.sender, self.room.room_id,
+            )
+            return
+
+        if self.config.media_relay_caption:
+            await self.relay_as_caption()
             return
 
         if self.config.anonymise_senders:
@@ -174,10 +191,42 @@ class Media(object):
                     response.event_id,
                     self.room.room_id,
                 )
-                logger.info(f"{media_name[self.media_type]} %s relayed to the management room", self.event.event_id)
+                logger.info("%s %s relayed to the management room", media_name[self.media_type], self.event.event_id)
             else:
-                logger.error(f"Failed to relay {media_name[self.media_type]} %s to the "
-                             f"management room", self.event.event_id)
+                logger.error(
+                    "Failed to relay %s %s to the management room", media_name[self.media_type], self.event.event_id,
+                )
         else:
-            logger.error(f"Failed to relay {media_name[self.media_type]} %s to the "
-                         f"management room", self.event.event_id)
+            logger.error(
+                "Failed to relay %s %s to the management room", media_name[self.media_type], self.event.event_id,
+            )
+
+    async def relay_as_caption(self):
+        """Relay to the management room as one media event with the sender information as the caption."""
+        if self.config.anonymise_senders:
+            caption = f"anonymous sent {media_name[self.media_type]}"
+        else:
+            caption = f"{self.event.sender} in {self.room.display_name} (`{self.room.room_id}`) " \
+                      f"sent {media_name[self.media_type]} {self.body}"
+        response = await send_media_to_room(
+            self.client,
+            self.config.management_room,
+            self.media_type,
+            caption,
+            self.media_url,
+            self.media_file,
+            self.media_info,
+            filename=self.body,
+            markdown_convert=True,
+        )
+        if type(response) == RoomSendResponse and response.event_id:
+            self.store.store_message(
+                self.event.event_id,
+                response.event_id,
+                self.room.room_id,
+            )
+            logger.info("%s %s relayed to the management room", media_name[self.media_type], self.event.event_id)
+        else:
+            logger.error(
+                "Failed to relay %s %s to the management room", media_name[self.media_type], self.event.event_id,
+            )
@@ -4,14 +4,29 @@ from typing import List
 # noinspection PyPackageRequirements
 from nio import RoomSendResponse, RoomSendError
 
-from middleman.chat_functions import send_reaction, send_text_to_room
-from middleman.utils import get_in_reply_to, get_mentions, get_replaces, get_reply_msg
+from middleman.chat_functions import make_text_content, send_reaction, send_text_to_room
+from middleman.utils import parse_relations
 
 logger = logging.getLogger(__name__)
 
 
+def is_mention_only_room(config, identifiers: List[str], is_named: bool) -> bool:
+    """
+    Check if messages of a room are only relayed if the bot is mentioned.
+    """
+    if config.mention_only_always_for_named and is_named:
+        return True
+    for identifier in identifiers:
+        if identifier in config.mention_only_rooms:
+            return True
+    return False
+
+
 class Message(object):
-    def __init__(self, client, store, config, message_content, room, event):
+    def __init__(
+        self, client, store, config, message_content, room, event, coalescer=None, digest=None, outbox=None,
+        relations=None, search=None, flood=None,
+    ):
         """Initialize a new Message
 
         Args:
@@ -26,6 +41,18 @@ class Message(object):
             room (nio.rooms.MatrixRoom): The room the event came from
 
             event (nio.events.room_events.RoomMessageText): The event defining the message
+
+            coalescer (BurstCoalescer): Optional tracker of recent relays used to merge bursts of messages
+
+            digest (Digest): Optional digest to count messages that are not relayed
+
+            outbox (Outbox): Optional outbox to send relays and replies through
+
+            relations (Relations): Optional relations of the event, if already parsed
+
+            search (SearchIndex): Optional index to add relayed messages to
+
+            flood (FloodGuard): Optional rate limiter of relays per room and sender
         """
         self.client = client
         self.store = store
@@ -33,49 +60,57 @@ class Message(object):
         self.message_content = message_content
         self.room = room
         self.event = event
+        self.coalescer = coalescer
+        self.digest = digest
+        self.outbox = outbox
+        self.relations = relations
+        self.search = search
+        self.flood = flood
 
     async def handle_management_room_message(self):
-        reply_to = get_in_reply_to(self.event)
-        replaces = get_replaces(self.event)
-
-        reply_section = get_reply_msg(self.event, reply_to, replaces)
-        if not reply_section:
-            logger.debug(
-                f"Skipping {self.event.event_id} which does not look like a reply"
-            )
+        reply_to, replaces, reply_text = self.relations or parse_relations(self.event)
+        if reply_text is None:
+            logger.debug("Skipping %s which does not look like a reply", self.event.event_id)
             return
         elif reply_to:
             # Send back to original sender
             message = self.store.get_message_by_management_event_id(reply_to)
             if not message:
                 logger.debug(
-                    f"Skipping message {self.event.event_id} which is not a reply to one of our relay messages",
+                    "Skipping message %s which is not a reply to one of our relay messages", self.event.event_id,
                 )
                 return
             # Relay back to original sender
-            # Send back anything after !reply
-            reply_text = reply_section[reply_section.find("!reply ") + 7:]
+            if self.outbox and self.outbox.enabled:
+                self.outbox.enqueue(
+                    "reply",
+                    message.room_id,
+                    make_text_content(reply_text, False, reply_to_event_id=message.event_id),
+                    self.event.event_id,
+                    self.room.room_id,
+                )
+                return
             response = await send_text_to_room(
                 self.client,
-                message["room_id"],
+                message.room_id,
                 reply_text,
                 False,
-                reply_to_event_id=message["event_id"],
+                reply_to_event_id=message.event_id,
             )
             if isinstance(response, RoomSendResponse):
                 # Store our outbound reply so we can reference it later
                 self.store.store_message(
                     event_id=response.event_id,
                     management_event_id=self.event.event_id,
-                    room_id=message["room_id"],
+                    room_id=message.room_id,
                 )
                 if self.config.confirm_reaction:
                     management_room_text = self.config.confirm_reaction_success
                 elif self.config.anonymise_senders:
                     management_room_text = "Message delivered back to the sender."
                 else:
-                    management_room_text = f"Message delivered back to the sender in room {message['room_id']}."
-                logger.info(f"Message {self.event.event_id} relayed back to the original sender")
+                    management_room_text = f"Message delivered back to the sender in room {message.room_id}."
+                logger.info("Message %s relayed back to the original sender", self.event.event_id)
             elif isinstance(response, RoomSendError):
                 if self.config.confirm_reaction:
                     management_room_text = self.config.confirm_reaction_fail
@@ -108,32 +143,39 @@ class Message(object):
             message = self.store.get_message_by_management_event_id(replaces)
             if not message:
                 logger.debug(
-                    f"Skipping message {self.event.event_id} which is not an edit to one of our reply messages",
+                    "Skipping message %s which is not an edit to one of our reply messages", self.event.event_id,
                 )
                 return
             # Edit the previously sent event
-            # Send back anything after !reply
-            reply_text = reply_section[reply_section.find("!reply ") + 7:]
+            if self.outbox and self.outbox.enabled:
+                self.outbox.enqueue(
+                    "edit",
+                    message.room_id,
+                    make_text_content(reply_text, False, replaces_event_id=message.event_id),
+                    self.event.event_id,
+                    self.room.room_id,
+                )
+                return
             response = await send_text_to_room(
                 self.client,
-                message["room_id"],
+                message.room_id,
                 reply_text,
                 False,
-                replaces_event_id=message["event_id"],
+                replaces_event_id=message.event_id,
             )
             if isinstance(response, RoomSendResponse):
                 # Store our outbound reply so we can reference it later
                 self.store.store_message(
                     event_id=response.event_id,
                     management_event_id=self.event.event_id,
-                    room_id=message["room_id"],
+                    room_id=message.room_id,
                 )
                 if self.config.anonymise_senders:
                     management_room_text = "Edit delivered back to the sender."
                 else:
                     management_room_text = f"Edit delivered back to the sender in " \
-                                            f"room {message['room_id']}."
-                logger.info(f"Edit {self.event.event_id} relayed back to the original sender")
+                                            f"room {message.room_id}."
+                logger.info("Edit %s relayed back to the original sender", self.event.event_id)
             elif isinstance(response, RoomSendError):
                 management_room_text = f"Failed to send edit back to sender: {response.message}"
                 logger.warning(management_room_text)
@@ -152,12 +194,7 @@ class Message(object):
         """
         Check if this room is only if mentioned.
         """
-        if self.config.mention_only_always_for_named and is_named:
-            return True
-        for identifier in identifiers:
-            if identifier in self.config.mention_only_rooms:
-                return True
-        return False
+        return is_mention_only_room(self.config, identifiers, is_named)
 
     async def process(self):
         """
@@ -174,21 +211,49 @@ class Message(object):
         """Relay to the management room."""
         # First check if we want to relay this
         if self.is_mention_only_room([self.room.canonical_alias, self.room.room_id], self.room.is_named):
-            # Did we get mentioned?
-            mentioned = self.config.user_id in get_mentions(self.message_content) or \
-                        self.message_content.lower().find(self.config.user_localpart.lower()) > -1
+            # Did we get mentioned? A mention of our user ID always contains our localpart too
+            mentioned = self.config.user_localpart.lower() in self.message_content.lower()
             if not mentioned:
                 logger.debug("Skipping message %s in room %s as it's set to only relay on mention and we were not "
                              "mentioned.", self.event.event_id, self.room.room_id)
+                if self.digest and self.digest.enabled:
+                    self.digest.record(
+                        self.room.room_id, self.room.display_name, self.event.sender, self.message_content,
+                    )
                 return
             logger.info("Room %s marked as mentions only and we have been mentioned, so relaying %s",
                         self.room.room_id, self.event.event_id)
 
-        if self.config.anonymise_senders:
-            text = f"anonymous: <i>{self.message_content}</i>".replace("\n", "  \n")
-        else:
-            text = f"{self.event.sender} in {self.room.display_name} (`{self.room.room_id}`): " \
-                   f"{self.message_content}".replace("\n", "  \n")
+        if self.flood and self.flood.enabled and not self.flood.allow(
+            self.room.room_id, self.room.display_name, self.event.sender,
+        ):
+            logger.debug(
+                "Holding back message %s from %s in room %s due to flood protection",
+                self.event.event_id, self.event.sender, self.room.room_id,
+            )
+            return
+
+        if self.search and self.search.enabled:
+            self.search.record(self.event.event_id, self.room.room_id, self.event.sender, self.message_content)
+
+        if self.outbox and self.outbox.enabled:
+            # Bursts are not coalesced when using the outbox, as the relay event ID is only known once sent
+            self.outbox.enqueue(
+                "relay",
+                self.config.management_room_id,
+                make_text_content(self.format_relay([self.message_content]), False),
+                self.event.event_id,
+                self.room.room_id,
+            )
+            return
+
+        if self.coalescer and self.coalescer.enabled:
+            burst = self.coalescer.get(self.room.room_id, self.event.sender, self.message_content)
+            if burst:
+                await self.extend_burst(burst)
+                return
+
+        text = self.format_relay([self.message_content])
         response = await send_text_to_room(
             client=self.client,
             room=self.config.management_room,
@@ -202,6 +267,45 @@ class Message(object):
                 response.event_id,
                 self.room.room_id,
             )
+            if self.coalescer and self.coalescer.enabled:
+                self.coalescer.start(self.room.room_id, self.event.sender, response.event_id, self.message_content)
             logger.info("Message %s relayed to the management room", self.event.event_id)
         else:
             logger.error("Failed to relay message %s to the management room", self.event.event_id)
+
+    async def extend_burst(self, burst):
+        """Relay a message as an edit of the previous relay from the same sender in the same room."""
+        text = self.format_relay(self.coalescer.extend(burst, self.message_content))
+        response = await send_text_to_room(
+            client=self.client,
+            room=self.config.management_room,
+            message=text,
+            notice=False,
+            replaces_event_id=burst.management_event_id,
+            notify_room_on_failure=self.room.room_id,
+        )
+        if type(response) == RoomSendResponse and response.event_id:
+            # Replies to the edit event route back to this message, replies to the original
+            # relay keep routing to the first message of the burst
+            self.store.store_message(
+                self.event.event_id,
+                response.event_id,
+                self.room.room_id,
+            )
+            logger.info(
+                "Message %s relayed to the management room as an edit of %s",
+                self.event.event_id, burst.management_event_id,
+            )
+        else:
+            # The failed message stays in the burst, so start a new one with the next message
+            self.coalescer.close(self.room.room_id, self.event.sender)
+            logger.error("Failed to relay message %s to the management room", self.event.event_id)
+
+    def format_relay(self, contents: List[str]) -> str:
+        """Format one or more messages from the sender as the text of a relay."""
+        if self.config.anonymise_senders:
+            text = "anonymous: " + "\n".join(f"<i>{content}</i>" for content in contents)
+        else:
+            text = f"{self.event.sender} in {self.room.display_name} (`{self.room.room_id}`): " + \
+                   "\n".join(contents)
+        return text.replace("\n", "  \n")
@@ -1,3 +1,6 @@
+tables = ["messages"]
+
+
 def migrate(store):
     """
     Recreate the messages table.
@@ -1,3 +1,6 @@
+tables = ["encrypted_events"]
+
+
 # noinspection PyProtectedMember
 def migrate(store):
     store._execute("""
@@ -0,0 +1,37 @@
+# noinspection PyProtectedMember
+def migrate(store):
+    if store.db_type == "postgres":
+        store._execute("""
+            CREATE TABLE outbox (
+                id SERIAL PRIMARY KEY,
+                txn_id text constraint outbox_txn_id_unique_idx unique,
+                kind text,
+                room_id text,
+                content text,
+                source_event_id text,
+                source_room_id text,
+                status text default 'pending',
+                attempts integer default 0,
+                next_attempt double precision default 0,
+                sent_event_id text
+            )
+        """)
+    else:
+        store._execute("""
+            CREATE TABLE outbox (
+                id INTEGER PRIMARY KEY autoincrement,
+                txn_id text constraint outbox_txn_id_unique_idx unique,
+                kind text,
+                room_id text,
+                content text,
+                source_event_id text,
+                source_room_id text,
+                status text default 'pending',
+                attempts integer default 0,
+                next_attempt real default 0,
+                sent_event_id text
+            )
+        """)
+    store._execute("""
+        CREATE INDEX outbox_status_next_attempt_idx ON outbox (status, next_attempt);
+    """)
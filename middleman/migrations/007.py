@@ -0,0 +1,26 @@
+# noinspection PyProtectedMember
+def migrate(store):
+    if store.db_type == "postgres":
+        store._execute("""
+            CREATE TABLE key_requests (
+                id SERIAL PRIMARY KEY,
+                session_id text constraint key_requests_session_id_unique_idx unique,
+                room_id text,
+                user_id text,
+                attempts integer default 0,
+                next_attempt double precision default 0,
+                status text default 'pending'
+            )
+        """)
+    else:
+        store._execute("""
+            CREATE TABLE key_requests (
+                id INTEGER PRIMARY KEY autoincrement,
+                session_id text constraint key_requests_session_id_unique_idx unique,
+                room_id text,
+                user_id text,
+                attempts integer default 0,
+                next_attempt real default 0,
+                status text default 'pending'
+            )
+        """)
@@ -0,0 +1,16 @@
+# noinspection PyProtectedMember
+def migrate(store):
+    if store.db_type == "postgres":
+        store._execute("""
+            CREATE TABLE welcome_messages (
+                id SERIAL PRIMARY KEY,
+                room_id text constraint welcome_messages_room_id_unique_idx unique
+            )
+        """)
+    else:
+        store._execute("""
+            CREATE TABLE welcome_messages (
+                id INTEGER PRIMARY KEY autoincrement,
+                room_id text constraint welcome_messages_room_id_unique_idx unique
+            )
+        """)
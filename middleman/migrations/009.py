@@ -0,0 +1,45 @@
+# noinspection PyProtectedMember
+def migrate(store):
+    if store.db_type == "postgres":
+        store._execute("""
+            CREATE TABLE relays (
+                id SERIAL PRIMARY KEY,
+                event_id text,
+                room_id text,
+                sender text,
+                body text,
+                created double precision,
+                body_tsv tsvector generated always as (to_tsvector('simple', coalesce(body, ''))) stored
+            )
+        """)
+        store._execute("""
+            CREATE INDEX relays_body_tsv_idx ON relays USING gin (body_tsv);
+        """)
+    else:
+        store._execute("""
+            CREATE TABLE relays (
+                id INTEGER PRIMARY KEY autoincrement,
+                event_id text,
+                room_id text,
+                sender text,
+                body text,
+                created real
+            )
+        """)
+        # Full-text index of the relay texts, kept in sync with the relays table by triggers
+        store._execute("""
+            CREATE VIRTUAL TABLE relays_fts USING fts5(body, content='relays', content_rowid='id');
+        """)
+        store._execute("""
+            CREATE TRIGGER relays_fts_insert AFTER INSERT ON relays BEGIN
+                INSERT INTO relays_fts (rowid, body) VALUES (new.id, new.body);
+            END;
+        """)
+        store._execute("""
+            CREATE TRIGGER relays_fts_delete AFTER DELETE ON relays BEGIN
+                INSERT INTO relays_fts (relays_fts, rowid, body) VALUES ('delete', old.id, old.body);
+            END;
+        """)
+    store._execute("""
+        CREATE INDEX relays_sender_idx ON relays (sender);
+    """)
@@ -0,0 +1,13 @@
+tables = ["relays"]
+transactional = False
+
+
+# noinspection PyProtectedMember
+def migrate(store):
+    """
+    Index the creation time of relayed messages, for deleting expired ones from the search index.
+
+    Runs at startup only, outside of a transaction, so that on Postgres the index is built
+    concurrently without blocking writes to the relays table.
+    """
+    store._create_index("relays_created_idx", "relays", "created")
@@ -0,0 +1,180 @@
+import asyncio
+import logging
+import time
+import uuid
+
+# noinspection PyPackageRequirements
+from nio import RoomSendError, RoomSendResponse
+
+from middleman.chat_functions import send_reaction, send_text_to_room
+from middleman.serialisation import dumps, loads
+from middleman.storage import OutboxItem
+
+logger = logging.getLogger(__name__)
+
+# How many due outbox items to fetch at a time
+OUTBOX_BATCH_SIZE = 50
+# Seconds to wait for new items before checking for retries that have become due
+OUTBOX_POLL_INTERVAL = 5
+# Maximum seconds to wait before retrying a failed send
+OUTBOX_MAX_BACKOFF = 300
+
+
+class Outbox(object):
+    def __init__(self, client, store, config):
+        """Durable queue of outbound relays and replies
+
+        Items are stored in the database when enqueued and sent by a background worker,
+        so sends that fail are retried, also across restarts. Each item has its own
+        transaction ID, so a send retried after the homeserver already received it is
+        not duplicated. The `messages` mapping is written in the same transaction that marks
+        an item sent, so an item is never retried once its mapping exists. Sent items are
+        deleted by the database maintenance.
+
+        Item kinds:
+            * relay: A message relayed to the management room. The source is the original
+                message.
+            * reply, edit: A reply or an edit of a reply sent back to the original sender.
+                The source is the management room message that is being relayed back.
+
+        Args:
+            client (nio.AsyncClient): nio client used to interact with matrix
+
+            store (Storage): Bot storage
+
+            config (Config): Bot configuration parameters
+        """
+        self.client = client
+        self.store = store
+        self.config = config
+        self.wakeup = asyncio.Event()
+        self.running = False
+        self.stopping = False
+
+    @property
+    def enabled(self) -> bool:
+        return self.config.outbox_enabled
+
+    def enqueue(self, kind: str, room_id: str, content: dict, source_event_id: str, source_room_id: str):
+        """Add a message to the outbox, to be sent by the worker"""
+        self.store.enqueue_outbox(
+            str(uuid.uuid4()), kind, room_id, dumps(content), source_event_id, source_room_id,
+        )
+        self.wakeup.set()
+
+    def stop(self):
+        """Stop the worker once the item being sent is done, leaving the rest for the next start"""
+        self.stopping = True
+        self.wakeup.set()
+
+    async def run(self):
+        """Send due outbox items, at most `config.outbox_rate` per second, until stopped"""
+        self.running = True
+        try:
+            while not self.stopping:
+                try:
+                    items = self.store.get_due_outbox(time.time(), OUTBOX_BATCH_SIZE)
+                except Exception as ex:
+                    logger.exception("Failed to get due outbox items, retrying in %ss: %s", OUTBOX_POLL_INTERVAL, ex)
+                    await asyncio.sleep(OUTBOX_POLL_INTERVAL)
+                    continue
+                if not items:
+                    self.wakeup.clear()
+                    try:
+                        await asyncio.wait_for(self.wakeup.wait(), timeout=OUTBOX_POLL_INTERVAL)
+                    except asyncio.TimeoutError:
+                        pass
+                    continue
+
+                for item in items:
+                    if self.stopping:
+                        break
+                    try:
+                        await self._send(item)
+                    except Exception as ex:
+                        logger.exception("Failed to process outbox item %s: %s", item.id, ex)
+                        try:
+                            await self._retry_or_fail(item, str(ex))
+                        except Exception as ex:
+                            logger.exception("Failed to reschedule outbox item %s: %s", item.id, ex)
+                    await asyncio.sleep(1 / self.config.outbox_rate)
+        finally:
+            self.running = False
+
+    async def _send(self, item: OutboxItem):
+        try:
+            response = await self.client.room_send(
+                item.room_id,
+                "m.room.message",
+                loads(item.content),
+                tx_id=item.txn_id,
+                ignore_unverified_devices=True,
+            )
+        except Exception as ex:
+            # Including connection errors, which are retried like any failed send
+            response = str(ex)
+
+        if isinstance(response, RoomSendResponse) and response.event_id:
+            # If this fails, the item is retried with the same transaction ID, so the homeserver
+            # does not send it twice
+            if item.kind == "relay":
+                message = (item.source_event_id, response.event_id, item.source_room_id)
+            else:
+                message = (response.event_id, item.source_event_id, item.room_id)
+            self.store.complete_outbox(item.id, response.event_id, message)
+            if item.kind == "relay":
+                logger.info("Message %s relayed to the management room", item.source_event_id)
+            else:
+                logger.info("%s %s relayed back to the original sender", item.kind.capitalize(), item.source_event_id)
+            try:
+                await self._confirm(item, None)
+            except Exception as ex:
+                logger.warning("Failed to confirm outbox item %s: %s", item.id, ex)
+            return
+
+        error = response.message if isinstance(response, RoomSendError) else response
+        await self._retry_or_fail(item, error)
+
+    async def _retry_or_fail(self, item: OutboxItem, error: str):
+        """Schedule a failed item to be retried with exponential backoff, or give up on it"""
+        attempts = item.attempts + 1
+        if attempts < self.config.outbox_max_attempts:
+            backoff = min(2 ** attempts, OUTBOX_MAX_BACKOFF)
+            logger.warning(
+                "Failed to send outbox item %s (attempt %s), retrying in %ss: %s", item.id, attempts, backoff, error,
+            )
+            self.store.retry_outbox(item.id, attempts, time.time() + backoff)
+            return
+
+        logger.error("Failed to send outbox item %s after %s attempts, giving up: %s", item.id, attempts, error)
+        self.store.fail_outbox(item.id, attempts)
+        await self._confirm(item, error)
+
+    async def _confirm(self, item: OutboxItem, error: str = None):
+        """Let the sender know the result of sending, like the bot does when sending directly"""
+        if item.kind == "relay":
+            if error:
+                await send_text_to_room(
+                    self.client,
+                    item.source_room_id,
+                    "Message did not get delivered due to an error. Please try again.",
+                )
+            return
+
+        if self.config.confirm_reaction:
+            await send_reaction(
+                self.client,
+                item.source_room_id,
+                item.source_event_id,
+                self.config.confirm_reaction_fail if error else self.config.confirm_reaction_success,
+            )
+            return
+
+        noun = "Edit" if item.kind == "edit" else "Message"
+        if error:
+            text = f"Failed to send {noun.lower()} back to sender: {error}"
+        elif self.config.anonymise_senders:
+            text = f"{noun} delivered back to the sender."
+        else:
+            text = f"{noun} delivered back to the sender in room {item.room_id}."
+        await send_text_to_room(self.client, item.source_room_id, text, True)
@@ -0,0 +1,27 @@
+import asyncio
+import logging
+
+from middleman.serialisation import use_orjson
+
+logger = logging.getLogger(__name__)
+
+
+def enable_performance_mode():
+    """Use uvloop as the event loop and orjson for serialisation, if they are installed
+
+    Must be called before the event loop is created. Either one that is missing is
+    skipped with a warning, and the standard library is used instead.
+    """
+    try:
+        # noinspection PyPackageRequirements
+        import uvloop
+    except ImportError:
+        logger.warning("Performance mode: uvloop is not installed, using the default event loop")
+    else:
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+        logger.info("Performance mode: using the uvloop event loop")
+
+    if use_orjson():
+        logger.info("Performance mode: using orjson for serialisation")
+    else:
+        logger.warning("Performance mode: orjson is not installed, using the standard json module")
@@ -0,0 +1,139 @@
+import asyncio
+import logging
+import random
+import time
+from typing import Awaitable, Callable, Optional
+
+# noinspection PyPackageRequirements
+from aiohttp import ClientError
+# noinspection PyPackageRequirements
+from nio import ErrorResponse
+
+logger = logging.getLogger(__name__)
+
+# Errors raised by the client that are worth retrying
+RETRYABLE_EXCEPTIONS = (asyncio.TimeoutError, ClientError)
+
+
+class RetryBudget(object):
+    def __init__(self, max_tokens: float = 10, token_ratio: float = 0.1):
+        """Limits retries while requests keep failing, so retrying does not amplify an outage
+
+        Each retry withdraws a token and each success deposits a fraction of one. Retries
+        are only allowed while more than half of the tokens are left.
+
+        Args:
+            max_tokens (float): Maximum amount of tokens
+
+            token_ratio (float): Tokens deposited per success
+        """
+        self.max_tokens = max_tokens
+        self.token_ratio = token_ratio
+        self.tokens = max_tokens
+
+    def deposit(self):
+        self.tokens = min(self.tokens + self.token_ratio, self.max_tokens)
+
+    def withdraw(self) -> bool:
+        if self.tokens <= self.max_tokens / 2:
+            return False
+        self.tokens -= 1
+        return True
+
+
+class RetryPolicy(object):
+    def __init__(
+        self, max_attempts: int = 4, base_delay: float = 0.5, max_delay: float = 30, deadline: float = 60,
+        budget: RetryBudget = None,
+    ):
+        """Retry policy for requests to the homeserver
+
+        Retries server errors, rate limiting and connection errors with exponential backoff
+        and full jitter, for at most `max_attempts` attempts and `deadline` seconds per call.
+
+        Args:
+            max_attempts (int): Maximum attempts per call, including the first
+
+            base_delay (float): Seconds to wait at most before the first retry, doubled for each retry
+
+            max_delay (float): Maximum seconds to wait before a retry
+
+            deadline (float): Seconds after which a call is given up, cancelling the attempt in progress
+
+            budget (RetryBudget): Budget shared by all calls made with this policy
+        """
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.deadline = deadline
+        self.budget = budget or RetryBudget()
+
+    def backoff(self, attempt: int) -> float:
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** (attempt - 1)))
+
+    def get_delay(self, attempt: int, response=None) -> Optional[float]:
+        """Get the seconds to wait before retrying after a failed attempt, or None if not retryable
+
+        Args:
+            attempt (int): The attempt that failed, starting from 1
+
+            response: The error response, or None if the attempt raised a retryable error
+        """
+        if response is None:
+            # A timeout or a connection error
+            return self.backoff(attempt)
+        if not isinstance(response, ErrorResponse):
+            return None
+        if response.status_code == "M_LIMIT_EXCEEDED":
+            if response.retry_after_ms:
+                return min(response.retry_after_ms / 1000, self.max_delay)
+            return self.backoff(attempt)
+        transport_response = getattr(response, "transport_response", None)
+        if transport_response is not None and transport_response.status >= 500:
+            return self.backoff(attempt)
+        return None
+
+
+default_policy = RetryPolicy()
+
+
+async def with_retry(request: Callable[[], Awaitable], policy: RetryPolicy = None):
+    """Make a request to the homeserver, retrying it according to the retry policy
+
+    Only the result of the last attempt is returned, or its error raised, once the policy
+    gives up. Each attempt is cancelled with `asyncio.TimeoutError` if it is still running
+    at the deadline of the call. Requests that are retried should be idempotent, for
+    example by reusing the same transaction ID.
+
+    Args:
+        request: A function returning the request coroutine, called once per attempt
+
+        policy (RetryPolicy): The retry policy to use. Defaults to `default_policy`.
+    """
+    policy = policy or default_policy
+    deadline = time.monotonic() + policy.deadline
+    attempt = 1
+    while True:
+        error = None
+        response = None
+        try:
+            response = await asyncio.wait_for(request(), timeout=max(deadline - time.monotonic(), 0))
+        except RETRYABLE_EXCEPTIONS as ex:
+            error = ex
+
+        delay = policy.get_delay(attempt, response)
+        if delay is None:
+            if not isinstance(response, ErrorResponse):
+                policy.budget.deposit()
+            return response
+
+        reason = repr(error) if error else getattr(response, "message", response)
+        if attempt >= policy.max_attempts or time.monotonic() + delay > deadline or not policy.budget.withdraw():
+            logger.warning("Giving up on request after %s attempts: %s", attempt, reason)
+            if error:
+                raise error
+            return response
+
+        logger.info("Request attempt %s failed, retrying in %.1fs: %s", attempt, delay, reason)
+        await asyncio.sleep(delay)
+        attempt += 1
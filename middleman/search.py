@@ -0,0 +1,101 @@
+import asyncio
+import logging
+import time
+from typing import List, Optional
+
+from middleman.storage import SearchResult
+
+logger = logging.getLogger(__name__)
+
+# Seconds between writes of relayed messages to the search index
+SEARCH_INDEX_INTERVAL = 2
+# Maximum relayed messages kept queued while writing them to the index fails
+SEARCH_MAX_PENDING = 10000
+# Seconds between deletions of relayed messages older than the retention period
+SEARCH_PRUNE_INTERVAL = 24 * 3600
+
+
+class SearchIndex(object):
+    def __init__(self, store, config):
+        """Full-text index of relayed messages, for searching the relay history
+
+        Relayed messages are queued in memory and written to the index in batches by a
+        background task, so that relaying does not wait for the database. A batch that fails
+        to be written is retried with the next one, keeping at most `SEARCH_MAX_PENDING` of the
+        newest messages queued. With `anonymise_senders` set, neither the sender nor the room
+        of a message is stored. Messages older than `config.search_retention_days` are deleted
+        from the index daily.
+
+        Args:
+            store (Storage): Bot storage
+
+            config (Config): Bot configuration parameters
+        """
+        self.store = store
+        self.config = config
+        self.pending: List[tuple] = []
+        self.wakeup = asyncio.Event()
+
+    @property
+    def enabled(self) -> bool:
+        return self.config.search_enabled
+
+    def record(self, event_id: str, room_id: str, sender: str, body: str):
+        """Queue a relayed message to be indexed"""
+        if self.config.anonymise_senders:
+            room_id = sender = None
+        self.pending.append((event_id, room_id, sender, body, time.time()))
+        self.wakeup.set()
+
+    def flush(self):
+        """Write the queued messages to the index, queueing them again if that fails"""
+        relays, self.pending = self.pending, []
+        if not relays:
+            return
+        try:
+            self.store.store_relays(relays)
+        except Exception as ex:
+            self.pending = relays[-SEARCH_MAX_PENDING:]
+            dropped = len(relays) - len(self.pending)
+            logger.warning(
+                "Failed to index %s relayed messages, retrying later%s: %s",
+                len(relays), f" without the oldest {dropped}" if dropped else "", ex,
+            )
+
+    def prune(self):
+        """Delete the messages older than the retention period from the index"""
+        if not self.config.search_retention_days:
+            return
+        try:
+            deleted = self.store.prune_relays(time.time() - self.config.search_retention_days * 24 * 3600)
+        except Exception as ex:
+            logger.warning("Failed to delete old relayed messages from the search index: %s", ex)
+            return
+        if deleted:
+            logger.info(
+                "Deleted %s relayed messages older than %s days from the search index",
+                deleted, self.config.search_retention_days,
+            )
+
+    def search(self, text: str, sender: Optional[str] = None, limit: int = 10) -> List[SearchResult]:
+        """Search the index, which lacks the messages relayed in the last `SEARCH_INDEX_INTERVAL` seconds"""
+        return self.store.search_relays(text, sender, limit)
+
+    async def run(self):
+        self.prune()
+        last_pruned = time.monotonic()
+        while True:
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout=SEARCH_PRUNE_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            self.wakeup.clear()
+            self.flush()
+            if self.pending:
+                # Writing failed, try again after the interval
+                self.wakeup.set()
+            if time.monotonic() - last_pruned >= SEARCH_PRUNE_INTERVAL:
+                self.prune()
+                last_pruned = time.monotonic()
+            # Let more messages queue up for the next batch
+            await asyncio.sleep(SEARCH_INDEX_INTERVAL)
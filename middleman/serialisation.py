@@ -0,0 +1,39 @@
+import json
+from typing import Any
+
+# The orjson module, when enabled
+_orjson = None
+
+
+def use_orjson() -> bool:
+    """Serialise with orjson from now on, if it is installed
+
+    Returns:
+        True if orjson is in use
+    """
+    global _orjson
+    try:
+        # noinspection PyPackageRequirements
+        import orjson
+    except ImportError:
+        return False
+    _orjson = orjson
+    return True
+
+
+def dumps(obj: Any) -> str:
+    """Serialise to a JSON string"""
+    if _orjson:
+        try:
+            return _orjson.dumps(obj).decode()
+        except TypeError:
+            # Values orjson does not support, like integers over 64 bits
+            pass
+    return json.dumps(obj, ensure_ascii=False)
+
+
+def loads(text: str) -> Any:
+    """Deserialise a JSON string"""
+    if _orjson:
+        return _orjson.loads(text)
+    return json.loads(text)
@@ -1,12 +1,16 @@
+import asyncio
 import importlib
-import json
 import logging
+import time
+from collections import OrderedDict
 from dataclasses import asdict
-from typing import Optional, List
+from typing import Iterator, List, NamedTuple, Optional
 
 # noinspection PyPackageRequirements
 from nio import MegolmEvent
 
+from middleman.serialisation import dumps
+
 # The latest migration version of the database.
 #
 # Database migrations are applied starting from the number specified in the database's
@@ -14,14 +18,187 @@ from nio import MegolmEvent
 # the version specified here.
 #
 # When a migration is performed, the `migration_version` table should be incremented.
-
-latest_migration_version = 5
+#
+# A migration module has a `migrate(store)` function and can optionally set:
+#   * `transactional`: Whether to run the migration and the version update in one
+#       transaction. Defaults to true. Set to false for migrations that create indexes
+#       concurrently with `Storage._create_index` or backfill in batches with
+#       `Storage._backfill`, so that locks are released between steps. Such migrations
+#       must be safe to re-run if interrupted.
+#   * `tables`: Names of the existing tables the migration touches, used to estimate
+#       the amount of rows touched in a dry run.
+
+latest_migration_version = 10
+
+# Queries issued by the bot while running, by name.
+#
+# Placeholders are written as `?` and translated once per backend on startup. On Postgres
+# each query is also prepared server side, so only the parameters are sent per execution.
+# Queries that differ per backend are given as a dictionary of backend to query.
+queries = {
+    "get_encrypted_events": """
+        select id, device_id, event_id, room_id, session_id, event, user_id from encrypted_events where session_id = ?
+    """,
+    "get_encrypted_events_for_user": """
+        select id, device_id, event_id, room_id, session_id, event, user_id from encrypted_events where user_id = ?
+    """,
+    "count_encrypted_events_for_user": """
+        select count(*) from encrypted_events where user_id = ?
+    """,
+    "get_message_by_management_event_id": """
+        select room_id, event_id from messages where management_event_id = ?
+    """,
+    "remove_encrypted_event": """
+        delete from encrypted_events where event_id = ?
+    """,
+    "store_encrypted_event": """
+        insert into encrypted_events
+            (device_id, event_id, room_id, session_id, event, user_id) values
+            (?, ?, ?, ?, ?, ?)
+    """,
+    "store_message": """
+        insert into messages (event_id, management_event_id, room_id) values (?, ?, ?)
+    """,
+    "enqueue_outbox": """
+        insert into outbox (txn_id, kind, room_id, content, source_event_id, source_room_id) values (?, ?, ?, ?, ?, ?)
+    """,
+    "get_due_outbox": """
+        select id, txn_id, kind, room_id, content, source_event_id, source_room_id, attempts from outbox
+        where status = 'pending' and next_attempt <= ? order by id limit ?
+    """,
+    "complete_outbox": """
+        update outbox set status = 'done', sent_event_id = ? where id = ?
+    """,
+    "prune_outbox": """
+        delete from outbox where status = 'done'
+    """,
+    "retry_outbox": """
+        update outbox set attempts = ?, next_attempt = ? where id = ?
+    """,
+    "fail_outbox": """
+        update outbox set status = 'failed', attempts = ? where id = ?
+    """,
+    "insert_key_request": """
+        insert into key_requests (room_id, user_id, attempts, next_attempt, status, session_id) values (?, ?, ?, ?, ?, ?)
+    """,
+    "update_key_request": """
+        update key_requests set room_id = ?, user_id = ?, attempts = ?, next_attempt = ?, status = ?
+        where session_id = ?
+    """,
+    "prune_key_requests": """
+        delete from key_requests where status = 'fulfilled' or (
+            status = 'expired' and session_id not in (select session_id from encrypted_events)
+        )
+    """,
+    "get_pending_key_requests": """
+        select session_id, room_id, user_id, attempts, next_attempt from key_requests where status = 'pending'
+    """,
+    "get_welcome_message_rooms": """
+        select room_id from welcome_messages
+    """,
+    "store_welcome_message_room": """
+        insert into welcome_messages (room_id) values (?)
+    """,
+    "store_relay": """
+        insert into relays (event_id, room_id, sender, body, created) values (?, ?, ?, ?, ?)
+    """,
+    "prune_relays": """
+        delete from relays where created < ?
+    """,
+    "search_relays": {
+        "sqlite": """
+            select r.event_id, m.management_event_id, r.room_id, r.sender, r.body, r.created
+            from relays_fts join relays r on r.id = relays_fts.rowid left join messages m on m.event_id = r.event_id
+            where relays_fts match ? order by relays_fts.rank limit ?
+        """,
+        "postgres": """
+            select r.event_id, m.management_event_id, r.room_id, r.sender, r.body, r.created
+            from relays r cross join plainto_tsquery('simple', ?) query left join messages m on m.event_id = r.event_id
+            where r.body_tsv @@ query order by ts_rank(r.body_tsv, query) desc limit ?
+        """,
+    },
+    "search_relays_by_sender": {
+        "sqlite": """
+            select r.event_id, m.management_event_id, r.room_id, r.sender, r.body, r.created
+            from relays_fts join relays r on r.id = relays_fts.rowid left join messages m on m.event_id = r.event_id
+            where relays_fts match ? and r.sender = ? order by relays_fts.rank limit ?
+        """,
+        "postgres": """
+            select r.event_id, m.management_event_id, r.room_id, r.sender, r.body, r.created
+            from relays r cross join plainto_tsquery('simple', ?) query left join messages m on m.event_id = r.event_id
+            where r.body_tsv @@ query and r.sender = ? order by ts_rank(r.body_tsv, query) desc limit ?
+        """,
+    },
+    "get_relays_by_sender": """
+        select r.event_id, m.management_event_id, r.room_id, r.sender, r.body, r.created
+        from relays r left join messages m on m.event_id = r.event_id
+        where r.sender = ? order by r.id desc limit ?
+    """,
+}
+
+# How many rows to read from the database at a time when streaming results
+FETCH_BATCH_SIZE = 100
+# Tables of the latest migration version, for inspection and export
+TABLES = ["messages", "encrypted_events", "outbox", "key_requests", "welcome_messages", "relays"]
+# How many rows to update per batch in migration backfills
+BACKFILL_BATCH_SIZE = 1000
+# Seconds to pause between backfill batches to let other database clients through
+BACKFILL_PAUSE = 0.05
+# Seconds without queries after which the database is considered idle for maintenance
+MAINTENANCE_IDLE_SECONDS = 60
+# Seconds maintenance may be postponed at most while the database stays busy
+MAINTENANCE_MAX_POSTPONE_SECONDS = 3600
+# Seconds between log lines reporting the hit rate of the message cache
+MESSAGE_CACHE_REPORT_INTERVAL = 3600
 
 logger = logging.getLogger(__name__)
 
 
+class EncryptedEvent(NamedTuple):
+    id: int
+    device_id: str
+    event_id: str
+    room_id: str
+    session_id: str
+    event: str
+    user_id: str
+
+
+class Message(NamedTuple):
+    room_id: str
+    event_id: str
+
+
+class OutboxItem(NamedTuple):
+    id: int
+    txn_id: str
+    kind: str
+    room_id: str
+    content: str
+    source_event_id: str
+    source_room_id: str
+    attempts: int
+
+
+class KeyRequest(NamedTuple):
+    session_id: str
+    room_id: str
+    user_id: str
+    attempts: int
+    next_attempt: float
+
+
+class SearchResult(NamedTuple):
+    event_id: str
+    management_event_id: Optional[str]
+    room_id: Optional[str]
+    sender: Optional[str]
+    body: str
+    created: float
+
+
 class Storage(object):
-    def __init__(self, database_config):
+    def __init__(self, database_config, message_cache_size: int = 1000, migrate: bool = True):
         """Setup the database
 
         Runs an initial setup or migrations depending on whether a database file has already
@@ -32,25 +209,44 @@ class Storage(object):
                 * type: A string, one of "sqlite" or "postgres"
                 * connection_string: A string, featuring a connection string that
                     be fed to each respective db library's `connect` method
+                * profile: Optional for sqlite, one of "default" or "performance"
+                * mmap_size: Optional for sqlite, bytes of the database to memory map
+                * cache_size: Optional for sqlite, KiB of page cache
+
+            message_cache_size: How many messages to keep in memory for looking up
+                messages by management event ID. Zero disables the cache.
+
+            migrate: Whether to set up and migrate the database. When false, the database is
+                left untouched, and is usable only for inspecting migrations.
         """
         self.conn = self._get_database_connection(
             database_config["type"], database_config["connection_string"]
         )
         self.cursor = self.conn.cursor()
         self.db_type = database_config["type"]
-
-        # Try to check the current migration version
-        migration_level = 0
-        # noinspection PyBroadException
-        try:
-            self._execute("SELECT version FROM migration_version")
-            row = self.cursor.fetchone()
-            migration_level = row[0]
-        except Exception:
-            self._initial_setup()
-        finally:
-            if migration_level < latest_migration_version:
-                self._run_migrations(migration_level)
+        self.last_activity = time.monotonic()
+
+        if self.db_type == "sqlite":
+            self._configure_sqlite(database_config)
+
+        # Write-through LRU cache of management event ID -> message
+        self.message_cache = OrderedDict()
+        self.message_cache_size = message_cache_size
+        self.message_cache_hits = 0
+        self.message_cache_misses = 0
+
+        self.in_transaction = False
+        self.statements = {}
+        # Named queries with the placeholders of the backend, for server side cursors
+        self.translated_queries = {}
+        # For unique names of server side cursors
+        self.cursor_count = 0
+        if not migrate:
+            return
+
+        self.migrate()
+        self.translated_queries = self._translate_queries()
+        self.statements = self._prepare_statements()
 
         logger.info(f"Database initialization of type '{self.db_type}' complete")
 
@@ -72,6 +268,198 @@ class Storage(object):
 
             return conn
 
+    def _configure_sqlite(self, database_config: dict):
+        """Apply the configured performance profile to the SQLite connection
+
+        The performance profile uses a write-ahead log with `synchronous=NORMAL`, so that
+        writes no longer wait for a full sync of the database file, at the cost of possibly
+        losing the latest writes (but not corrupting the database) on power loss. Freed pages
+        are reclaimed incrementally by the maintenance task. This only takes effect for
+        existing databases after a manual `VACUUM`.
+        """
+        if database_config.get("profile") == "performance":
+            self._execute("PRAGMA journal_mode=WAL")
+            self._execute("PRAGMA synchronous=NORMAL")
+            self._execute("PRAGMA auto_vacuum=INCREMENTAL")
+        if database_config.get("mmap_size"):
+            self._execute(f"PRAGMA mmap_size={int(database_config['mmap_size'])}")
+        if database_config.get("cache_size"):
+            # Negative values are in KiB rather than pages
+            self._execute(f"PRAGMA cache_size=-{int(database_config['cache_size'])}")
+
+    def maintain(self):
+        """Run periodic database maintenance
+
+        Deletes the outbox items that have been sent, along with their content. On SQLite
+        also checkpoints the write-ahead log, updates query planner statistics and reclaims
+        free pages. Postgres takes care of this itself with autovacuum.
+        """
+        started = time.monotonic()
+        self._execute_named("prune_outbox")
+        if self.cursor.rowcount > 0:
+            logger.info(f"Deleted {self.cursor.rowcount} sent outbox items")
+        if self.db_type != "sqlite":
+            return
+        self._execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        self._execute("PRAGMA optimize")
+        self._execute("PRAGMA incremental_vacuum")
+        logger.info(f"Database maintenance done in {time.monotonic() - started:.2f}s")
+
+    async def run_maintenance(self, interval: int):
+        """Run database maintenance periodically, postponing it while the database is busy
+
+        Maintenance is postponed for at most `MAINTENANCE_MAX_POSTPONE_SECONDS`, so that it
+        still runs on a bot that is never idle.
+        """
+        while True:
+            await asyncio.sleep(interval)
+            due = time.monotonic()
+            while (
+                time.monotonic() - self.last_activity < MAINTENANCE_IDLE_SECONDS
+                and time.monotonic() - due < MAINTENANCE_MAX_POSTPONE_SECONDS
+            ):
+                await asyncio.sleep(MAINTENANCE_IDLE_SECONDS)
+            try:
+                self.maintain()
+            except Exception as ex:
+                logger.warning(f"Database maintenance failed: {ex}")
+
+    def close(self):
+        """Close the database connection, writing out the SQLite write-ahead log if any"""
+        if self.db_type == "sqlite":
+            self._execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        self.conn.close()
+
+    def get_stats(self) -> dict:
+        """Get the migration version, the amount of rows per table and the size of the database
+
+        Returns:
+            A dictionary with the keys `migration_version`, `tables` (row counts by table),
+            `size` and `free` (bytes, free is None on Postgres).
+        """
+        tables = {table: self._count_rows(table) for table in TABLES}
+        if self.db_type == "sqlite":
+            self._execute("PRAGMA page_size")
+            page_size = self.cursor.fetchone()[0]
+            self._execute("PRAGMA page_count")
+            size = self.cursor.fetchone()[0] * page_size
+            self._execute("PRAGMA freelist_count")
+            free = self.cursor.fetchone()[0] * page_size
+        else:
+            self._execute("SELECT pg_database_size(current_database())")
+            size = self.cursor.fetchone()[0]
+            free = None
+        return {
+            "migration_version": self.get_migration_level(),
+            "tables": tables,
+            "size": size,
+            "free": free,
+        }
+
+    def prune(self, keep_encrypted_events: Optional[int] = None, relays_before: Optional[float] = None) -> dict:
+        """Delete rows the bot no longer needs, in one transaction
+
+        Deletes the encrypted events of sessions whose key was given up on, outbox items that
+        have been sent or have failed, and key requests that are no longer pending.
+
+        Args:
+            keep_encrypted_events: If set, also delete all but this many of the newest
+                encrypted events
+
+            relays_before: If set, also delete the relayed messages created before this
+                time from the search index
+
+        Returns:
+            The amount of rows deleted, by table
+        """
+        deleted = {}
+        self._begin()
+        try:
+            self._execute("""
+                delete from encrypted_events where session_id in (
+                    select session_id from key_requests where status = 'expired'
+                )
+            """)
+            deleted["encrypted_events"] = self.cursor.rowcount
+            if keep_encrypted_events is not None:
+                self._execute("""
+                    delete from encrypted_events where id not in (
+                        select id from encrypted_events order by id desc limit ?
+                    )
+                """, (keep_encrypted_events,))
+                deleted["encrypted_events"] += self.cursor.rowcount
+            self._execute("delete from outbox where status in ('done', 'failed')")
+            deleted["outbox"] = self.cursor.rowcount
+            self._execute("delete from key_requests where status in ('fulfilled', 'expired')")
+            deleted["key_requests"] = self.cursor.rowcount
+            if relays_before is not None:
+                self._execute("delete from relays where created < ?", (relays_before,))
+                deleted["relays"] = self.cursor.rowcount
+        except Exception:
+            self._rollback()
+            raise
+        self._commit()
+        logger.info(f"Pruned rows: {deleted}")
+        return deleted
+
+    def vacuum(self):
+        """Rebuild the database to reclaim free space, and update query planner statistics
+
+        On SQLite this also applies a changed `auto_vacuum` setting to an existing database.
+        """
+        started = time.monotonic()
+        self._execute("VACUUM" if self.db_type == "sqlite" else "VACUUM ANALYZE")
+        if self.db_type == "sqlite":
+            self._execute("ANALYZE")
+        logger.info(f"Database vacuumed in {time.monotonic() - started:.2f}s")
+
+    def analyze(self):
+        """Update query planner statistics"""
+        self._execute("ANALYZE")
+
+    def iter_table(self, table: str) -> Iterator[dict]:
+        """Stream the rows of a table as dictionaries of column name to value, in batches
+
+        On Postgres a server side cursor is used, so that only one batch of rows is held in
+        memory at a time.
+        """
+        if table not in TABLES:
+            raise ValueError(f"Unknown table {table}")
+        if self.db_type == "postgres":
+            # Held over commits, as the connection is in autocommit mode
+            cursor = self.conn.cursor(name=f"iter_{table}", withhold=True)
+        else:
+            cursor = self.conn.cursor()
+        try:
+            cursor.execute(f"select * from {table} order by id")
+            columns = None
+            while rows := cursor.fetchmany(FETCH_BATCH_SIZE):
+                if columns is None:
+                    columns = [column[0] for column in cursor.description]
+                for row in rows:
+                    yield dict(zip(columns, row))
+        finally:
+            cursor.close()
+
+    def migrate(self):
+        """Set up the database if needed and migrate it to the latest version"""
+        migration_level = self.get_migration_level()
+        if migration_level is None:
+            self._initial_setup()
+            migration_level = 0
+        if migration_level < latest_migration_version:
+            self._run_migrations(migration_level)
+
+    def get_migration_level(self) -> Optional[int]:
+        """Get the current migration version of the database, or None if it has not been set up"""
+        # noinspection PyBroadException
+        try:
+            self._execute("SELECT version FROM migration_version")
+            row = self.cursor.fetchone()
+            return row[0]
+        except Exception:
+            return None
+
     def _initial_setup(self):
         """Initial setup of the database"""
         logger.info("Performing initial database setup...")
@@ -114,84 +502,403 @@ class Storage(object):
             logger.info(
                 f"Migrating the database from v{current_migration_version} to v{next_migration_version}...",
             )
+            started = time.monotonic()
+
+            migration = self._import_migration(next_migration_version)
+            transactional = getattr(migration, "transactional", True)
+            if transactional:
+                self._begin()
+            try:
+                # noinspection PyUnresolvedReferences
+                migration.migrate(self)
+
+                # Update the stored migration version
+                self._execute("UPDATE migration_version SET version = ?", (next_migration_version,))
+            except Exception:
+                if transactional:
+                    self._rollback()
+                logger.error(f"Migrating the database to v{next_migration_version} failed")
+                raise
+            if transactional:
+                self._commit()
+
+            logger.info(f"Database migrated to v{next_migration_version} in {time.monotonic() - started:.1f}s")
+            current_migration_version += 1
 
-            migration = importlib.import_module(f".migrations.{str(next_migration_version).rjust(3, '0')}", "middleman")
-            # noinspection PyUnresolvedReferences
-            migration.migrate(self)
+    @staticmethod
+    def _import_migration(version: int):
+        return importlib.import_module(f".migrations.{str(version).rjust(3, '0')}", "middleman")
 
-            # Update the stored migration version
-            self._execute("UPDATE migration_version SET version = ?", (next_migration_version,))
+    def dry_run_migrations(self) -> List[dict]:
+        """Report the pending migrations without applying them
 
-            logger.info(f"Database migrated to v{next_migration_version}")
-            current_migration_version += 1
+        Returns:
+            A list of pending migrations, each a dictionary with the keys `version`,
+            `transactional` and `rows`, the latter being the estimated amount of rows
+            touched in the existing tables.
+        """
+        current_migration_version = self.get_migration_level() or 0
+        pending = []
+        for version in range(current_migration_version + 1, latest_migration_version + 1):
+            migration = self._import_migration(version)
+            rows = 0
+            for table in getattr(migration, "tables", []):
+                rows += self._count_rows(table)
+            pending.append({
+                "version": version,
+                "transactional": getattr(migration, "transactional", True),
+                "rows": rows,
+            })
+            logger.info(f"Migration to v{version} would touch an estimated {rows} rows")
+        return pending
+
+    def _count_rows(self, table: str) -> int:
+        # noinspection PyBroadException
+        try:
+            self._execute(f"SELECT count(*) FROM {table}")
+            return self.cursor.fetchone()[0]
+        except Exception:
+            # The table does not exist yet
+            return 0
+
+    def _begin(self):
+        self._execute("BEGIN")
+        self.in_transaction = True
+
+    def _commit(self):
+        self._execute("COMMIT")
+        self.in_transaction = False
+
+    def _rollback(self):
+        self._execute("ROLLBACK")
+        self.in_transaction = False
+
+    def _create_index(self, name: str, table: str, columns: str):
+        """Create an index for migrations, if it does not exist yet
+
+        On Postgres the index is built concurrently when not in a transaction, so that
+        writes to the table are not blocked while it is built. An index left invalid by an
+        interrupted concurrent build is dropped and built again.
+        """
+        concurrently = "CONCURRENTLY " if self.db_type == "postgres" and not self.in_transaction else ""
+        if concurrently:
+            self._execute("""
+                SELECT 1 FROM pg_class c JOIN pg_index i ON i.indexrelid = c.oid
+                WHERE c.relname = ? AND NOT i.indisvalid
+            """, (name,))
+            if self.cursor.fetchone():
+                logger.warning(f"Dropping index {name} left invalid by an interrupted build")
+                self._execute(f"DROP INDEX CONCURRENTLY {name}")
+        logger.info(f"Creating index {name} on {table} ({columns})...")
+        started = time.monotonic()
+        self._execute(f"CREATE INDEX {concurrently}IF NOT EXISTS {name} ON {table} ({columns})")
+        logger.info(f"Created index {name} in {time.monotonic() - started:.1f}s")
+
+    def _backfill(self, table: str, assignments: str, condition: str, params: tuple = ()) -> int:
+        """Update rows of a table in batches for migrations
+
+        When not in a transaction, each batch is committed on its own, so locks are only
+        held for one batch at a time, and the progress is logged per batch. The assignments
+        must make the condition false for the updated rows, otherwise the backfill never
+        ends. Params are given in the order their placeholders appear in the assignments and
+        the condition.
+
+        Migrations run at startup only, before the bot starts syncing, so the pause between
+        batches holds up nothing but the startup.
+
+        Returns:
+            The amount of rows updated
+        """
+        batched = not self.in_transaction
+        total = 0
+        while True:
+            if batched:
+                self._begin()
+            try:
+                self._execute(f"""
+                    UPDATE {table} SET {assignments} WHERE id IN (
+                        SELECT id FROM {table} WHERE {condition} LIMIT {BACKFILL_BATCH_SIZE}
+                    )
+                """, params)
+                updated = self.cursor.rowcount
+            except Exception:
+                if batched:
+                    self._rollback()
+                raise
+            if batched:
+                self._commit()
+            if updated <= 0:
+                break
+            total += updated
+            logger.info(f"Backfilled {total} rows of {table}...")
+            if batched:
+                time.sleep(BACKFILL_PAUSE)
+        return total
 
     def _execute(self, *args):
         """A wrapper around cursor.execute that transforms placeholder ?'s to %s for postgres
         """
+        self.last_activity = time.monotonic()
         if self.db_type == "postgres":
             self.cursor.execute(args[0].replace("?", "%s"), *args[1:])
         else:
             self.cursor.execute(*args)
 
-    def get_encrypted_events(self, session_id: str) -> List:
-        self._execute("""
-            select id, device_id, room_id, session_id, event, user_id from encrypted_events where session_id = ?;
-        """, (session_id,))
-        events = self.cursor.fetchall()
-        return [
-            {
-                "id": row[0],
-                "device_id": row[1],
-                "room_id": row[2],
-                "session_id": row[3],
-                "event": row[4],
-                "user_id": row[5],
-            } for row in events
-        ]
-
-    def get_encrypted_events_for_user(self, user_id: str) -> List:
-        self._execute("""
-            select id, device_id, room_id, session_id, event, user_id from encrypted_events where user_id = ?;
-        """, (user_id,))
-        events = self.cursor.fetchall()
-        return [
-            {
-                "id": row[0],
-                "device_id": row[1],
-                "room_id": row[2],
-                "session_id": row[3],
-                "event": row[4],
-                "user_id": row[5],
-            } for row in events
-        ]
-
-    def get_message_by_management_event_id(self, management_event_id: str) -> Optional[dict]:
-        self._execute("SELECT room_id, event_id FROM messages where management_event_id = ?", (management_event_id,))
+    def _translate_queries(self) -> dict:
+        """Get the named queries of the backend with its placeholder style"""
+        return {
+            name: (query[self.db_type] if isinstance(query, dict) else query).strip().replace(
+                "?", "%s" if self.db_type == "postgres" else "?",
+            )
+            for name, query in queries.items()
+        }
+
+    def _prepare_statements(self) -> dict:
+        """Translate the named queries to the placeholder style of the backend
+
+        On Postgres the queries are prepared on the server and the returned statements
+        execute the prepared query. On SQLite the statement text is passed as is, which
+        lets the driver reuse its cached compiled statement on every execution.
+        """
+        queries_for_backend = {
+            name: (query[self.db_type] if isinstance(query, dict) else query).strip()
+            for name, query in queries.items()
+        }
+        if self.db_type != "postgres":
+            return queries_for_backend
+
+        statements = {}
+        for name, query in queries_for_backend.items():
+            parts = query.split("?")
+            prepared = "".join(f"{part}${index}" for index, part in enumerate(parts[:-1], start=1)) + parts[-1]
+            self.cursor.execute(f"PREPARE {name} AS {prepared}")
+            if len(parts) > 1:
+                statements[name] = f"EXECUTE {name} ({', '.join(['%s'] * (len(parts) - 1))})"
+            else:
+                statements[name] = f"EXECUTE {name}"
+        return statements
+
+    def _execute_named(self, name: str, params: tuple = ()):
+        """Execute one of the named queries with the given parameters"""
+        self.last_activity = time.monotonic()
+        self.cursor.execute(self.statements[name], params)
+
+    def _iter_named(self, name: str, params: tuple = (), server_side: bool = False) -> Iterator[tuple]:
+        """Execute one of the named queries and stream the resulting rows in batches
+
+        Uses a cursor of its own so other queries can be made while iterating. On Postgres a
+        client side cursor receives all rows on execute, so only `server_side` iteration holds
+        one batch of rows in memory at a time. It runs the query text rather than the prepared
+        statement, as an `EXECUTE` can not be declared as a cursor, and takes a round trip per
+        batch, so it is only used for results that can be large.
+        """
+        self.last_activity = time.monotonic()
+        if self.db_type == "postgres" and server_side:
+            self.cursor_count += 1
+            # Held over commits, as the connection is in autocommit mode
+            cursor = self.conn.cursor(name=f"iter_{name}_{self.cursor_count}", withhold=True)
+            statement = self.translated_queries[name]
+        else:
+            cursor = self.conn.cursor()
+            statement = self.statements[name]
+        try:
+            cursor.execute(statement, params)
+            while rows := cursor.fetchmany(FETCH_BATCH_SIZE):
+                yield from rows
+        finally:
+            cursor.close()
+
+    def iter_encrypted_events(self, session_id: str) -> Iterator[EncryptedEvent]:
+        for row in self._iter_named("get_encrypted_events", (session_id,), server_side=True):
+            yield EncryptedEvent(*row)
+
+    def iter_encrypted_events_for_user(self, user_id: str) -> Iterator[EncryptedEvent]:
+        for row in self._iter_named("get_encrypted_events_for_user", (user_id,), server_side=True):
+            yield EncryptedEvent(*row)
+
+    def get_encrypted_events(self, session_id: str) -> List[EncryptedEvent]:
+        return list(self.iter_encrypted_events(session_id))
+
+    def get_encrypted_events_for_user(self, user_id: str) -> List[EncryptedEvent]:
+        return list(self.iter_encrypted_events_for_user(user_id))
+
+    def count_encrypted_events_for_user(self, user_id: str) -> int:
+        self._execute_named("count_encrypted_events_for_user", (user_id,))
+        return self.cursor.fetchone()[0]
+
+    def _cache_message(self, management_event_id: str, message: Message):
+        if not self.message_cache_size:
+            return
+        self.message_cache[management_event_id] = message
+        self.message_cache.move_to_end(management_event_id)
+        if len(self.message_cache) > self.message_cache_size:
+            self.message_cache.popitem(last=False)
+
+    def get_message_by_management_event_id(self, management_event_id: str) -> Optional[Message]:
+        message = self.message_cache.get(management_event_id)
+        if message:
+            self.message_cache_hits += 1
+            self.message_cache.move_to_end(management_event_id)
+            return message
+        self.message_cache_misses += 1
+        logger.debug(
+            "Message cache miss for %s (hits: %s, misses: %s)",
+            management_event_id, self.message_cache_hits, self.message_cache_misses,
+        )
+
+        self._execute_named("get_message_by_management_event_id", (management_event_id,))
         row = self.cursor.fetchone()
         if row:
-            return {
-                "room_id": row[0],
-                "event_id": row[1],
-            }
+            message = Message(*row)
+            self._cache_message(management_event_id, message)
+            return message
+
+    def get_message_cache_stats(self) -> dict:
+        lookups = self.message_cache_hits + self.message_cache_misses
+        return {
+            "size": len(self.message_cache),
+            "max_size": self.message_cache_size,
+            "hits": self.message_cache_hits,
+            "misses": self.message_cache_misses,
+            "hit_rate": self.message_cache_hits / lookups if lookups else 0.0,
+        }
+
+    async def report_message_cache(self):
+        """Log the message cache statistics periodically"""
+        while True:
+            await asyncio.sleep(MESSAGE_CACHE_REPORT_INTERVAL)
+            logger.info("Message cache: %s", self.get_message_cache_stats())
 
     def remove_encrypted_event(self, event_id: str):
-        self._execute("""
-            delete from encrypted_events where event_id = ?;
-        """, (event_id,))
+        self._execute_named("remove_encrypted_event", (event_id,))
 
     def store_encrypted_event(self, event: MegolmEvent):
         try:
             event_dict = asdict(event)
-            event_json = json.dumps(event_dict)
-            self._execute("""
-                insert into encrypted_events
-                    (device_id, event_id, room_id, session_id, event, user_id) values
-                    (?, ?, ?, ?, ?, ?)
-            """, (event.device_id, event.event_id, event.room_id, event.session_id, event_json, event.sender))
+            event_json = dumps(event_dict)
+            self._execute_named("store_encrypted_event", (
+                event.device_id, event.event_id, event.room_id, event.session_id, event_json, event.sender,
+            ))
         except Exception as ex:
             logger.error("Failed to store encrypted event %s: %s" % (event.event_id, ex))
 
     def store_message(self, event_id: str, management_event_id: str, room_id: str):
-        self._execute("""
-            insert into messages (event_id, management_event_id, room_id) values (?, ?, ?)
-        """, (event_id, management_event_id, room_id))
+        self._execute_named("store_message", (event_id, management_event_id, room_id))
+        self._cache_message(management_event_id, Message(room_id, event_id))
+
+    def enqueue_outbox(
+        self, txn_id: str, kind: str, room_id: str, content: str, source_event_id: str, source_room_id: str,
+    ):
+        self._execute_named("enqueue_outbox", (txn_id, kind, room_id, content, source_event_id, source_room_id))
+
+    def get_due_outbox(self, now: float, limit: int) -> List[OutboxItem]:
+        return [OutboxItem(*row) for row in self._iter_named("get_due_outbox", (now, limit))]
+
+    def complete_outbox(self, outbox_id: int, sent_event_id: str, message: Optional[tuple] = None):
+        """Mark an outbox item sent, storing the message mapping of it in the same transaction
+
+        Args:
+            outbox_id: ID of the outbox item
+
+            sent_event_id: ID of the event the item was sent as
+
+            message: Optional tuple of event ID, management event ID and room ID to store
+                with `store_message`
+        """
+        self._begin()
+        try:
+            if message:
+                self._execute_named("store_message", message)
+            self._execute_named("complete_outbox", (sent_event_id, outbox_id))
+        except Exception:
+            self._rollback()
+            raise
+        self._commit()
+        if message:
+            event_id, management_event_id, room_id = message
+            self._cache_message(management_event_id, Message(room_id, event_id))
+
+    def retry_outbox(self, outbox_id: int, attempts: int, next_attempt: float):
+        self._execute_named("retry_outbox", (attempts, next_attempt, outbox_id))
+
+    def fail_outbox(self, outbox_id: int, attempts: int):
+        self._execute_named("fail_outbox", (attempts, outbox_id))
+
+    def save_key_request(
+        self, session_id: str, room_id: str, user_id: str, attempts: int, next_attempt: float, status: str,
+    ):
+        params = (room_id, user_id, attempts, next_attempt, status, session_id)
+        self._execute_named("update_key_request", params)
+        if self.cursor.rowcount <= 0:
+            self._execute_named("insert_key_request", params)
+
+    def prune_key_requests(self) -> int:
+        """Delete the key requests that are no longer needed
+
+        Expired requests are kept while events of their session are stored, so that `prune`
+        can still delete those events.
+
+        Returns:
+            The amount of requests deleted
+        """
+        self._execute_named("prune_key_requests")
+        return self.cursor.rowcount
+
+    def get_pending_key_requests(self) -> List[KeyRequest]:
+        return [KeyRequest(*row) for row in self._iter_named("get_pending_key_requests")]
+
+    def get_welcome_message_rooms(self) -> Iterator[str]:
+        for row in self._iter_named("get_welcome_message_rooms", server_side=True):
+            yield row[0]
+
+    def store_welcome_message_room(self, room_id: str):
+        self._execute_named("store_welcome_message_room", (room_id,))
+
+    def store_relays(self, relays: List[tuple]):
+        """Add relayed messages to the search index, in one transaction
+
+        Args:
+            relays: Tuples of event ID, room ID, sender, body and creation time
+        """
+        self._begin()
+        try:
+            for relay in relays:
+                self._execute_named("store_relay", relay)
+        except Exception:
+            self._rollback()
+            raise
+        self._commit()
+
+    def prune_relays(self, before: float) -> int:
+        """Delete the relayed messages created before the given time from the search index
+
+        Returns:
+            The amount of messages deleted
+        """
+        self._execute_named("prune_relays", (before,))
+        return self.cursor.rowcount
+
+    def search_relays(self, text: str, sender: Optional[str] = None, limit: int = 10) -> List[SearchResult]:
+        """Find relayed messages, best matches first
+
+        Args:
+            text: Words to search for, all of which must match. If empty, the latest
+                messages of the sender are returned.
+
+            sender: Optional user ID of the sender to limit to
+
+            limit: Maximum amount of results
+        """
+        if not text:
+            if not sender:
+                return []
+            rows = self._iter_named("get_relays_by_sender", (sender, limit))
+        else:
+            if self.db_type == "sqlite":
+                # Match the words as such, without the FTS5 query syntax
+                text = " ".join('"' + word.replace('"', '""') + '"' for word in text.split())
+            if sender:
+                rows = self._iter_named("search_relays_by_sender", (text, sender, limit))
+            else:
+                rows = self._iter_named("search_relays", (text, limit))
+        return [SearchResult(*row) for row in rows]
@@ -1,25 +1,37 @@
 from logging import Logger
 import re
-import time
 
-from typing import Optional, List
+from typing import List, NamedTuple, Optional, Set
+from urllib.parse import quote
 
 # noinspection PyPackageRequirements
 import nio
 
+from middleman.retry import with_retry
+from middleman.serialisation import loads
+
 
 # Domain part from https://stackoverflow.com/a/106223/1489738
 USER_ID_REGEX = r"@[a-z0-9_=\/\-\.]*:(([a-zA-Z0-9]|[a-zA-Z0-9][a-zA-Z0-9\-]*[a-zA-Z0-9])\.)*([A-Za-z0-9]|[A-Za-z0-9]" \
                 r"[A-Za-z0-9\-]*[A-Za-z0-9])*"
 
-reply_regex = re.compile(r"<mx-reply><blockquote>.*</blockquote></mx-reply>(.*)", flags=re.RegexFlag.DOTALL)
+# Path of the client-server API, for requests the client has no method for
+CLIENT_API_PATH = "/_matrix/client/v3"
 
+REPLY_FALLBACK_START = "<mx-reply><blockquote>"
+REPLY_FALLBACK_END = "</blockquote></mx-reply>"
+REPLY_COMMAND = "!reply "
+REPLY_PREFIXES = (REPLY_COMMAND, "<p>" + REPLY_COMMAND)
+
+
+class Relations(NamedTuple):
+    reply_to: Optional[str]
+    replaces: Optional[str]
+    # The text to relay back, if the message is a `!reply` to or an edit of another event
+    reply_text: Optional[str]
 
-def get_in_reply_to(event: nio.Event) -> Optional[str]:
-    """
-    Pulls an in reply to event ID from an event, if any.
-    """
-    return event.source.get("content", {}).get("m.relates_to", {}).get("m.in_reply_to", {}).get("event_id")
+
+NO_RELATIONS = Relations(None, None, None)
 
 
 def get_mentions(text: str) -> List[str]:
@@ -30,66 +42,100 @@ def get_mentions(text: str) -> List[str]:
     return list({match.group() for match in matches})
 
 
-def get_replaces(event: nio.Event) -> Optional[str]:
+def _strip_reply_fallback(content: dict) -> Optional[str]:
     """
-    Get the replaces relation, if any.
+    Get the body of a message without any quoted reply fallback.
     """
-    rel_type = event.source.get("content", {}).get("m.relates_to", {}).get("rel_type")
-    if rel_type == "m.replace":
-        return event.source.get("content").get("m.relates_to").get("event_id")
-
-
-def _get_reply_msg(event: nio.Event) -> Optional[str]:
-    # first check if this is edit
-    if get_replaces(event):
-        msg_plain = event.source.get("content", {}).get("m.new_content", {}).get("body")
-        msg_formatted = event.source.get("content", {}).get("m.new_content", {}).get("formatted_body")
-    else:
-        msg_plain = event.source.get("content", {}).get("body")
-        msg_formatted = event.source.get("content", {}).get("formatted_body")
-
-    if msg_formatted and (reply_msg := reply_regex.findall(msg_formatted)):
-        return reply_msg[0]
-    elif msg_formatted:
-        return msg_formatted
-    else:
-        #revert to old method
-        message_parts = msg_plain.split('\n\n', 1)
-        if len(message_parts) > 1:
-            return '\n\n'.join(message_parts[1:])
-        return msg_plain
-
+    formatted = content.get("formatted_body")
+    if formatted:
+        start = formatted.find(REPLY_FALLBACK_START)
+        if start > -1:
+            end = formatted.rfind(REPLY_FALLBACK_END)
+            if end >= start + len(REPLY_FALLBACK_START):
+                return formatted[end + len(REPLY_FALLBACK_END):]
+        return formatted
+
+    plain = content.get("body")
+    if plain is None:
+        return None
+    # Plain text fallback is separated from the reply by an empty line
+    _fallback, separator, reply = plain.partition("\n\n")
+    return reply if separator else plain
+
+
+def parse_relations(event: nio.Event) -> Relations:
+    """
+    Get the reply and replace relations of an event and the text of any `!reply` it contains, in one pass.
 
-def get_reply_msg(event: nio.Event, reply_to: Optional[str], replaces: Optional[str]) -> Optional[str]:
-    if reply_to or replaces:
-        if reply_section := _get_reply_msg(event):
-            if any([reply_section.startswith(x) for x in ("!reply ", "<p>!reply ")]):
-                return reply_section
+    Messages without relations, which is most of them, are rejected before looking at the body.
+    """
+    content = event.source.get("content", {})
+    relates_to = content.get("m.relates_to")
+    if not relates_to:
+        return NO_RELATIONS
+
+    reply_to = (relates_to.get("m.in_reply_to") or {}).get("event_id")
+    replaces = relates_to.get("event_id") if relates_to.get("rel_type") == "m.replace" else None
+    if not reply_to and not replaces:
+        return NO_RELATIONS
+
+    if replaces:
+        # The reply of an edit is in the new content
+        content = content.get("m.new_content", {})
+    reply_section = _strip_reply_fallback(content)
+    reply_text = None
+    if reply_section and reply_section.startswith(REPLY_PREFIXES):
+        # Send back anything after !reply
+        reply_text = reply_section[reply_section.find(REPLY_COMMAND) + len(REPLY_COMMAND):]
+    return Relations(reply_to, replaces, reply_text)
+
+
+def restore_megolm_event(event_json: str) -> nio.MegolmEvent:
+    """
+    Restore a MegolmEvent stored as JSON by `Storage.store_encrypted_event`.
+    """
+    event_dict = loads(event_json)
+    params = event_dict["source"]
+    params["room_id"] = event_dict["room_id"]
+    params["transaction_id"] = event_dict["transaction_id"]
+    return nio.MegolmEvent.from_dict(params)
 
 
 async def get_room_id(client: nio.AsyncClient, room: str, logger: Logger) -> str:
     if room.startswith("#"):
         response = await client.room_resolve_alias(room)
         if getattr(response, "room_id", None):
-            logger.debug(f"Room '{room}' resolved to {response.room_id}")
+            logger.debug("Room '%s' resolved to %s", room, response.room_id)
             return response.room_id
         else:
             logger.warning(f"Could not resolve '{room}' to a room ID")
-            raise ValueError(message="Unknown room alias")
+            raise ValueError(f"Unknown room alias {room}")
     elif room.startswith("!"):
         return room
     else:
         logger.warning(f"Unknown type of room identifier: {room}")
-        raise ValueError(message="Unknown room identifier")
+        raise ValueError(f"Unknown room identifier {room}")
+
+
+async def get_room_tags(client: nio.AsyncClient, room_id: str) -> Set[str]:
+    """
+    Get the tags the bot has set on a room.
+    """
+    path = f"{CLIENT_API_PATH}/user/{quote(client.user_id, safe='')}/rooms/{quote(room_id, safe='')}/tags"
+    headers = {"Authorization": f"Bearer {client.access_token}"}
+    response = await with_retry(lambda: client.send("GET", path, headers=headers))
+    try:
+        if response.status != 200:
+            return set()
+        content = await response.json()
+        return set(content.get("tags", {}))
+    finally:
+        response.release()
 
 
 async def with_ratelimit(client, method, *args, **kwargs):
     """
-    Call a client method with 3s backoff if rate limited.
+    Call a client method, retrying with backoff if rate limited or the server fails.
     """
     func = getattr(client, method)
-    response = await func(*args, **kwargs)
-    if getattr(response, "status_code", None) == "M_LIMIT_EXCEEDED":
-        time.sleep(3)
-        return with_ratelimit(client, method, *args, **kwargs)
-    return response
+    return await with_retry(lambda: func(*args, **kwargs))
@@ -0,0 +1,86 @@
+"""
+Compare the peak memory of reading a large backlog of undecrypted events.
+
+Run from the repository root with `python scripts/bench_backlog_memory.py [--rows N]`.
+The backlog of one user is read both as the bot did before, fetching all rows into a
+list of dicts, into a list of `EncryptedEvent` tuples, and by streaming the tuples with
+`iter_encrypted_events_for_user`. Peak memory is measured with tracemalloc.
+"""
+import argparse
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from middleman.storage import Storage  # noqa: E402
+
+USER_ID = "@user:example.com"
+# Roughly the size of a serialised megolm event
+EVENT_JSON = '{"source": {"content": {"ciphertext": "%s"}}}' % ("A" * 400)
+
+
+def read_dicts(store: Storage) -> int:
+    store._execute("""
+        select id, device_id, room_id, session_id, event, user_id from encrypted_events where user_id = ?;
+    """, (USER_ID,))
+    events = [
+        {
+            "id": row[0],
+            "device_id": row[1],
+            "room_id": row[2],
+            "session_id": row[3],
+            "event": row[4],
+            "user_id": row[5],
+        } for row in store.cursor.fetchall()
+    ]
+    return len(events)
+
+
+def read_tuples(store: Storage) -> int:
+    return len(store.get_encrypted_events_for_user(USER_ID))
+
+
+def read_stream(store: Storage) -> int:
+    count = 0
+    for _event in store.iter_encrypted_events_for_user(USER_ID):
+        count += 1
+    return count
+
+
+def measure(store: Storage, read) -> tuple:
+    tracemalloc.start()
+    started = time.perf_counter()
+    rows = read(store)
+    elapsed = time.perf_counter() - started
+    _current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return rows, peak, elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=100000, help="how many undecrypted events to store")
+    args = parser.parse_args()
+
+    store = Storage({"type": "sqlite", "connection_string": ":memory:"})
+    store._begin()
+    for i in range(args.rows):
+        store._execute_named("store_encrypted_event", (
+            "DEVICE", f"$event{i}", "!room:example.com", f"session{i % 1000}", EVENT_JSON, USER_ID,
+        ))
+    store._commit()
+
+    for label, read in (
+        ("dicts, fetchall", read_dicts),
+        ("NamedTuple, list", read_tuples),
+        ("NamedTuple, streaming", read_stream),
+    ):
+        rows, peak, elapsed = measure(store, read)
+        print(f"{label:24} {rows} rows, peak {peak / 1024 / 1024:.1f} MiB, {elapsed:.2f}s")
+    store.close()
+
+
+if __name__ == "__main__":
+    main()
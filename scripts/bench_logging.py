@@ -0,0 +1,75 @@
+"""
+Compare logging to a slow disk directly and through the log queue.
+
+Run from the repository root with `python scripts/bench_logging.py [--records N] [--delay MS]`.
+Records are written to a stream that sleeps on every write to simulate a slow disk or
+pipe, either by a handler called directly, as without `logging.queue`, or by a
+`QueueListener` thread behind a `QueueHandler`, set up as the config does with
+`logging.queue` enabled. Reported is the time the logging calls block the caller, which
+is the time the event loop would be stalled, and the time until every record is written.
+"""
+import argparse
+import io
+import logging
+import queue
+import time
+from logging.handlers import QueueHandler, QueueListener
+
+
+class SlowStream(io.StringIO):
+    def __init__(self, delay: float):
+        super().__init__()
+        self.delay = delay
+
+    def write(self, text: str) -> int:
+        time.sleep(self.delay)
+        return super().write(text)
+
+
+def get_handler(delay: float) -> logging.Handler:
+    handler = logging.StreamHandler(SlowStream(delay))
+    handler.setFormatter(logging.Formatter("%(asctime)s | %(name)s [%(levelname)s] %(message)s"))
+    return handler
+
+
+def bench(records: int, delay: float, use_queue: bool) -> tuple:
+    logger = logging.getLogger(f"bench.{'queue' if use_queue else 'direct'}")
+    logger.propagate = False
+    logger.setLevel(logging.INFO)
+    handler = get_handler(delay)
+    listener = None
+    if use_queue:
+        log_queue = queue.SimpleQueue()
+        logger.addHandler(QueueHandler(log_queue))
+        listener = QueueListener(log_queue, handler, respect_handler_level=True)
+        listener.start()
+    else:
+        logger.addHandler(handler)
+
+    started = time.perf_counter()
+    for i in range(records):
+        logger.info("Relayed message %s from %s to %s", i, "@user:example.com", "!room:example.com")
+    blocked = time.perf_counter() - started
+    if listener:
+        listener.stop()
+    written = time.perf_counter() - started
+    return blocked, written
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--records", type=int, default=2000, help="how many records to log")
+    parser.add_argument("--delay", type=float, default=1, help="milliseconds each write to the stream takes")
+    args = parser.parse_args()
+
+    print(f"{args.records} records, {args.delay} ms per write")
+    for label, use_queue in (("direct", False), ("queue", True)):
+        blocked, written = bench(args.records, args.delay / 1000, use_queue)
+        print(
+            f"{label:7} caller blocked {blocked * 1000:8.1f} ms ({blocked / args.records * 1e6:7.1f} us per record), "
+            f"all written after {written * 1000:8.1f} ms",
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,231 @@
+"""
+Compare relay throughput, the event loop and serialisation with `performance_mode` off and on.
+
+Run from the repository root with `python scripts/bench_performance_mode.py [--relays N]`.
+Relay throughput is measured by relaying messages through the outbox as the bot does:
+each message is formatted and stored in the outbox by `Message.process`, and the outbox
+worker loads it, sends it to a stand-in client that answers at once, and stores the
+message mapping. The database is in memory, or with `--database DIRECTORY` a fresh SQLite
+file in that directory with the `--profile` given. Relaying needs the Matrix
+dependencies to be installed.
+
+The event loop is measured by handing events from a producer to worker tasks through an
+`asyncio.Queue`, each worker yielding to the loop a few times per event, as the sync, the
+inbound queue and the outbox do. Serialisation is measured by dumping and loading a
+typical outbox message and a stored encrypted event with `middleman.serialisation`.
+
+Performance mode uses uvloop and orjson, each only when installed. The best of several
+repeats is reported.
+"""
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+import time
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from middleman import serialisation  # noqa: E402
+from middleman.storage import Storage  # noqa: E402
+
+WORKERS = 4
+YIELDS_PER_EVENT = 3
+
+
+def get_documents() -> dict:
+    return {
+        "outbox message": {
+            "msgtype": "m.text",
+            "body": "Message relayed from @user:example.com in Room: " + "Hello, is anyone around? " * 5,
+            "format": "org.matrix.custom.html",
+            "formatted_body": "<p>Message relayed from @user:example.com in Room:</p><p>"
+                              + "Hello, is anyone around? " * 5 + "</p>",
+        },
+        "encrypted event": {
+            "source": {
+                "content": {
+                    "algorithm": "m.megolm.v1.aes-sha2",
+                    "ciphertext": "A" * 400,
+                    "device_id": "DEVICE",
+                    "sender_key": "B" * 43,
+                    "session_id": "C" * 43,
+                },
+                "event_id": "$event:example.com",
+                "origin_server_ts": 1700000000000,
+                "room_id": "!room:example.com",
+                "sender": "@user:example.com",
+                "type": "m.room.encrypted",
+                "unsigned": {"age": 1234},
+            },
+        },
+    }
+
+
+async def churn(events: int):
+    queue = asyncio.Queue(maxsize=100)
+
+    async def worker():
+        while True:
+            await queue.get()
+            for _ in range(YIELDS_PER_EVENT):
+                await asyncio.sleep(0)
+            queue.task_done()
+
+    workers = [asyncio.ensure_future(worker()) for _ in range(WORKERS)]
+    for i in range(events):
+        await queue.put(i)
+    await queue.join()
+    for task in workers:
+        task.cancel()
+    await asyncio.gather(*workers, return_exceptions=True)
+
+
+def bench_loop(new_event_loop, events: int, repeats: int = 5) -> float:
+    best = None
+    for _ in range(repeats):
+        loop = new_event_loop()
+        try:
+            started = time.perf_counter()
+            loop.run_until_complete(churn(events))
+            elapsed = time.perf_counter() - started
+        finally:
+            loop.close()
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def bench_serialisation(document: dict, runs: int, repeats: int = 5) -> float:
+    best = None
+    for _ in range(repeats):
+        started = time.perf_counter()
+        for _ in range(runs):
+            serialisation.loads(serialisation.dumps(document))
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def get_relay_config() -> SimpleNamespace:
+    return SimpleNamespace(
+        management_room="!management:example.com",
+        management_room_id="!management:example.com",
+        mention_only_rooms=set(),
+        mention_only_always_for_named=False,
+        user_localpart="bot",
+        anonymise_senders=False,
+        outbox_enabled=True,
+        # As fast as the worker can, to measure the relay path rather than the rate limit
+        outbox_rate=1e9,
+        outbox_max_attempts=10,
+        confirm_reaction=False,
+    )
+
+
+class StandInClient(object):
+    def __init__(self):
+        """Answers sends at once, in place of the homeserver"""
+        # noinspection PyPackageRequirements
+        from nio import RoomSendResponse
+
+        self.response_class = RoomSendResponse
+        self.rooms = {}
+        self.sent = 0
+
+    async def room_send(self, room_id: str, message_type: str, content: dict, tx_id: str = None, **kwargs):
+        self.sent += 1
+        return self.response_class(f"$relay{self.sent}", room_id)
+
+
+async def relay(store: Storage, relays: int):
+    from middleman.message_responses import Message
+    from middleman.outbox import Outbox
+
+    config = get_relay_config()
+    client = StandInClient()
+    outbox = Outbox(client, store, config)
+    worker = asyncio.ensure_future(outbox.run())
+    room = SimpleNamespace(room_id="!room:example.com", display_name="Room", canonical_alias=None, is_named=True)
+    for i in range(relays):
+        event = SimpleNamespace(event_id=f"$event{i}", sender="@user:example.com", source={"content": {}})
+        body = f"Hello, is anyone around? This is message number {i}. " * 2
+        await Message(client, store, config, body, room, event, outbox=outbox).process()
+    while client.sent < relays:
+        await asyncio.sleep(0.001)
+    outbox.stop()
+    await worker
+
+
+def bench_relay(new_event_loop, relays: int, database: str, profile: str, repeats: int = 3) -> float:
+    best = None
+    for _ in range(repeats):
+        with tempfile.TemporaryDirectory(dir=database) as directory:
+            store = Storage({
+                "type": "sqlite",
+                "connection_string": os.path.join(directory, "relay.db") if database else ":memory:",
+                "profile": profile,
+            })
+            loop = new_event_loop()
+            try:
+                started = time.perf_counter()
+                loop.run_until_complete(relay(store, relays))
+                elapsed = time.perf_counter() - started
+            finally:
+                loop.close()
+                store.close()
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--relays", type=int, default=5000, help="how many messages to relay")
+    parser.add_argument("--database", metavar="DIRECTORY", help="relay with a database file in this directory")
+    parser.add_argument(
+        "--profile", default="performance", choices=["default", "performance"],
+        help="SQLite profile of the database file (default: performance)",
+    )
+    parser.add_argument("--events", type=int, default=100000, help="how many events to hand to the workers")
+    parser.add_argument("--runs", type=int, default=100000, help="how many times to serialise each document")
+    args = parser.parse_args()
+
+    loops = [("asyncio", asyncio.new_event_loop)]
+    try:
+        # noinspection PyPackageRequirements
+        import uvloop
+    except ImportError:
+        print("uvloop is not installed, performance mode is measured without it")
+    else:
+        loops.append(("uvloop", uvloop.new_event_loop))
+    orjson_module = serialisation._orjson if serialisation.use_orjson() else None
+    if not orjson_module:
+        print("orjson is not installed, performance mode is measured without it")
+
+    database = f"a {args.profile} profile database file" if args.database else "an in-memory database"
+    print(f"Relaying {args.relays} messages through the outbox with {database}")
+    results = {}
+    for label, new_event_loop, enabled in (("off", loops[0][1], False), ("on", loops[-1][1], True)):
+        serialisation._orjson = orjson_module if enabled else None
+        results[label] = bench_relay(new_event_loop, args.relays, args.database, args.profile)
+        print(f"    performance mode {label:3} {args.relays / results[label]:8.0f} messages/s")
+    print(f"    on / off: {results['off'] / results['on']:.2f}x")
+
+    print(f"Event loop, {args.events} events to {WORKERS} workers    (microseconds per event)")
+    for label, new_event_loop in loops:
+        elapsed = bench_loop(new_event_loop, args.events)
+        print(f"    {label:8} {elapsed / args.events * 1e6:8.2f}")
+
+    print(f"Serialisation, {args.runs} dumps and loads    (microseconds per document)")
+    modes = [("json", False)]
+    if orjson_module:
+        modes.append(("orjson", True))
+    for label, enabled in modes:
+        serialisation._orjson = orjson_module if enabled else None
+        for name, document in get_documents().items():
+            elapsed = bench_serialisation(document, args.runs)
+            print(f"    {label:8} {name:16} {elapsed / args.runs * 1e6:8.2f}")
+
+
+if __name__ == "__main__":
+    main()
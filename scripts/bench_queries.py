@@ -0,0 +1,81 @@
+"""
+Measure the per-query overhead of the bot's most frequent queries on SQLite.
+
+Run from the repository root with `python scripts/bench_queries.py [--runs N]`.
+Each query is run both ad hoc, passing the query text through `_execute` as the bot
+did before the named queries, and through `_execute_named`, on an in-memory database
+holding a small backlog. Only executing the query and fetching the rows is timed.
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from middleman.storage import Storage, queries  # noqa: E402
+
+# Rows of each table in the database queried
+BACKLOG_ROWS = 1000
+
+
+def get_params(name: str, runs: int) -> list:
+    if name == "store_message":
+        return [(f"$new{i}", f"$newmanagement{i}", "!room") for i in range(runs)]
+    if name == "get_encrypted_events":
+        return [(f"session{i % 100}",) for i in range(runs)]
+    if name == "get_encrypted_events_for_user":
+        return [(f"@user{i % 100}:example.com",) for i in range(runs)]
+    if name == "get_message_by_management_event_id":
+        return [(f"$management{i % BACKLOG_ROWS}",) for i in range(runs)]
+    # Deleting events that are not stored keeps the table the same between runs
+    return [(f"$missing{i}",) for i in range(runs)]
+
+
+def get_store() -> Storage:
+    store = Storage({"type": "sqlite", "connection_string": ":memory:"}, message_cache_size=0)
+    store._begin()
+    for i in range(BACKLOG_ROWS):
+        store.store_message(event_id=f"$event{i}", management_event_id=f"$management{i}", room_id="!room")
+        store._execute_named("store_encrypted_event", (
+            "DEVICE", f"$encrypted{i}", "!room", f"session{i % 100}", "{}", f"@user{i % 100}:example.com",
+        ))
+    store._commit()
+    return store
+
+
+def bench(store: Storage, execute, query: str, params: list) -> float:
+    started = time.perf_counter()
+    for args in params:
+        execute(query, args)
+        store.cursor.fetchall()
+    return time.perf_counter() - started
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=20000, help="how many times to run each query")
+    args = parser.parse_args()
+
+    names = [
+        "get_encrypted_events",
+        "get_encrypted_events_for_user",
+        "get_message_by_management_event_id",
+        "remove_encrypted_event",
+        "store_message",
+    ]
+    print(f"{'query':36} {'ad hoc':>10} {'named':>10}   (microseconds per query)")
+    for name in names:
+        params = get_params(name, args.runs)
+        # A fresh database per run, so the inserts of one run don't slow down the other
+        store = get_store()
+        ad_hoc = bench(store, store._execute, queries[name], params)
+        store.close()
+        store = get_store()
+        named = bench(store, store._execute_named, name, params)
+        store.close()
+        print(f"{name:36} {ad_hoc / args.runs * 1e6:10.2f} {named / args.runs * 1e6:10.2f}")
+
+
+if __name__ == "__main__":
+    main()
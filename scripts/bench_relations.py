@@ -0,0 +1,121 @@
+"""
+Compare `parse_relations` with the helpers it replaced on typical management room messages.
+
+Run from the repository root with `python scripts/bench_relations.py [--runs N]`.
+The old helpers are copied below as they were before `parse_relations`, and called the
+way the message callback called them. Each kind of message is parsed `--runs` times, and
+the best of five repeats is reported.
+"""
+import argparse
+import os
+import re
+import sys
+import time
+from types import SimpleNamespace
+from typing import Optional
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from middleman.utils import parse_relations  # noqa: E402
+
+reply_regex = re.compile(r"<mx-reply><blockquote>.*</blockquote></mx-reply>(.*)", flags=re.RegexFlag.DOTALL)
+
+
+def get_in_reply_to(event) -> Optional[str]:
+    return event.source.get("content", {}).get("m.relates_to", {}).get("m.in_reply_to", {}).get("event_id")
+
+
+def get_replaces(event) -> Optional[str]:
+    rel_type = event.source.get("content", {}).get("m.relates_to", {}).get("rel_type")
+    if rel_type == "m.replace":
+        return event.source.get("content").get("m.relates_to").get("event_id")
+
+
+def _get_reply_msg(event) -> Optional[str]:
+    if get_replaces(event):
+        msg_plain = event.source.get("content", {}).get("m.new_content", {}).get("body")
+        msg_formatted = event.source.get("content", {}).get("m.new_content", {}).get("formatted_body")
+    else:
+        msg_plain = event.source.get("content", {}).get("body")
+        msg_formatted = event.source.get("content", {}).get("formatted_body")
+
+    if msg_formatted and (reply_msg := reply_regex.findall(msg_formatted)):
+        return reply_msg[0]
+    elif msg_formatted:
+        return msg_formatted
+    else:
+        message_parts = msg_plain.split('\n\n', 1)
+        if len(message_parts) > 1:
+            return '\n\n'.join(message_parts[1:])
+        return msg_plain
+
+
+def get_reply_msg(event, reply_to: Optional[str], replaces: Optional[str]) -> Optional[str]:
+    if reply_to or replaces:
+        if reply_section := _get_reply_msg(event):
+            if any([reply_section.startswith(x) for x in ("!reply ", "<p>!reply ")]):
+                return reply_section
+
+
+def old_parse(event):
+    reply_to = get_in_reply_to(event)
+    replaces = get_replaces(event)
+    return reply_to, replaces, get_reply_msg(event, reply_to, replaces)
+
+
+def get_events() -> dict:
+    quote = "<mx-reply><blockquote><a href=\"https://matrix.to/#/!room/$relay\">In reply to</a> " + \
+            "Message relayed from @user:example.com: " + "lorem ipsum " * 20 + "</blockquote></mx-reply>"
+    return {
+        "plain message": {"body": "Hello, is anyone around? " * 5, "msgtype": "m.text"},
+        "formatted message": {
+            "body": "Hello **there**", "formatted_body": "<p>Hello <strong>there</strong></p>", "msgtype": "m.text",
+        },
+        "reply": {
+            "body": "> <@user:example.com> lorem ipsum\n\nThanks, looking into it",
+            "formatted_body": quote + "Thanks, looking into it",
+            "m.relates_to": {"m.in_reply_to": {"event_id": "$relay"}},
+            "msgtype": "m.text",
+        },
+        "!reply": {
+            "body": "> <@user:example.com> lorem ipsum\n\n!reply Thanks, we will get back to you",
+            "formatted_body": quote + "!reply Thanks, we will get back to you",
+            "m.relates_to": {"m.in_reply_to": {"event_id": "$relay"}},
+            "msgtype": "m.text",
+        },
+        "!reply edit": {
+            "body": " * !reply Thanks, we will get back to you soon",
+            "m.new_content": {"body": "!reply Thanks, we will get back to you soon", "msgtype": "m.text"},
+            "m.relates_to": {"rel_type": "m.replace", "event_id": "$reply"},
+            "msgtype": "m.text",
+        },
+    }
+
+
+def bench(parse, event, runs: int, repeats: int = 5) -> float:
+    """Get the best time of parsing the event `runs` times"""
+    best = None
+    for _ in range(repeats):
+        started = time.perf_counter()
+        for _ in range(runs):
+            parse(event)
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=100000, help="how many times to parse each message")
+    args = parser.parse_args()
+
+    print(f"{'message':20} {'old':>8} {'new':>8}   (microseconds per message)")
+    for name, content in get_events().items():
+        event = SimpleNamespace(source={"content": content})
+        old = bench(old_parse, event, args.runs)
+        new = bench(parse_relations, event, args.runs)
+        print(f"{name:20} {old / args.runs * 1e6:8.2f} {new / args.runs * 1e6:8.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,50 @@
+"""
+Compare the write throughput of the default and performance SQLite profiles.
+
+Run from the repository root with `python scripts/bench_sqlite_profiles.py [--writes N]`.
+Each profile gets a fresh database file in a temporary directory, and every write is
+one autocommitted `store_message`, as when relaying messages.
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from middleman.storage import Storage  # noqa: E402
+
+
+def bench(profile: str, writes: int, directory: str) -> float:
+    store = Storage(
+        {
+            "type": "sqlite",
+            "connection_string": os.path.join(directory, f"{profile}.db"),
+            "profile": profile,
+        },
+        message_cache_size=0,
+    )
+    try:
+        started = time.perf_counter()
+        for i in range(writes):
+            store.store_message(event_id=f"$event{i}", management_event_id=f"$management{i}", room_id="!room")
+        return time.perf_counter() - started
+    finally:
+        store.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--writes", type=int, default=2000, help="how many messages to store per profile")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        results = {profile: bench(profile, args.writes, directory) for profile in ("default", "performance")}
+    for profile, elapsed in results.items():
+        print(f"{profile:12} {args.writes} writes in {elapsed:.2f}s, {args.writes / elapsed:.0f} writes/s")
+    print(f"performance / default: {results['default'] / results['performance']:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,64 @@
+"""
+Measure the startup time of the config check and of importing the bot.
+
+Run from the repository root with `python scripts/bench_startup.py [config.yaml]`.
+Each command is run in a fresh interpreter with `-X importtime`, several times, and the
+best wall time is reported along with the total import time and the slowest imports of
+the best run. Importing the bot needs the Matrix dependencies to be installed.
+"""
+import argparse
+import os
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def parse_importtime(stderr: str) -> list:
+    """Get the (cumulative microseconds, module) of the top level imports"""
+    imports = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "imported package" in line:
+            continue
+        _self, cumulative, name = line[len("import time:"):].split("|")
+        # Nested imports are indented
+        if not name.startswith("  "):
+            imports.append((int(cumulative), name.strip()))
+    return imports
+
+
+def bench(label: str, args: list, runs: int):
+    best = None
+    for _ in range(runs):
+        started = time.perf_counter()
+        process = subprocess.run(
+            [sys.executable, "-X", "importtime", *args], cwd=ROOT, capture_output=True, text=True,
+        )
+        elapsed = time.perf_counter() - started
+        if best is None or elapsed < best[0]:
+            best = (elapsed, process)
+
+    elapsed, process = best
+    imports = parse_importtime(process.stderr)
+    total = sum(cumulative for cumulative, _name in imports)
+    print(f"{label}: {elapsed * 1000:.0f} ms wall, {total / 1000:.0f} ms importing (exit code {process.returncode})")
+    for cumulative, name in sorted(imports, reverse=True)[:5]:
+        print(f"    {cumulative / 1000:7.1f} ms  {name}")
+    if process.returncode:
+        print("    " + process.stderr.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("config", nargs="?", default="config.yaml", help="path to the bot config file")
+    parser.add_argument("--runs", type=int, default=5, help="how many times to run each command")
+    args = parser.parse_args()
+
+    config = os.path.abspath(args.config)
+    bench("main.py --check-config", ["main.py", config, "--check-config"], args.runs)
+    bench("import middleman.main", ["-c", "import middleman.main"], args.runs)
+
+
+if __name__ == "__main__":
+    main()
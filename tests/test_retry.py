@@ -0,0 +1,143 @@
+import asyncio
+import time
+
+import pytest
+
+pytest.importorskip("aiohttp")
+pytest.importorskip("nio")
+
+# noinspection PyPackageRequirements
+from aiohttp import web  # noqa: E402
+# noinspection PyPackageRequirements
+from aiohttp.test_utils import TestServer  # noqa: E402
+# noinspection PyPackageRequirements
+from nio import AsyncClient, AsyncClientConfig, ErrorResponse, JoinedRoomsResponse  # noqa: E402
+
+from middleman.retry import RetryBudget, RetryPolicy, with_retry  # noqa: E402
+
+
+class FakeHomeserver(object):
+    def __init__(self, failures: list):
+        """Answers every request with the next injected failure, then with success
+
+        Args:
+            failures (list): Failures to answer with, in order, each a tuple of the HTTP
+                status, the JSON body and the seconds to wait before answering
+        """
+        self.failures = list(failures)
+        self.requests = 0
+
+    async def handle(self, request: web.Request) -> web.Response:
+        self.requests += 1
+        if self.failures:
+            status, body, delay = self.failures.pop(0)
+            await asyncio.sleep(delay)
+            return web.json_response(body, status=status)
+        return web.json_response({"joined_rooms": ["!room:example.com"]})
+
+
+def get_policy(**kwargs) -> RetryPolicy:
+    options = {"max_attempts": 4, "base_delay": 0.01, "max_delay": 1, "deadline": 5}
+    options.update(kwargs)
+    return RetryPolicy(**options)
+
+
+def run_joined_rooms(failures: list, policy: RetryPolicy) -> tuple:
+    """Request the joined rooms from a fake homeserver with the given failures and policy
+
+    Returns:
+        A tuple of the response or the error raised, the amount of requests made and the
+        seconds taken
+    """
+    async def run():
+        homeserver = FakeHomeserver(failures)
+        app = web.Application()
+        app.router.add_route("*", "/{tail:.*}", homeserver.handle)
+        server = TestServer(app)
+        await server.start_server()
+        # Retries are left to the retry policy, as in the bot
+        client = AsyncClient(
+            f"http://{server.host}:{server.port}", "@bot:example.com",
+            config=AsyncClientConfig(max_limit_exceeded=0, max_timeouts=0),
+        )
+        client.access_token = "token"
+        started = time.monotonic()
+        try:
+            response = await with_retry(client.joined_rooms, policy)
+        except Exception as ex:
+            response = ex
+        elapsed = time.monotonic() - started
+        await client.close()
+        await server.close()
+        return response, homeserver.requests, elapsed
+
+    return asyncio.run(run())
+
+
+def test_success_is_not_retried():
+    response, requests, _elapsed = run_joined_rooms([], get_policy())
+
+    assert isinstance(response, JoinedRoomsResponse)
+    assert requests == 1
+
+
+def test_server_errors_are_retried():
+    failures = [(502, {"errcode": "M_UNKNOWN", "error": "Bad gateway"}, 0)] * 2
+    response, requests, _elapsed = run_joined_rooms(failures, get_policy())
+
+    assert isinstance(response, JoinedRoomsResponse)
+    assert requests == 3
+
+
+def test_rate_limiting_waits_for_retry_after():
+    failures = [(429, {"errcode": "M_LIMIT_EXCEEDED", "error": "Too many requests", "retry_after_ms": 300}, 0)]
+    response, requests, elapsed = run_joined_rooms(failures, get_policy())
+
+    assert isinstance(response, JoinedRoomsResponse)
+    assert requests == 2
+    assert elapsed >= 0.3
+
+
+def test_retry_after_is_capped_at_max_delay():
+    failures = [(429, {"errcode": "M_LIMIT_EXCEEDED", "error": "Too many requests", "retry_after_ms": 60000}, 0)]
+    response, requests, elapsed = run_joined_rooms(failures, get_policy(max_delay=0.2))
+
+    assert isinstance(response, JoinedRoomsResponse)
+    assert requests == 2
+    assert elapsed < 5
+
+
+def test_client_errors_are_not_retried():
+    failures = [(403, {"errcode": "M_FORBIDDEN", "error": "Forbidden"}, 0)]
+    response, requests, _elapsed = run_joined_rooms(failures, get_policy())
+
+    assert isinstance(response, ErrorResponse)
+    assert response.status_code == "M_FORBIDDEN"
+    assert requests == 1
+
+
+def test_gives_up_after_max_attempts():
+    failures = [(503, {"errcode": "M_UNKNOWN", "error": "Unavailable"}, 0)] * 10
+    response, requests, _elapsed = run_joined_rooms(failures, get_policy(max_attempts=3))
+
+    assert isinstance(response, ErrorResponse)
+    assert requests == 3
+
+
+def test_slow_attempt_is_cancelled_at_the_deadline():
+    failures = [(200, {"joined_rooms": []}, 3)]
+    response, requests, elapsed = run_joined_rooms(failures, get_policy(deadline=0.5))
+
+    assert isinstance(response, asyncio.TimeoutError)
+    assert requests == 1
+    assert elapsed < 2
+
+
+def test_exhausted_budget_stops_retries():
+    budget = RetryBudget(max_tokens=2)
+    budget.withdraw()
+    failures = [(502, {"errcode": "M_UNKNOWN", "error": "Bad gateway"}, 0)] * 2
+    response, requests, _elapsed = run_joined_rooms(failures, get_policy(budget=budget))
+
+    assert isinstance(response, ErrorResponse)
+    assert requests == 1